@@ -1,50 +1,39 @@
-# from geoProjector import hk1980_to_wgs84
-import requests
+from src.lib.geoProjector import hk1980_to_wgs84
 DB = 'geo_maps'
 COLLECTIONS = [{'id': 'node', 'c_name': 'hk_node'}, {'id': 'link', 'c_name': 'hk_link'}]
 
-def hk1980_to_wgs84(north, east):
+def read_node(node_id, north, east, node_memo=None):
     """
-    Transform hk1980 to wgs84
-    :param north:
-    :param east:
-    :return:
+    Build a node and convert its hk1980 position to wgs84 locally
+    :param node_id: id of the node
+    :param north: hk1980 northing string
+    :param east: hk1980 easting string
+    :param node_memo: dict of the converted nodes by id, a shared node is converted once
+    :return: node dict
     """
-    r = requests.get("https://api.data.gov.hk/v1/coordinate-conversion",
-                     params={'hk80-northing': north, 'hk80-easting': east})
-    status_code = r.status_code
-    if status_code != 200:
-        print(status_code, 'not found')
-        return None
-    json_data = r.json()
-    obj = {
-        'lat': json_data['wgs84-latitude'],
-        'lon': json_data['wgs84-longitude']
+    if node_memo is not None and node_id in node_memo:
+        return node_memo[node_id]
+    lat, lon = hk1980_to_wgs84(float(north), float(east))
+    node = {
+        'id': node_id,
+        'hk80': [north, east],
+        'position': [lon, lat]
     }
-    return [obj['lat'], obj['lon']]
+    if node_memo is not None:
+        node_memo[node_id] = node
+    return node
 
-def read_nodes_from_seg(seg_obj):
+def read_nodes_from_seg(seg_obj, node_memo=None):
     """
     Extract source node and target node from one link
     :param seg_obj:
+    :param node_memo: dict of the converted nodes by id
     :return: array for the two elements
     """
-    p1 = hk1980_to_wgs84(float(seg_obj["Start_Node_Northings"])
-                                    , float(seg_obj["Start_Node_Eastings"]))
-    first_node = {
-        'id': seg_obj['Start_Node'],
-        'hk80': [seg_obj["Start_Node_Northings"], seg_obj["Start_Node_Eastings"]],
-        'position': [p1[1], p1[0]]
-    }
-
-    p2 = hk1980_to_wgs84(float(seg_obj["End_Node_Northings"])
-                                    , float(seg_obj["End_Node_Eastings"]))
-    second_node = {
-        'id': seg_obj['End_Node'],
-        'hk80': [seg_obj["End_Node_Northings"], seg_obj["End_Node_Eastings"]],
-        'position': [p2[1], p2[0]]
-    }
-
+    first_node = read_node(seg_obj['Start_Node'], seg_obj["Start_Node_Northings"], seg_obj["Start_Node_Eastings"],
+                           node_memo)
+    second_node = read_node(seg_obj['End_Node'], seg_obj["End_Node_Northings"], seg_obj["End_Node_Eastings"],
+                            node_memo)
     return [first_node, second_node]
 
 def parser_link(link_path):
@@ -61,14 +50,12 @@ def parser_link(link_path):
         print(schemas)
         line = input.readline()
         records = []
-        nodes = []
         links = []
         node_id_map = {}
         num = 0
         while line:
             # if num > 5:
             #     break
-            print(num, ' of records has been parsed')
             num += 1
             segs = line.split(',')
             segs = [seg.strip() for seg in segs]
@@ -78,11 +65,8 @@ def parser_link(link_path):
                 obj[schemas[i]] = segs[i]
 
             records.append(obj)
-            _nodes = read_nodes_from_seg(obj)
-            for n in _nodes:
-                if n['id'] not in node_id_map:
-                    node_id_map[id] = n
-                    nodes.append(n)
+            # Each node is converted and added once
+            _nodes = read_nodes_from_seg(obj, node_id_map)
 
             links.append({
                 'id': obj['Link_ID'],
@@ -93,8 +77,9 @@ def parser_link(link_path):
                 'region': obj['Region'],
                 'type': obj['Road_Type']
             })
+        print(num, ' of records has been parsed')
         return {
-            'node': nodes,
+            'node': list(node_id_map.values()),
             'link': links
         }
 def dump_tsm_node_link_to_db(path):
@@ -6,6 +6,14 @@ from psycopg2 import extras
 from pymongo import MongoClient
 import os
 import json
+import time
+
+from src.tsm_fetcher.tsm_storage import find_link_buckets, reconstruct_snapshot_state
+from src.tsm_fetcher.tsm_schema import to_typed_record
+from src.tsm_fetcher.tsm_link_cache import get_link_cache
+from src.tsm_fetcher.tsm_link_stats import LINK_STATS_COLLECTION, hour_of_week, zscore_from_stats
+from src.tsm_fetcher.tsm_congestion import CONGESTION_COLLECTION, merge_congestion_documents
+from src.tsm_fetcher.tsm_rollup import choose_resolution, find_rollup_records, rollup_to_record, ROLLUP_RESOLUTIONS
 
 
 DATABASE = "gis"
@@ -158,12 +166,14 @@ class OSMQuery:
                 # Return the distance
                 return result
 
-    def update_latest_link_info_from_mongodb(self, link_list, time_second, query_gap_second=3600):
+    def update_latest_link_info_from_mongodb(self, link_list, time_second, query_gap_second=3600,
+                                             storage_layout='document'):
         """
         Query and update the latest information for the link list
         :param link_list: a list of links queried from MongoDB
         :param time_second: seconds since the epoch
         :param query_gap_second: the time gap for query
+        :param storage_layout: layout of the traffic speed data, 'document', 'bucket' or 'delta' (see tsm_storage)
         :return: a list of updated link dicts
         """
 
@@ -174,51 +184,41 @@ class OSMQuery:
         start_time_second = time_second - (query_gap_second + 1800)
         query_data_size = int(query_gap_second / 1800)
 
+        if storage_layout == "delta":
+            # One reconstruction serves all the links
+            snapshot_time, snapshot_state = reconstruct_snapshot_state(db, time_second)
+        # The raw records older than the retention are deleted once rolled up (see tsm_rollup)
+        resolution = choose_resolution(start_time_second, time_second) if storage_layout == "document" else 0
+
         link_dict_list = []
         for link in link_list:
             link_dict = {}
             link_id = link["parent_id"]
-            # Transfer the cursor to a list
-            latest_link_record_list = list(tsm_collection
-                                           .find({"link_id": link_id,
-                                                  "capture_date_1970": {"$lt": time_second, "$gte": start_time_second}})
-                                           .limit(query_data_size))
+            if storage_layout == "bucket":
+                # The latest records of the range, find_link_buckets() sorts them by capture time
+                latest_link_record_list = find_link_buckets(db, link_id, start_time_second,
+                                                            time_second)[-query_data_size:]
+            elif storage_layout == "delta":
+                latest_link_record_list = []
+                if link_id in snapshot_state and snapshot_time >= start_time_second:
+                    latest_link_record_list.append(snapshot_state[link_id])
+            elif resolution:
+                latest_link_record_list = [rollup_to_record(d) for d in find_rollup_records(
+                    db, resolution, start_time_second, time_second, link_id)][-query_data_size:]
+            else:
+                # Transfer the cursor to a list
+                latest_link_record_list = list(tsm_collection
+                                               .find({"link_id": link_id,
+                                                      "capture_date_1970": {"$lt": time_second,
+                                                                            "$gte": start_time_second}})
+                                               .limit(query_data_size))
+                # Records not migrated yet are converted here
+                latest_link_record_list = [to_typed_record(r) for r in latest_link_record_list]
             # print(latest_link_record_list)
 
-            # Traffic information lists
-            link_saturation_level = []
-            link_traffic_speed = []
-
-            def convert_saturation_string(saturation_string):
-                saturation_level = 0
-                if saturation_string == "TRAFFIC GOOD":
-                    saturation_level = 3
-                elif saturation_string == "TRAFFIC AVERAGE":
-                    saturation_level = 2
-                elif saturation_string == "TRAFFIC BAD":
-                    saturation_level = 1
-                return saturation_level
-
-            if len(latest_link_record_list) == 0:
-                pass
-            elif len(latest_link_record_list) == 1:
-                link_saturation_level_string = latest_link_record_list[0]["road_saturation_level"]
-                link_saturation_level.append(convert_saturation_string(link_saturation_level_string))
-
-                link_traffic_speed.append(float(latest_link_record_list[0]["traffic_speed"]))
-            else:
-                # two links in the list
-                first_saturation_level_string = latest_link_record_list[0]["road_saturation_level"]
-                first_saturation_level = convert_saturation_string(first_saturation_level_string)
-                second_saturation_level_string = latest_link_record_list[1]["road_saturation_level"]
-                second_saturation_level = convert_saturation_string(second_saturation_level_string)
-                link_saturation_level.append(first_saturation_level)
-                link_saturation_level.append(second_saturation_level)
-
-                first_traffic_speed = float(latest_link_record_list[0]["traffic_speed"])
-                second_traffic_speed = float(latest_link_record_list[1]["traffic_speed"])
-                link_traffic_speed.append(first_traffic_speed)
-                link_traffic_speed.append(second_traffic_speed)
+            # Traffic information lists, the records are in the typed schema
+            link_saturation_level = [r["road_saturation_level"] for r in latest_link_record_list[:2]]
+            link_traffic_speed = [float(r["traffic_speed"]) for r in latest_link_record_list[:2]]
 
             link_dict["link_id"] = link["link_id"]
             link_dict["parent_id"] = link_id
@@ -259,23 +259,131 @@ def query_road_link_from_mongodb(link_id):
     """
     Query a road with link id stored in MongoDB
     :param link_id: string of two indexes (example: "3006-30069")
-    :return: records of the road from all time
+    :return: typed records of the road from all time (see tsm_schema), with the region and road_type
+             of the link dimension. Before the oldest raw record of the road (the raw records older than the
+             retention are deleted, see tsm_rollup) the records are the 30-minute rollups (see rollup_to_record())
     """
 
     client = MongoClient("127.0.0.1", 27017)
     db = client["traffic"]
     tsm_collection = db["traffic_speed_map"]
-    road_records = list(tsm_collection.find({"link_id": link_id}))
+    road_records = [to_typed_record(r) for r in tsm_collection.find({"link_id": link_id})
+                    .sort([("capture_date_1970", 1)])]
     # road_records = list(tsm_collection.find({"link_id": link_id}).sort([("capture_date", -1)]).limit(1))
+    # The rollup periods before the period of the oldest raw record, all of them without raw records
+    rollup_end = road_records[0]["capture_date_1970"] // ROLLUP_RESOLUTIONS[0] * ROLLUP_RESOLUTIONS[0] \
+        if len(road_records) else time.time()
+    road_records = [rollup_to_record(d) for d in find_rollup_records(
+        db, ROLLUP_RESOLUTIONS[0], 0, rollup_end, link_id)] + road_records
     client.close()
+    link_info = get_link_cache().get(link_id)
 
     if len(road_records) == 0:
         print("No traffic speed data of this road in current database")
         return None
     else:
+        if link_info is not None:
+            for record in road_records:
+                record["region"] = link_info["road_region"]
+                record["road_type"] = link_info["road_type"]
         return road_records
 
 
+def query_road_link_buckets_from_mongodb(link_id, start_time_second=None, end_time_second=None):
+    """
+    Query a road with link id stored in the hourly bucket layout
+    :param link_id: string of two indexes (example: "3006-30069")
+    :param start_time_second: start of the time range (included), seconds since the epoch
+    :param end_time_second: end of the time range (excluded), seconds since the epoch
+    :return: records of the road in the time range sorted by capture time, or None
+    """
+
+    client = MongoClient("127.0.0.1", 27017)
+    db = client["traffic"]
+    road_records = find_link_buckets(db, link_id, start_time_second, end_time_second)
+    client.close()
+
+    if len(road_records) == 0:
+        print("No traffic speed data of this road in current database")
+        return None
+    else:
+        return road_records
+
+
+def query_road_link_series_from_mongodb(link_id, start_time_second, end_time_second, resolution=None):
+    """
+    Query the speeds of a road in a time range at the resolution of the range (see tsm_rollup.choose_resolution)
+    :param link_id: string of two indexes (example: "3006-30069")
+    :param start_time_second: start of the time range (included), seconds since the epoch
+    :param end_time_second: end of the time range (excluded), seconds since the epoch
+    :param resolution: 0 for the raw records or a rollup resolution in seconds, chosen by the range by default
+    :return: (resolution, list of typed records for the raw records or rollup documents, sorted by time)
+    """
+
+    if resolution is None:
+        resolution = choose_resolution(start_time_second, end_time_second)
+    client = MongoClient("127.0.0.1", 27017)
+    db = client["traffic"]
+    if resolution:
+        road_records = list(find_rollup_records(db, resolution, start_time_second, end_time_second, link_id))
+    else:
+        road_records = [to_typed_record(r) for r in db["traffic_speed_map"]
+                        .find({"link_id": link_id,
+                               "capture_date_1970": {"$gte": start_time_second, "$lt": end_time_second}})
+                        .sort([("capture_date_1970", 1)])]
+    client.close()
+    return resolution, road_records
+
+
+def query_link_zscores_from_mongodb(link_list=None, min_count=10):
+    """
+    z-scores of the latest speed of the links against their baselines, read from the flushed
+    per-link statistics (see tsm_link_stats) without scanning the traffic speed records
+    :param link_list: list of link ids, all the links by default
+    :param min_count: min number of speeds of a baseline
+    :return: dict of link id: {'speed', 'capture_date_1970', 'zscore', 'mean', 'ewma'}, zscore is None without a baseline
+    """
+
+    client = MongoClient("127.0.0.1", 27017)
+    db = client["traffic"]
+    query = {} if link_list is None else {"link_id": {"$in": list(link_list)}}
+    link_stats_list = list(db[LINK_STATS_COLLECTION].find(query, {"_id": 0}))
+    client.close()
+
+    zscores = {}
+    for stats in link_stats_list:
+        if stats["count"] == 0:
+            continue
+        zscores[stats["link_id"]] = {
+            "speed": stats["last_speed"], "capture_date_1970": stats["last_capture_1970"],
+            "zscore": zscore_from_stats(stats, stats["last_speed"], hour_of_week(stats["last_capture_1970"]),
+                                        min_count),
+            "mean": stats["mean"], "ewma": stats["ewma"]}
+    return zscores
+
+
+def query_congestion_index_from_mongodb(start_time_second, end_time_second, region=None, road_type=None):
+    """
+    Congestion time series of a region and road type from the materialized index (see tsm_congestion)
+    :param start_time_second: start of the time range (included), seconds since the epoch
+    :param end_time_second: end of the time range (excluded), seconds since the epoch
+    :param region: 'HK', 'K', 'TM' or 'ST', all the regions by default
+    :param road_type: e.g. 'MAJOR ROUTE', all the road types by default
+    :return: list of {'snapshot_time', 'links', 'mean_speed', 'saturation_share': [bad, average, good]}
+    """
+
+    client = MongoClient("127.0.0.1", 27017)
+    db = client["traffic"]
+    query = {"snapshot_time": {"$gte": start_time_second, "$lt": end_time_second}}
+    if region is not None:
+        query["region"] = region
+    if road_type is not None:
+        query["road_type"] = road_type
+    documents = list(db[CONGESTION_COLLECTION].find(query, {"_id": 0}))
+    client.close()
+    return merge_congestion_documents(documents)
+
+
 def save_link_info_json(json_dict):
     """
     Create a folder and output a JSON file of nearby traffic information
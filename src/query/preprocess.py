@@ -1,11 +1,12 @@
 import csv
-from urllib.error import HTTPError, URLError
-import urllib.request
-import json
+import io
+import struct
 from pymongo import MongoClient
 import psycopg2
 from psycopg2 import extras
 
+from src.lib.geoProjector import hk1980_to_wgs84
+
 
 def get_tsm_link_node_info(csv_path):
     """
@@ -26,7 +27,8 @@ def get_tsm_link_node_info(csv_path):
 
     link_records = []
     node_records = []
-    node_id_list = []
+    # Nodes shared by several links are converted once
+    node_id_set = set()
     for link_dict in link_dict_list:
         start_id = link_dict['Start Node']
         end_id = link_dict['End Node']
@@ -35,45 +37,29 @@ def get_tsm_link_node_info(csv_path):
                        'road_type': link_dict['Road Type'], 'start_id': start_id, 'end_id': end_id}
         link_records.append(link_record)
 
-        if start_id not in node_id_list:
-            node_id_list.append(start_id)
-            coordinates = convert_coordinates(link_dict['Start Node Eastings'], link_dict['Start Node Northings'])
-            node_record = {'node_id': start_id, 'lat': coordinates['wgsLat'], 'long': coordinates['wgsLong']}
-            print('Converted start_id: ' + start_id + '. Lat: ' + str(coordinates['wgsLat'])
-                  + ', Long: ' + str(coordinates['wgsLong']))
-            node_records.append(node_record)
-
-        if end_id not in node_id_list:
-            node_id_list.append(end_id)
-            coordinates = convert_coordinates(link_dict['End Node Eastings'], link_dict['End Node Northings'])
-            node_record = {'node_id': end_id, 'lat': coordinates['wgsLat'], 'long': coordinates['wgsLong']}
-            print('Converted end_id: ' + end_id + '. Lat: ' + str(coordinates['wgsLat'])
-                  + ', Long: ' + str(coordinates['wgsLong']))
-            node_records.append(node_record)
+        for node_id, eastings, northings in ((start_id, link_dict['Start Node Eastings'],
+                                              link_dict['Start Node Northings']),
+                                             (end_id, link_dict['End Node Eastings'],
+                                              link_dict['End Node Northings'])):
+            if node_id in node_id_set:
+                continue
+            node_id_set.add(node_id)
+            coordinates = convert_coordinates(eastings, northings)
+            node_records.append({'node_id': node_id, 'lat': coordinates['wgsLat'], 'long': coordinates['wgsLong']})
+    print('Converted ' + str(len(node_records)) + ' nodes of ' + str(len(link_records)) + ' links')
 
     return link_records, node_records
 
 
 def convert_coordinates(eastings, northings):
     """
-    Convert HK 1980 Grid Coordinate to WGS 84 with Decimal Degree unit
+    Convert the HK 1980 Grid Coordinate of a node to WGS84 locally (see lib/geoProjector)
     :param eastings: eastings of a node in HK 1980 Grid Coordinate
     :param northings: northings of a node in HK 1980 Grid Coordinate
-    :return: a list contain ['wgsLat'] and ['wgsLong']
+    :return: a dict contain ['wgsLat'] and ['wgsLong']
     """
-
-    transform_path = 'http://www.geodetic.gov.hk/transform/v2/?inSys=hkgrid&outSys=wgsgeog&outUnit=decDeg' \
-                     '&e=' + eastings + '&n=' + northings
-    try:
-        response = urllib.request.urlopen(transform_path)
-    except HTTPError as e:
-        data = str(e.code)
-        print('HTTPError = ' + data)
-    except URLError as e:
-        data = str(e.reason)
-        print('URLError = ' + data)
-    else:
-        return json.loads(response.read())
+    lat, lon = hk1980_to_wgs84(float(northings), float(eastings))
+    return {'wgsLat': lat, 'wgsLong': lon}
 
 
 def store_tsm_link_node_info(link_records, node_records):
@@ -104,37 +90,54 @@ def get_mongodb_osm_links():
     return osm_links
 
 
-def process_osm_links(osm_links):
+def iter_mongodb_osm_links():
     """
-    Process and organize the osm link result from MongoDB
-    :param osm_links: a list of osm links queried from MongoDB
-    :return: a list of processed dicts with link information
+    Stream the osm links from MongoDB instead of loading them all
+    :return: a generator of osm link documents
+    """
+
+    client = MongoClient('127.0.0.1', 27018)
+    db = client['local']
+    try:
+        for link in db['osm_links'].find({}, {'_id': 0, 'id': 1, 'path': 1}):
+            yield link
+    finally:
+        client.close()
+
+
+def iter_osm_link_edges(osm_links):
+    """
+    Split the osm links into the edges between consecutive path nodes
+    :param osm_links: an iterable of osm links
+    :return: a generator of dicts with edge information
     """
 
-    link_dict_list = []
     for link in osm_links:
-        # print(link['path'])
         parent_id = link['id']
         # Build edges
         for nid in range(len(link['path']) - 1):
             start_node = link['path'][nid]
             end_node = link['path'][nid + 1]
             link_id = start_node['id'] + "-" + end_node['id']
-            # print(link_id)
             start_node_long = str(start_node['coordinates'][0])
             start_node_lat = str(start_node['coordinates'][1])
             end_node_long = str(end_node['coordinates'][0])
             end_node_lat = str(end_node['coordinates'][1])
             line_string = 'LINESTRING(' + start_node_long + ' ' + start_node_lat + ', ' \
                           + end_node_long + ' ' + end_node_lat + ')'
-            # print(line_string)
-            dict = {'link_id': link_id, 'parent_id': parent_id,
-                    'start_long': start_node_long, 'start_lat': start_node_lat,
-                    'end_long': end_node_long, 'end_lat': end_node_lat, 'line_string': line_string}
-            link_dict_list.append(dict)
-            print(dict)
+            yield {'link_id': link_id, 'parent_id': parent_id,
+                   'start_long': start_node_long, 'start_lat': start_node_lat,
+                   'end_long': end_node_long, 'end_lat': end_node_lat, 'line_string': line_string}
 
-    return tuple(link_dict_list)
+
+def process_osm_links(osm_links):
+    """
+    Process and organize the osm link result from MongoDB
+    :param osm_links: a list of osm links queried from MongoDB
+    :return: a list of processed dicts with link information
+    """
+
+    return tuple(iter_osm_link_edges(osm_links))
 
 
 def create_hk_osm_link_postgis_database(link_dicts):
@@ -181,12 +184,127 @@ def create_hk_osm_link_postgis_database(link_dicts):
                 postgresql_connection.close()
 
 
+def linestring_ewkb_hex(start_long, start_lat, end_long, end_lat, srid=4326):
+    """
+    Hex EWKB of a two-point LINESTRING, the text form of a geometry that PostGIS reads without parsing WKT
+    :return: hex string, e.g. '0102000020E6100000...'
+    """
+
+    # Little endian, LINESTRING type with the SRID flag, SRID, number of points, points
+    return struct.pack('<BIIIdddd', 1, 0x20000002, srid, 2, float(start_long), float(start_lat),
+                       float(end_long), float(end_lat)).hex().upper()
+
+
+def copy_text_field(value):
+    """
+    Escape a value for the text format of COPY
+    """
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def iter_osm_link_copy_rows(osm_links):
+    """
+    :param osm_links: an iterable of osm links
+    :return: a generator of the COPY text rows of the hk_osm_link edges
+    """
+
+    for edge in iter_osm_link_edges(osm_links):
+        fields = (edge['link_id'], edge['parent_id'], edge['start_long'], edge['start_lat'],
+                  edge['end_long'], edge['end_lat'])
+        yield '\t'.join(copy_text_field(field) for field in fields) + '\t' + \
+            linestring_ewkb_hex(edge['start_long'], edge['start_lat'], edge['end_long'], edge['end_lat']) + '\n'
+
+
+def copy_rows_in_chunks(cursor, table, rows, chunk_size=50000):
+    """
+    Write text rows into a table with one COPY FROM STDIN per chunk
+    :param cursor: a psycopg2 cursor
+    :param table: name of the table
+    :param rows: an iterable of COPY text rows
+    :param chunk_size: number of rows of each COPY
+    :return: number of copied rows
+    """
+
+    copy_sql = 'COPY ' + table + ' (link_id, parent_id, start_long, start_lat, end_long, end_lat, link) FROM STDIN'
+    row_count = 0
+    buffer = io.StringIO()
+    buffered = 0
+    for row in rows:
+        buffer.write(row)
+        buffered += 1
+        if buffered >= chunk_size:
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            row_count += buffered
+            buffer = io.StringIO()
+            buffered = 0
+    if buffered:
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+        row_count += buffered
+    return row_count
+
+
+def load_hk_osm_link_postgis_database(osm_links, chunk_size=50000, table='hk_osm_link'):
+    """
+    Reload the hk_osm_link PostGIS table with COPY through a staging table.
+    The staging table is loaded and indexed in its own transaction while readers keep using hk_osm_link,
+    then a second short transaction replaces hk_osm_link by the staging table.
+    :param osm_links: an iterable of osm links, e.g. iter_mongodb_osm_links()
+    :param chunk_size: number of rows of each COPY
+    :param table: name of the reloaded table, its staging table and indexes are named after it
+    :return: number of loaded rows, None on error
+    """
+
+    try:
+        postgresql_connection = psycopg2.connect(dbname='gis', host='127.0.0.1', port='5432',
+                                                 user='postgres', password='manage')
+    except psycopg2.OperationalError as error:
+        print('OperationalError: ' + str(error))
+        return None
+
+    cursor = postgresql_connection.cursor()
+    create_staging_sql = """
+    DROP TABLE IF EXISTS {table}_staging;
+    CREATE TABLE {table}_staging (link_id text, parent_id text,
+    start_long text, start_lat text, end_long text, end_lat text, link GEOMETRY(LINESTRING, 4326));
+    """.format(table=table)
+
+    create_index_sql = """
+    CREATE INDEX {table}_staging_index ON {table}_staging USING GIST (link);
+    ANALYZE {table}_staging;
+    """.format(table=table)
+
+    swap_sql = """
+    DROP TABLE IF EXISTS {table};
+    ALTER TABLE {table}_staging RENAME TO {table};
+    ALTER INDEX {table}_staging_index RENAME TO {table}_index;
+    """.format(table=table)
+    row_count = None
+    try:
+        cursor.execute(create_staging_sql)
+        row_count = copy_rows_in_chunks(cursor, table + '_staging', iter_osm_link_copy_rows(osm_links),
+                                        chunk_size)
+        cursor.execute(create_index_sql)    # The index is built once after the load
+        postgresql_connection.commit()
+        cursor.execute(swap_sql)    # The table is locked only during the swap
+        postgresql_connection.commit()
+        print('Loaded ' + str(row_count) + ' osm link edges')
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        postgresql_connection.rollback()
+        row_count = None
+    finally:
+        cursor.close()
+        postgresql_connection.close()
+    return row_count
+
+
 if __name__ == '__main__':
     # Store TSM node and link info into MongoDB
     # link_records, node_records = get_tsm_link_node_info('../../tsm_link_and_node_info_v2.csv')
     # store_tsm_link_node_info(link_records, node_records)
 
     # Store OSM links from TSM links into PostGis
-    osm_links = get_mongodb_osm_links()
-    link_dicts = process_osm_links(osm_links)
-    create_hk_osm_link_postgis_database(link_dicts)
+    load_hk_osm_link_postgis_database(iter_mongodb_osm_links())
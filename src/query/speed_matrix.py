@@ -0,0 +1,148 @@
+"""
+Link x time speed matrix of the TSM data.
+The records of a time range are read with one projected scan in capture order
+and resampled onto a regular time grid with numpy, instead of one query per link.
+Example:
+    matrix, link_ids, grid_times = query_speed_matrix(1525104000, 1525190400, step_seconds=300, fill='ffill')
+    matrix[i, j] is the speed of link_ids[i] at grid_times[j]
+"""
+import numpy as np
+from pymongo import MongoClient, ASCENDING
+
+from src.tsm_fetcher.tsm_storage import TRAFFIC_SPEED_BUCKET_COLLECTION
+from src.tsm_fetcher.tsm_schema import TRAFFIC_SPEED_COLLECTION
+from src.tsm_fetcher.tsm_rollup import choose_resolution, find_rollup_records
+
+FILL_METHODS = ('nan', 'ffill')
+
+
+def create_capture_index(db):
+    """
+    Indexes of the capture-ordered scans of both layouts
+    :param db: the 'traffic' database
+    """
+    db[TRAFFIC_SPEED_COLLECTION].create_index([('capture_date_1970', ASCENDING)])
+    db[TRAFFIC_SPEED_BUCKET_COLLECTION].create_index([('bucket_start', ASCENDING)])
+
+
+def scan_document_records(db, start_time_second, end_time_second):
+    """
+    :return: a generator of (link_id, capture_date_1970, traffic_speed) in capture order
+    """
+    cursor = db[TRAFFIC_SPEED_COLLECTION] \
+        .find({'capture_date_1970': {'$gte': start_time_second, '$lt': end_time_second}},
+              {'_id': 0, 'link_id': 1, 'capture_date_1970': 1, 'traffic_speed': 1}) \
+        .sort([('capture_date_1970', ASCENDING)])
+    for record in cursor:
+        yield record['link_id'], record['capture_date_1970'], record['traffic_speed']
+
+
+def scan_bucket_records(db, start_time_second, end_time_second):
+    """
+    :return: a generator of (link_id, capture_date_1970, traffic_speed), in capture order within each bucket
+    """
+    cursor = db[TRAFFIC_SPEED_BUCKET_COLLECTION] \
+        .find({'bucket_start': {'$gt': start_time_second - 3600, '$lt': end_time_second}},
+              {'_id': 0, 'link_id': 1, 'capture_date_1970': 1, 'traffic_speed': 1}) \
+        .sort([('bucket_start', ASCENDING)])
+    for bucket in cursor:
+        for capture, speed in zip(bucket['capture_date_1970'], bucket['traffic_speed']):
+            if start_time_second <= capture < end_time_second:
+                yield bucket['link_id'], capture, speed
+
+
+def scan_rollup_records(db, resolution, start_time_second, end_time_second):
+    """
+    :return: a generator of (link_id, period_start, mean speed) of the rollup documents in period order
+    """
+    for document in find_rollup_records(db, resolution, start_time_second, end_time_second):
+        yield document['link_id'], document['period_start'], document['mean']
+
+
+def resample_to_grid(link_index, captures, speeds, n_links, start_time_second, step_seconds, n_times, fill='nan'):
+    """
+    Resample observations onto a regular time grid.
+    A cell of grid time t is the mean speed of the link captured in [t, t + step).
+    Observations before the start time (any column < 0) seed the forward fill and are dropped otherwise.
+    :param link_index: numpy int array, row of each observation
+    :param captures: numpy array of capture times in seconds since the epoch
+    :param speeds: numpy float array
+    :param n_links: number of rows
+    :param start_time_second: first grid time
+    :param step_seconds: grid step
+    :param n_times: number of grid times
+    :param fill: 'nan' to leave the empty cells as NaN, 'ffill' to carry the last speed of the link forward
+    :return: float matrix of shape (n_links, n_times)
+    """
+    assert fill in FILL_METHODS
+    # Column 0 is the seed column of the observations before the start time
+    columns = np.floor_divide(captures - start_time_second, step_seconds).astype(np.int64) + 1
+    columns = np.clip(columns, 0, None)
+    keep = columns <= n_times
+    keys = link_index[keep] * (n_times + 1) + columns[keep]
+    size = n_links * (n_times + 1)
+    sums = np.bincount(keys, weights=speeds[keep], minlength=size)
+    counts = np.bincount(keys, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = (sums / counts).reshape(n_links, n_times + 1)
+
+    if fill == 'ffill' and matrix.size:
+        # Index of the last valid column of each cell, carried forward along the rows
+        valid_columns = np.where(np.isnan(matrix), 0, np.arange(n_times + 1))
+        np.maximum.accumulate(valid_columns, axis=1, out=valid_columns)
+        matrix = matrix[np.arange(n_links)[:, None], valid_columns]
+    return matrix[:, 1:]
+
+
+def query_speed_matrix(start_time_second, end_time_second, step_seconds=300, link_list=None, fill='nan',
+                       lookback_seconds=600, storage_layout='document', resolution=None):
+    """
+    Query the speeds of the links over a time window as a dense matrix
+    :param start_time_second: start of the window (included), seconds since the epoch
+    :param end_time_second: end of the window (excluded), seconds since the epoch
+    :param step_seconds: step of the time grid
+    :param link_list: list of link ids of the rows, the links with data in the window (sorted) by default
+    :param fill: 'nan' or 'ffill', see resample_to_grid()
+    :param lookback_seconds: with 'ffill', speeds captured this long before the start seed the first cells
+    :param storage_layout: 'document' or 'bucket'
+    :param resolution: 0 for the raw records or a rollup resolution in seconds (see tsm_rollup), chosen by the
+                       time range by default, not coarser than step_seconds while the raw records are kept,
+                       the bucket layout always reads the raw records
+    :return: (matrix of shape (number of links, number of grid times), numpy array of link ids,
+              numpy int64 array of grid times)
+    """
+    assert storage_layout in ('document', 'bucket')
+    grid_times = np.arange(start_time_second, end_time_second, step_seconds, dtype=np.int64)
+    scan_start = start_time_second - lookback_seconds if fill == 'ffill' else start_time_second
+
+    client = MongoClient('127.0.0.1', 27017)
+    db = client['traffic']
+    if resolution is None:
+        resolution = choose_resolution(start_time_second, end_time_second, max_resolution=step_seconds)
+    if storage_layout == 'bucket':
+        observations = list(scan_bucket_records(db, scan_start, end_time_second))
+    elif resolution:
+        observations = list(scan_rollup_records(db, resolution, scan_start, end_time_second))
+    else:
+        observations = list(scan_document_records(db, scan_start, end_time_second))
+    client.close()
+
+    if len(observations):
+        link_array, captures, speeds = zip(*observations)
+    else:
+        link_array, captures, speeds = (), (), ()
+    captures = np.array(captures, dtype=np.int64)
+    speeds = np.array(speeds, dtype=np.float64)
+
+    if link_list is None:
+        link_ids, link_index = np.unique(np.array(link_array, dtype=object).astype(str), return_inverse=True)
+    else:
+        link_ids = np.array(link_list)
+        row_of_link = dict((link_id, i) for i, link_id in enumerate(link_list))
+        link_index = np.array([row_of_link.get(link_id, -1) for link_id in link_array], dtype=np.int64)
+        known = link_index >= 0
+        link_index, captures, speeds = link_index[known], captures[known], speeds[known]
+
+    matrix = resample_to_grid(link_index.astype(np.int64), captures, speeds, len(link_ids), start_time_second,
+                              step_seconds, len(grid_times), fill)
+    return matrix, link_ids, grid_times
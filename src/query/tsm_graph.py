@@ -0,0 +1,293 @@
+"""
+Directed road network graph of the TSM links and nodes, in compressed sparse row (CSR) arrays.
+Nodes are numbered 0..n-1, the out-edges of node i are the edges indptr[i]:indptr[i + 1],
+edge e goes from edge_source[e] to edge_target[e] and is the link link_ids[e].
+The graph is built from tsm_link_and_node_info_v2.csv and cached as a .npz file next to it,
+the cache is rebuilt when the csv is newer.
+Example:
+    graph = load_tsm_graph()
+    for e in graph.out_edges(graph.node_index['722']):
+        print(graph.link_ids[e], graph.link_length[e])
+"""
+import csv
+import os
+
+import numpy as np
+
+from src.lib.geoProjector import hk1980_to_wgs84
+from src.tsm_fetcher.tsm_link_cache import LINK_INFO_CSV_PATH
+
+# Road type of the transfer edges added by connect_graph()
+TRANSFER_ROAD_TYPE = 'TRANSFER'
+# Meters, nodes closer than this are joined by transfer edges
+TRANSFER_RADIUS = 300
+# A transfer edge is this many times longer than the straight distance of its nodes
+TRANSFER_DETOUR_FACTOR = 1.3
+
+GRAPH_ARRAYS = ('node_ids', 'node_east', 'node_north', 'node_lat', 'node_lon', 'indptr', 'edge_source',
+                'edge_target', 'link_ids', 'link_length', 'link_region', 'link_road_type')
+
+
+def graph_cache_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '_graph.npz'
+
+
+class TSMGraph:
+
+    def __init__(self, arrays):
+        """
+        :param arrays: dict of the GRAPH_ARRAYS
+        """
+        for name in GRAPH_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.node_index = dict((node_id, i) for i, node_id in enumerate(self.node_ids.tolist()))
+        self.link_index = dict((link_id, e) for e, link_id in enumerate(self.link_ids.tolist()))
+        self.reverse_indptr = None
+        self.reverse_edges = None
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @property
+    def edge_count(self):
+        return len(self.link_ids)
+
+    @classmethod
+    def from_csv(cls, csv_path=LINK_INFO_CSV_PATH):
+        """
+        Build the graph from the link and node csv, the link length is the HK1980 distance of its end nodes
+        :param csv_path: path of tsm_link_and_node_info_v2.csv
+        :return: a TSMGraph
+        """
+        node_index = {}
+        node_positions = []
+        links = []
+        with open(csv_path, newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                ends = []
+                for prefix in ('Start Node', 'End Node'):
+                    node_id = row[prefix]
+                    if node_id not in node_index:
+                        node_index[node_id] = len(node_positions)
+                        node_positions.append((float(row[prefix + ' Eastings']), float(row[prefix + ' Northings'])))
+                    ends.append(node_index[node_id])
+                links.append((ends[0], ends[1], row['Link ID'], row['Region'], row['Road Type']))
+
+        # Sort the edges by source node for the CSR layout
+        links.sort(key=lambda link: link[0])
+        node_positions = np.array(node_positions, dtype=np.float64).reshape(-1, 2)
+        edge_source = np.array([link[0] for link in links], dtype=np.int32)
+        edge_target = np.array([link[1] for link in links], dtype=np.int32)
+        indptr = np.zeros(len(node_index) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(edge_source, minlength=len(node_index)), out=indptr[1:])
+        wgs84_positions = [hk1980_to_wgs84(north, east) for east, north in node_positions]
+
+        return cls({
+            'node_ids': np.array(list(node_index), dtype=str),
+            'node_east': node_positions[:, 0],
+            'node_north': node_positions[:, 1],
+            'node_lat': np.array([p[0] for p in wgs84_positions], dtype=np.float64),
+            'node_lon': np.array([p[1] for p in wgs84_positions], dtype=np.float64),
+            'indptr': indptr,
+            'edge_source': edge_source,
+            'edge_target': edge_target,
+            'link_ids': np.array([link[2] for link in links], dtype=str),
+            'link_length': np.hypot(node_positions[edge_target, 0] - node_positions[edge_source, 0],
+                                    node_positions[edge_target, 1] - node_positions[edge_source, 1]),
+            'link_region': np.array([link[3] for link in links], dtype=str),
+            'link_road_type': np.array([link[4] for link in links], dtype=str),
+        })
+
+    def save(self, npz_path):
+        np.savez_compressed(npz_path, **dict((name, getattr(self, name)) for name in GRAPH_ARRAYS))
+
+    @classmethod
+    def load(cls, npz_path):
+        with np.load(npz_path) as npz:
+            return cls(dict((name, npz[name]) for name in GRAPH_ARRAYS))
+
+    def out_edges(self, node):
+        """
+        :param node: node index
+        :return: range of the edge indexes leaving the node
+        """
+        return range(self.indptr[node], self.indptr[node + 1])
+
+    def successors(self, node):
+        """
+        :param node: node index
+        :return: numpy array of the node indexes reachable by one edge
+        """
+        return self.edge_target[self.indptr[node]:self.indptr[node + 1]]
+
+    def build_reverse(self):
+        """
+        CSR arrays of the in-edges, built on first use:
+        the in-edges of node i are reverse_edges[reverse_indptr[i]:reverse_indptr[i + 1]]
+        """
+        if self.reverse_indptr is None:
+            self.reverse_edges = np.argsort(self.edge_target, kind='stable').astype(np.int32)
+            reverse_indptr = np.zeros(self.node_count + 1, dtype=np.int32)
+            np.cumsum(np.bincount(self.edge_target, minlength=self.node_count), out=reverse_indptr[1:])
+            self.reverse_indptr = reverse_indptr
+        return self.reverse_indptr, self.reverse_edges
+
+    def in_edges(self, node):
+        """
+        :param node: node index
+        :return: numpy array of the edge indexes entering the node
+        """
+        reverse_indptr, reverse_edges = self.build_reverse()
+        return reverse_edges[reverse_indptr[node]:reverse_indptr[node + 1]]
+
+    def with_edges(self, edges):
+        """
+        A new graph with extra edges on the same nodes
+        :param edges: list of (source node index, target node index, link id, length, region, road type)
+        :return: a TSMGraph
+        """
+        all_edges = list(zip(self.edge_source.tolist(), self.edge_target.tolist(), self.link_ids.tolist(),
+                             self.link_length.tolist(), self.link_region.tolist(), self.link_road_type.tolist()))
+        all_edges.extend(edges)
+        all_edges.sort(key=lambda edge: edge[0])
+        edge_source = np.array([edge[0] for edge in all_edges], dtype=np.int32)
+        indptr = np.zeros(self.node_count + 1, dtype=np.int32)
+        np.cumsum(np.bincount(edge_source, minlength=self.node_count), out=indptr[1:])
+        arrays = dict((name, getattr(self, name)) for name in ('node_ids', 'node_east', 'node_north', 'node_lat',
+                                                               'node_lon'))
+        arrays.update({
+            'indptr': indptr,
+            'edge_source': edge_source,
+            'edge_target': np.array([edge[1] for edge in all_edges], dtype=np.int32),
+            'link_ids': np.array([edge[2] for edge in all_edges], dtype=str),
+            'link_length': np.array([edge[3] for edge in all_edges], dtype=np.float64),
+            'link_region': np.array([edge[4] for edge in all_edges], dtype=str),
+            'link_road_type': np.array([edge[5] for edge in all_edges], dtype=str),
+        })
+        return TSMGraph(arrays)
+
+    def strongly_connected_components(self):
+        """
+        Kosaraju's algorithm with explicit stacks
+        :return: numpy int array of the component label of each node
+        """
+        indptr = self.indptr.tolist()
+        edge_target = self.edge_target.tolist()
+        reverse_indptr, reverse_edges = self.build_reverse()
+        reverse_indptr = reverse_indptr.tolist()
+        edge_source = self.edge_source.tolist()
+        reverse_sources = [edge_source[e] for e in reverse_edges.tolist()]
+
+        # Nodes in order of finishing time of a depth-first search
+        order = []
+        visited = [False] * self.node_count
+        for root in range(self.node_count):
+            if visited[root]:
+                continue
+            visited[root] = True
+            stack = [(root, indptr[root])]
+            while stack:
+                node, edge = stack[-1]
+                if edge < indptr[node + 1]:
+                    stack[-1] = (node, edge + 1)
+                    next_node = edge_target[edge]
+                    if not visited[next_node]:
+                        visited[next_node] = True
+                        stack.append((next_node, indptr[next_node]))
+                else:
+                    stack.pop()
+                    order.append(node)
+
+        # Components of the reversed graph in reverse finishing order
+        labels = [-1] * self.node_count
+        label = 0
+        for root in reversed(order):
+            if labels[root] >= 0:
+                continue
+            labels[root] = label
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                for i in range(reverse_indptr[node], reverse_indptr[node + 1]):
+                    next_node = reverse_sources[i]
+                    if labels[next_node] < 0:
+                        labels[next_node] = label
+                        stack.append(next_node)
+            label += 1
+        return np.array(labels, dtype=np.int64)
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def in_degree(self):
+        return np.bincount(self.edge_target, minlength=self.node_count)
+
+
+def transfer_edge(graph, a, b, distance, detour_factor):
+    return (a, b, 'transfer:' + str(graph.node_ids[a]) + '-' + str(graph.node_ids[b]), distance * detour_factor,
+            '', TRANSFER_ROAD_TYPE)
+
+
+def connect_graph(graph, radius=TRANSFER_RADIUS, detour_factor=TRANSFER_DETOUR_FACTOR):
+    """
+    Connect the graph with transfer edges, the TSM links are monitored corridors that do not form a network.
+    Nodes within the radius are joined both ways, then each strongly connected component is joined both ways
+    to its nearest other component until every node reaches every other.
+    A transfer edge stands for the unmonitored roads between its nodes, its length is the straight distance
+    times detour_factor and its road type is TRANSFER_ROAD_TYPE.
+    :param graph: a TSMGraph
+    :param radius: distance in meters under which nodes are joined
+    :param detour_factor: ratio of the transfer edge length to the straight distance
+    :return: a new TSMGraph
+    """
+    positions = np.column_stack([graph.node_east, graph.node_north])
+    distances = np.hypot(positions[:, None, 0] - positions[None, :, 0], positions[:, None, 1] - positions[None, :, 1])
+    np.fill_diagonal(distances, np.inf)
+    linked = set(zip(graph.edge_source.tolist(), graph.edge_target.tolist()))
+
+    edges = []
+    sources, targets = np.nonzero(distances <= radius)
+    for a, b in zip(sources.tolist(), targets.tolist()):
+        if (a, b) not in linked:
+            edges.append(transfer_edge(graph, a, b, distances[a, b], detour_factor))
+            linked.add((a, b))
+    graph = graph.with_edges(edges)
+
+    # Join each component to its nearest other component, the number of components at least halves each round
+    labels = graph.strongly_connected_components()
+    while labels.max() > 0:
+        edges = []
+        other = labels[:, None] != labels[None, :]
+        between = np.where(other, distances, np.inf)
+        nearest = between.argmin(axis=1)
+        for label in range(labels.max() + 1):
+            members = np.nonzero(labels == label)[0]
+            a = members[between[members, nearest[members]].argmin()]
+            b = nearest[a]
+            for source, target in ((a, b), (b, a)):
+                if (source, target) not in linked:
+                    edges.append(transfer_edge(graph, source, target, distances[source, target], detour_factor))
+                    linked.add((source, target))
+        graph = graph.with_edges(edges)
+        labels = graph.strongly_connected_components()
+    return graph
+
+
+def load_tsm_graph(csv_path=LINK_INFO_CSV_PATH, cache_path=None):
+    """
+    Load the graph from its .npz cache, the cache is (re)built when missing or older than the csv
+    :param csv_path: path of tsm_link_and_node_info_v2.csv
+    :param cache_path: path of the .npz cache, next to the csv by default
+    :return: a TSMGraph
+    """
+    if cache_path is None:
+        cache_path = graph_cache_path(csv_path)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        return TSMGraph.load(cache_path)
+    graph = TSMGraph.from_csv(csv_path)
+    try:
+        graph.save(cache_path)
+    except IOError as err:
+        print('Graph cache error: ' + str(err))
+    return graph
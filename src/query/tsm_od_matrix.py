@@ -0,0 +1,185 @@
+"""
+Origin-destination travel-time matrices between the zones of the TSM network, computed once per snapshot.
+Two zone levels:
+  'region': HK / K / TM / ST, the region of a node is the most common region of its links
+  'zone':   square cells of zone_size meters (HK1980) within each region, e.g. 'K-166-163'
+The TSM links are monitored corridors that do not form a network (no link crosses two regions), so the routes
+run on the graph connected by transfer edges (see tsm_graph.connect_graph()). The centroid of a zone is its node
+nearest to the mean position of its nodes, and one Dijkstra per centroid gives all the cells of a snapshot.
+The latest matrices are kept in memory with their snapshot time, with a short history for trend charts:
+    od_matrix = get_od_matrix()
+    task_thread(od_matrix.refresh_if_new, 120, stop_time).start()
+    od_matrix.get_matrix('region')
+"""
+import collections
+import time
+
+import numpy as np
+
+from src.query.tsm_graph import load_tsm_graph, connect_graph, TRANSFER_ROAD_TYPE
+from src.query.tsm_routing import TSMRouter
+
+ZONE_LEVELS = ('region', 'zone')
+ZONE_SIZE = 5000
+HISTORY_LENGTH = 30
+
+
+def node_regions(graph):
+    """
+    :param graph: a TSMGraph
+    :return: list of the region of each node, the most common region of its in and out links
+    """
+    counters = [collections.Counter() for _ in range(graph.node_count)]
+    for source, target, region, road_type in zip(graph.edge_source.tolist(), graph.edge_target.tolist(),
+                                                 graph.link_region.tolist(), graph.link_road_type.tolist()):
+        if road_type == TRANSFER_ROAD_TYPE:
+            continue
+        counters[source][region] += 1
+        counters[target][region] += 1
+    return [counter.most_common(1)[0][0] if len(counter) else 'NULL' for counter in counters]
+
+
+def build_zones(graph, zone_size=ZONE_SIZE):
+    """
+    Zones of the nodes at every level
+    :param graph: a TSMGraph
+    :param zone_size: cell size of the 'zone' level in meters
+    :return: dict of level: {'zone_ids': list of zone ids, 'centroid_nodes': list of the centroid node index of
+             each zone, 'centroids': list of {'zone', 'node', 'lat', 'lon', 'nodes'}}
+    """
+    regions = node_regions(graph)
+    labels = {
+        'region': regions,
+        'zone': ['%s-%d-%d' % (region, east // zone_size, north // zone_size)
+                 for region, east, north in zip(regions, graph.node_east.tolist(), graph.node_north.tolist())],
+    }
+    zones = {}
+    for level in ZONE_LEVELS:
+        zone_ids = sorted(set(labels[level]))
+        zone_index = dict((zone_id, i) for i, zone_id in enumerate(zone_ids))
+        node_zone = np.array([zone_index[label] for label in labels[level]], dtype=np.int64)
+        counts = np.bincount(node_zone, minlength=len(zone_ids))
+        mean_east = np.bincount(node_zone, weights=graph.node_east, minlength=len(zone_ids)) / counts
+        mean_north = np.bincount(node_zone, weights=graph.node_north, minlength=len(zone_ids)) / counts
+        centroid_nodes = []
+        for i in range(len(zone_ids)):
+            members = np.nonzero(node_zone == i)[0]
+            distances = np.hypot(graph.node_east[members] - mean_east[i], graph.node_north[members] - mean_north[i])
+            centroid_nodes.append(int(members[distances.argmin()]))
+        zones[level] = {'zone_ids': zone_ids, 'centroid_nodes': centroid_nodes,
+                        'centroids': [{'zone': zone_id, 'node': str(graph.node_ids[node]),
+                                       'lat': float(graph.node_lat[node]), 'lon': float(graph.node_lon[node]),
+                                       'nodes': int(count)}
+                                      for zone_id, node, count in zip(zone_ids, centroid_nodes, counts)]}
+    return zones
+
+
+class ODMatrixJob:
+
+    def __init__(self, router=None, zone_size=ZONE_SIZE, history_length=HISTORY_LENGTH):
+        """
+        :param router: a TSMRouter holding the current speeds, a new one on the connected graph by default
+        :param zone_size: cell size of the 'zone' level in meters
+        :param history_length: number of snapshots kept for the trend charts
+        """
+        self.router = router if router is not None else TSMRouter(connect_graph(load_tsm_graph()))
+        self.zones = build_zones(self.router.graph, zone_size)
+        self.latest = None
+        self.history = collections.deque(maxlen=history_length)
+
+    def compute_centroid_seconds(self):
+        """
+        One Dijkstra from every centroid node with the current weights, stopped once all the centroids are settled
+        :return: dict of centroid node index: dict of centroid node index: travel seconds
+        """
+        centroid_nodes = set()
+        for zones in self.zones.values():
+            centroid_nodes.update(zones['centroid_nodes'])
+        centroid_seconds = {}
+        for source in centroid_nodes:
+            seconds, parent_edge = self.router.shortest_path_tree(source, centroid_nodes)
+            centroid_seconds[source] = seconds
+        return centroid_seconds
+
+    def refresh(self):
+        """
+        Compute the matrices of the current speeds of the router and replace the cached ones
+        :return: the new entry {'snapshot_time', 'computed_at', 'levels': {level: zone x zone matrix of seconds}}
+        """
+        centroid_seconds = self.compute_centroid_seconds()
+        levels = {}
+        for level, zones in self.zones.items():
+            nodes = zones['centroid_nodes']
+            levels[level] = np.array([[centroid_seconds[a].get(b, np.nan) for b in nodes] for a in nodes])
+        entry = {'snapshot_time': self.router.snapshot_time, 'computed_at': int(time.time()), 'levels': levels}
+        self.latest = entry
+        self.history.append(entry)
+        return entry
+
+    def on_ingest(self, records):
+        """
+        Ingest listener of TSMFetcher
+        :param records: stored records of a snapshot
+        """
+        self.router.on_ingest(records)
+        self.refresh()
+
+    def refresh_if_new(self, time_second=None, lookback_seconds=1800):
+        """
+        Load the latest speeds from traffic_speed_map, the matrices are recomputed only for a new snapshot
+        :param time_second: seconds since the epoch, now by default
+        :param lookback_seconds: see TSMRouter.load_speeds_from_mongodb()
+        :return: True if the matrices were recomputed
+        """
+        self.router.load_speeds_from_mongodb(time_second, lookback_seconds)
+        if self.latest is not None and self.latest['snapshot_time'] == self.router.snapshot_time:
+            return False
+        self.refresh()
+        return True
+
+    def get_matrix(self, level='region'):
+        """
+        :param level: 'region' or 'zone'
+        :return: {'snapshot_time', 'computed_at', 'zones': list of centroids, 'seconds': list of rows
+                  (None if not connected)}, None before the first run
+        """
+        assert level in ZONE_LEVELS
+        entry = self.latest
+        if entry is None:
+            return None
+        seconds = entry['levels'][level]
+        return {'snapshot_time': entry['snapshot_time'], 'computed_at': entry['computed_at'],
+                'zones': self.zones[level]['centroids'],
+                'seconds': [[None if np.isnan(value) else value for value in row] for row in seconds.tolist()]}
+
+    def get_history(self, source_zone, target_zone, level='region'):
+        """
+        Travel time of one zone pair over the kept snapshots
+        :param source_zone: zone id, e.g. 'HK'
+        :param target_zone: zone id
+        :param level: 'region' or 'zone'
+        :return: list of (snapshot_time, travel seconds or None) in snapshot order
+        """
+        assert level in ZONE_LEVELS
+        zone_ids = self.zones[level]['zone_ids']
+        if source_zone not in zone_ids or target_zone not in zone_ids:
+            return []
+        i, j = zone_ids.index(source_zone), zone_ids.index(target_zone)
+        series = []
+        for entry in list(self.history):
+            value = entry['levels'][level][i, j]
+            series.append((entry['snapshot_time'], None if np.isnan(value) else float(value)))
+        return series
+
+
+_od_matrix = None
+
+
+def get_od_matrix():
+    """
+    :return: the process-wide ODMatrixJob, created on first use
+    """
+    global _od_matrix
+    if _od_matrix is None:
+        _od_matrix = ODMatrixJob()
+    return _od_matrix
@@ -0,0 +1,245 @@
+"""
+Match the TSM links to OpenStreetMap paths without PostGIS.
+The drivable ways of osm_highway and their nodes of osm_node (geo_maps, see osm_parser.OSMParser) are loaded once
+into a directed graph in HK1980 meters with a grid index of the nodes. For each TSM link the start and end nodes
+are snapped to the nearest OSM nodes within snap_radius, and the shortest OSM path between the candidates is found
+by a Dijkstra bounded by a multiple of the straight distance.
+The result is written in the osm_links format read by preprocess.get_mongodb_osm_links():
+{'id': TSM link id, 'path': [{'id': OSM node id, 'coordinates': [lon, lat]}, ...]}
+  python -m src.query.tsm_osm_matcher
+"""
+import heapq
+import math
+
+from pymongo import MongoClient, ReplaceOne
+
+from src.lib.geoProjector import wgs84_to_hk1980
+from src.query.tsm_graph import load_tsm_graph
+
+OSM_DB = 'geo_maps'
+OSM_NODE_COLLECTION = 'osm_node'
+OSM_HIGHWAY_COLLECTION = 'osm_highway'
+OSM_LINKS_PORT = 27018
+OSM_LINKS_DB = 'local'
+OSM_LINKS_COLLECTION = 'osm_links'
+
+DRIVABLE_HIGHWAYS = ('motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link', 'secondary',
+                     'secondary_link', 'tertiary', 'tertiary_link', 'unclassified', 'residential', 'living_street',
+                     'road')
+# Meters
+SNAP_RADIUS = 60
+GRID_CELL_SIZE = 100
+# The searched path length is at most DETOUR_FACTOR times the straight distance plus DETOUR_SLACK meters
+DETOUR_FACTOR = 2.0
+DETOUR_SLACK = 300
+# Snap distances weigh more than path length, so the path does not start or end short of the TSM nodes
+SNAP_PENALTY = 4.0
+
+
+def way_directions(tag):
+    """
+    :param tag: tag dict of an OSM way
+    :return: (forward allowed, backward allowed)
+    """
+    oneway = tag.get('oneway')
+    if oneway in ('yes', 'true', '1'):
+        return True, False
+    if oneway == '-1':
+        return False, True
+    if oneway == 'no':
+        return True, True
+    if tag.get('highway') in ('motorway', 'motorway_link') or tag.get('junction') == 'roundabout':
+        return True, False
+    return True, True
+
+
+class OSMRoadGraph:
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        """
+        :param cell_size: cell size of the grid index in meters
+        """
+        self.cell_size = cell_size
+        self.node_index = {}
+        self.node_ids = []
+        self.node_east = []
+        self.node_north = []
+        self.node_lon_lat = []
+        # adjacency[i] is a list of (node index, length in meters)
+        self.adjacency = []
+        self.grid = {}
+
+    def add_node(self, node_id, lat, lon):
+        if node_id in self.node_index:
+            return self.node_index[node_id]
+        try:
+            north, east = wgs84_to_hk1980(lat, lon)
+        except AssertionError:
+            # Outside the range of the HK1980 grid
+            return None
+        i = self.node_index[node_id] = len(self.node_ids)
+        self.node_ids.append(node_id)
+        self.node_east.append(east)
+        self.node_north.append(north)
+        self.node_lon_lat.append([lon, lat])
+        self.adjacency.append([])
+        self.grid.setdefault((int(east // self.cell_size), int(north // self.cell_size)), []).append(i)
+        return i
+
+    def add_way(self, node_ids, tag):
+        """
+        Add the segments of a way between its known nodes
+        :param node_ids: OSM node ids of the way in order
+        :param tag: tag dict of the way
+        """
+        forward, backward = way_directions(tag)
+        nodes = [self.node_index.get(node_id) for node_id in node_ids]
+        for a, b in zip(nodes[:-1], nodes[1:]):
+            if a is None or b is None or a == b:
+                continue
+            length = math.hypot(self.node_east[a] - self.node_east[b], self.node_north[a] - self.node_north[b])
+            if forward:
+                self.adjacency[a].append((b, length))
+            if backward:
+                self.adjacency[b].append((a, length))
+
+    def nearest_nodes(self, east, north, radius=SNAP_RADIUS):
+        """
+        :param east: HK1980 easting
+        :param north: HK1980 northing
+        :param radius: search radius in meters
+        :return: dict of node index: distance of the nodes within the radius
+        """
+        cx, cy = int(east // self.cell_size), int(north // self.cell_size)
+        reach = int(math.ceil(radius / self.cell_size))
+        nodes = {}
+        for x in range(cx - reach, cx + reach + 1):
+            for y in range(cy - reach, cy + reach + 1):
+                for i in self.grid.get((x, y), ()):
+                    distance = math.hypot(self.node_east[i] - east, self.node_north[i] - north)
+                    if distance <= radius:
+                        nodes[i] = distance
+        return nodes
+
+    def bounded_path(self, sources, targets, max_length):
+        """
+        Shortest path from any source to any target, the penalized snap distances count in the length
+        :param sources: dict of node index: snap cost
+        :param targets: dict of node index: snap cost
+        :param max_length: paths longer than this are not searched
+        :return: list of node indexes, None if no path within max_length
+        """
+        adjacency = self.adjacency
+        lengths = dict(sources)
+        parent = {}
+        settled = set()
+        heap = [(length, node) for node, length in sources.items()]
+        heapq.heapify(heap)
+        best_length = max_length
+        best_node = None
+        while heap:
+            length, node = heapq.heappop(heap)
+            if length > best_length:
+                break
+            if node in settled:
+                continue
+            settled.add(node)
+            if node in targets and length + targets[node] <= best_length:
+                best_length = length + targets[node]
+                best_node = node
+            for next_node, edge_length in adjacency[node]:
+                next_length = length + edge_length
+                if next_length <= best_length and next_length < lengths.get(next_node, math.inf):
+                    lengths[next_node] = next_length
+                    parent[next_node] = node
+                    heapq.heappush(heap, (next_length, next_node))
+        if best_node is None:
+            return None
+        path = [best_node]
+        while path[-1] in parent:
+            path.append(parent[path[-1]])
+        path.reverse()
+        return path
+
+    def match(self, start_east, start_north, end_east, end_north, snap_radius=SNAP_RADIUS):
+        """
+        :return: list of node indexes of the OSM path between two points, None if not matched
+        """
+        sources = self.nearest_nodes(start_east, start_north, snap_radius)
+        targets = self.nearest_nodes(end_east, end_north, snap_radius)
+        if len(sources) == 0 or len(targets) == 0:
+            return None
+        straight = math.hypot(end_east - start_east, end_north - start_north)
+        return self.bounded_path(dict((i, d * SNAP_PENALTY) for i, d in sources.items()),
+                                 dict((i, d * SNAP_PENALTY) for i, d in targets.items()),
+                                 straight * DETOUR_FACTOR + DETOUR_SLACK + 2 * snap_radius * SNAP_PENALTY)
+
+
+def load_osm_road_graph(cell_size=GRID_CELL_SIZE, chunk_size=10000):
+    """
+    Load the drivable ways and their nodes from geo_maps
+    :param cell_size: cell size of the grid index in meters
+    :param chunk_size: number of node ids of each osm_node query
+    :return: an OSMRoadGraph
+    """
+    client = MongoClient('127.0.0.1', 27017)
+    db = client[OSM_DB]
+    ways = list(db[OSM_HIGHWAY_COLLECTION].find({'tag.highway': {'$in': list(DRIVABLE_HIGHWAYS)}},
+                                                {'_id': 0, 'nd': 1, 'tag': 1}))
+    node_ids = list(set(node_id for way in ways for node_id in way['nd']))
+    graph = OSMRoadGraph(cell_size)
+    for i in range(0, len(node_ids), chunk_size):
+        for node in db[OSM_NODE_COLLECTION].find({'id': {'$in': node_ids[i:i + chunk_size]}},
+                                                 {'_id': 0, 'id': 1, 'location': 1}):
+            graph.add_node(node['id'], node['location'][0], node['location'][1])
+    client.close()
+    for way in ways:
+        graph.add_way(way['nd'], way['tag'])
+    print('Loaded ' + str(len(graph.node_ids)) + ' nodes of ' + str(len(ways)) + ' OSM ways')
+    return graph
+
+
+def match_tsm_links(osm_graph, tsm_graph=None, snap_radius=SNAP_RADIUS):
+    """
+    Match every TSM link to an OSM path
+    :param osm_graph: an OSMRoadGraph
+    :param tsm_graph: a TSMGraph, loaded from the csv or its cache by default
+    :param snap_radius: snap radius of the TSM nodes in meters
+    :return: (list of osm_links documents, list of the unmatched link ids)
+    """
+    if tsm_graph is None:
+        tsm_graph = load_tsm_graph()
+    osm_links = []
+    unmatched = []
+    for link_id, source, target in zip(tsm_graph.link_ids.tolist(), tsm_graph.edge_source.tolist(),
+                                       tsm_graph.edge_target.tolist()):
+        path = osm_graph.match(tsm_graph.node_east[source], tsm_graph.node_north[source],
+                               tsm_graph.node_east[target], tsm_graph.node_north[target], snap_radius)
+        if path is None or len(path) < 2:
+            unmatched.append(link_id)
+            continue
+        osm_links.append({'id': link_id, 'path': [{'id': osm_graph.node_ids[i],
+                                                   'coordinates': osm_graph.node_lon_lat[i]} for i in path]})
+    print('Matched ' + str(len(osm_links)) + ' of ' + str(tsm_graph.edge_count) + ' TSM links')
+    return osm_links, unmatched
+
+
+def store_osm_links(osm_links):
+    """
+    Upsert the matched links into the osm_links collection read by preprocess.get_mongodb_osm_links()
+    :param osm_links: osm_links documents
+    """
+    if len(osm_links) == 0:
+        return
+    client = MongoClient('127.0.0.1', OSM_LINKS_PORT)
+    collection = client[OSM_LINKS_DB][OSM_LINKS_COLLECTION]
+    collection.create_index('id', unique=True)
+    collection.bulk_write([ReplaceOne({'id': link['id']}, link, upsert=True) for link in osm_links], ordered=False)
+    client.close()
+
+
+if __name__ == '__main__':
+    matched_links, unmatched_links = match_tsm_links(load_osm_road_graph())
+    store_osm_links(matched_links)
+    if len(unmatched_links):
+        print('Unmatched links: ' + ', '.join(unmatched_links))
@@ -0,0 +1,246 @@
+"""
+Fastest route between TSM nodes with the current traffic speeds.
+Edge weights are the travel seconds of the links (length / speed), kept in one array over the CSR graph
+(see tsm_graph) and refreshed in place when a new snapshot is stored, the graph is never rebuilt.
+Single routes use A* with the straight HK1980 distance at the top speed as the heuristic,
+batches of origin-destination pairs run one Dijkstra per distinct origin.
+Usage with the live poller:
+    router = TSMRouter()
+    tsm_fetcher.add_ingest_listener(router.on_ingest)
+    router.route('722', '50059')
+"""
+import heapq
+import math
+import time
+
+import numpy as np
+from pymongo import MongoClient, ASCENDING
+
+from src.query.tsm_graph import load_tsm_graph, connect_graph, TRANSFER_ROAD_TYPE
+from src.tsm_fetcher.tsm_schema import to_number, TRAFFIC_SPEED_COLLECTION
+
+# Speed of the links without a reported speed, km/h
+DEFAULT_SPEED = 50.0
+# Reported speeds are clamped to this range, km/h
+MIN_SPEED = 1.0
+MAX_SPEED = 120.0
+# Speed of the transfer edges of a connected graph (see tsm_graph.connect_graph()), km/h
+TRANSFER_SPEED = 30.0
+
+
+class TSMRouter:
+
+    def __init__(self, graph=None, default_speed=DEFAULT_SPEED, transfer_speed=TRANSFER_SPEED):
+        """
+        :param graph: a TSMGraph, by default the graph loaded from the csv or its cache and connected with
+                      transfer edges (see tsm_graph.connect_graph()), the TSM links alone rarely join two nodes
+        :param default_speed: speed of the links without a reported speed in km/h
+        :param transfer_speed: speed of the transfer edges in km/h, they have no reported speed
+        """
+        self.graph = graph if graph is not None else connect_graph(load_tsm_graph())
+        self.indptr = self.graph.indptr.tolist()
+        self.edge_source = self.graph.edge_source.tolist()
+        self.edge_target = self.graph.edge_target.tolist()
+        self.node_east = self.graph.node_east.tolist()
+        self.node_north = self.graph.node_north.tolist()
+        self.speeds = np.full(self.graph.edge_count, default_speed, dtype=np.float64)
+        self.speeds[self.graph.link_road_type == TRANSFER_ROAD_TYPE] = transfer_speed
+        self.weights = None
+        self.top_speed = None
+        self.snapshot_time = None
+        self.refresh_weights()
+
+    def refresh_weights(self):
+        """
+        Recompute the travel seconds of the edges from self.speeds
+        """
+        speeds = np.clip(self.speeds, MIN_SPEED, MAX_SPEED) / 3.6
+        # Swapped at once, a route being searched keeps the weights it started with
+        self.weights = (self.graph.link_length / speeds).tolist()
+        self.top_speed = float(speeds.max()) if len(speeds) else MAX_SPEED / 3.6
+
+    def update_speeds(self, link_speeds, snapshot_time=None):
+        """
+        Set the speeds of the links and refresh the edge weights in place
+        :param link_speeds: dict of link_id: speed in km/h, unknown links are ignored
+        :param snapshot_time: capture time of the speeds
+        :return: number of updated links
+        """
+        edges = []
+        speeds = []
+        for link_id, speed in link_speeds.items():
+            edge = self.graph.link_index.get(link_id)
+            if edge is not None:
+                edges.append(edge)
+                speeds.append(float(speed))
+        if len(edges):
+            self.speeds[edges] = speeds
+            self.refresh_weights()
+        if snapshot_time is not None:
+            self.snapshot_time = snapshot_time
+        return len(edges)
+
+    def on_ingest(self, records):
+        """
+        Ingest listener of TSMFetcher
+        :param records: stored records of a snapshot, of schema 1 or typed
+        """
+        if len(records) == 0:
+            return
+        self.update_speeds(dict((r['link_id'], to_number(r['traffic_speed'])) for r in records),
+                           int(max(float(r['capture_date_1970']) for r in records)))
+
+    def load_speeds_from_mongodb(self, time_second=None, lookback_seconds=1800):
+        """
+        Load the latest speed of every link captured within lookback_seconds before a time
+        :param time_second: seconds since the epoch, now by default
+        :param lookback_seconds: length of the scanned time range
+        :return: number of updated links
+        """
+        if time_second is None:
+            time_second = time.time()
+        client = MongoClient('127.0.0.1', 27017)
+        db = client['traffic']
+        link_speeds = {}
+        latest_capture = None
+        for record in db[TRAFFIC_SPEED_COLLECTION] \
+                .find({'capture_date_1970': {'$gte': time_second - lookback_seconds, '$lt': time_second}},
+                      {'_id': 0, 'link_id': 1, 'traffic_speed': 1, 'capture_date_1970': 1}) \
+                .sort([('capture_date_1970', ASCENDING)]):
+            link_speeds[record['link_id']] = record['traffic_speed']
+            latest_capture = record['capture_date_1970']
+        client.close()
+        return self.update_speeds(link_speeds, latest_capture)
+
+    def heuristic(self, node, target):
+        return math.hypot(self.node_east[node] - self.node_east[target],
+                          self.node_north[node] - self.node_north[target]) / self.top_speed
+
+    def shortest_path(self, source, target):
+        """
+        A* between two node indexes
+        :return: (travel seconds, list of edge indexes), None if the target is not reachable
+        """
+        weights = self.weights
+        indptr = self.indptr
+        edge_target = self.edge_target
+        seconds = {source: 0.0}
+        parent_edge = {}
+        settled = set()
+        heap = [(self.heuristic(source, target), 0.0, source)]
+        while heap:
+            estimate, cost, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if node == target:
+                return cost, self.trace_edges(parent_edge, source, target)
+            settled.add(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                next_node = edge_target[edge]
+                next_cost = cost + weights[edge]
+                if next_cost < seconds.get(next_node, math.inf):
+                    seconds[next_node] = next_cost
+                    parent_edge[next_node] = edge
+                    heapq.heappush(heap, (next_cost + self.heuristic(next_node, target), next_cost, next_node))
+        return None
+
+    def shortest_path_tree(self, source, targets=None):
+        """
+        Dijkstra from a node index, stops once all the targets are settled
+        :param source: node index
+        :param targets: set of node indexes, all the nodes by default
+        :return: (dict of node index: travel seconds, dict of node index: parent edge index)
+        """
+        weights = self.weights
+        indptr = self.indptr
+        edge_target = self.edge_target
+        seconds = {source: 0.0}
+        parent_edge = {}
+        settled = set()
+        remaining = set(targets) if targets is not None else None
+        heap = [(0.0, source)]
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            if remaining is not None:
+                remaining.discard(node)
+                if len(remaining) == 0:
+                    break
+            for edge in range(indptr[node], indptr[node + 1]):
+                next_node = edge_target[edge]
+                next_cost = cost + weights[edge]
+                if next_cost < seconds.get(next_node, math.inf):
+                    seconds[next_node] = next_cost
+                    parent_edge[next_node] = edge
+                    heapq.heappush(heap, (next_cost, next_node))
+        return dict((node, seconds[node]) for node in settled), parent_edge
+
+    def trace_edges(self, parent_edge, source, target):
+        """
+        :return: list of the edge indexes from the source to the target
+        """
+        edges = []
+        node = target
+        while node != source:
+            edge = parent_edge[node]
+            edges.append(edge)
+            node = self.edge_source[edge]
+        edges.reverse()
+        return edges
+
+    def build_route(self, seconds, edges, source, target):
+        """
+        :return: dict of 'source', 'target', 'seconds', 'meters', 'nodes' and 'links', with the TSM ids
+        """
+        nodes = [self.graph.node_ids[source]] + [self.graph.node_ids[self.edge_target[e]] for e in edges]
+        return {'source': str(self.graph.node_ids[source]), 'target': str(self.graph.node_ids[target]),
+                'seconds': seconds, 'meters': float(sum(self.graph.link_length[e] for e in edges)),
+                'nodes': [str(node) for node in nodes], 'links': [str(self.graph.link_ids[e]) for e in edges],
+                'snapshot_time': self.snapshot_time}
+
+    def route(self, source_id, target_id):
+        """
+        Fastest route between two TSM nodes
+        :param source_id: TSM node id, e.g. '722'
+        :param target_id: TSM node id
+        :return: route dict (see build_route()), None if a node is unknown or the target is not reachable
+        """
+        source = self.graph.node_index.get(source_id)
+        target = self.graph.node_index.get(target_id)
+        if source is None or target is None:
+            return None
+        result = self.shortest_path(source, target)
+        if result is None:
+            return None
+        return self.build_route(result[0], result[1], source, target)
+
+    def route_many(self, pairs):
+        """
+        Fastest routes of many origin-destination pairs, one Dijkstra for each distinct origin
+        :param pairs: list of (source node id, target node id)
+        :return: list of route dicts (None for the unknown or unreachable pairs), in the order of the pairs
+        """
+        targets_by_source = {}
+        for source_id, target_id in pairs:
+            source = self.graph.node_index.get(source_id)
+            target = self.graph.node_index.get(target_id)
+            if source is not None and target is not None:
+                targets_by_source.setdefault(source, set()).add(target)
+
+        trees = {}
+        for source, targets in targets_by_source.items():
+            trees[source] = self.shortest_path_tree(source, targets)
+
+        routes = []
+        for source_id, target_id in pairs:
+            source = self.graph.node_index.get(source_id)
+            target = self.graph.node_index.get(target_id)
+            if source is None or target is None or target not in trees[source][0]:
+                routes.append(None)
+                continue
+            seconds, parent_edge = trees[source]
+            edges = self.trace_edges(parent_edge, source, target)
+            routes.append(self.build_route(seconds[target], edges, source, target))
+        return routes
@@ -2,6 +2,10 @@
 Tasks for all tasks
 """
 from src.tsm_fetcher.tsm_fetcher_helper import TSMFetcher as TF
+from src.tsm_fetcher.tsm_scheduler import scheduler_thread
+from src.tsm_fetcher.tsm_link_stats import LinkStatsTracker
+from src.tsm_fetcher.tsm_congestion import CongestionIndexer
+from src.tsm_fetcher.tsm_rollup import run_rollup
 from src.utils import Logger, task_thread
 import time
 
@@ -9,16 +13,27 @@ TSM_INTERVAL = 2 * 60
 CURRENT_INTERVAL = 200
 FORECAST_INTERVAL = 3600*3
 AQ_INTERVAL = 1200
+ROLLUP_INTERVAL = 3600
 
 TOTAL_RUNNING_TIME = 3600*24*60
 
 if __name__ == '__main__':
     tsm = TF()
+    link_stats = LinkStatsTracker()
+    tsm.add_ingest_listener(link_stats.on_ingest)
+    tsm.add_ingest_listener(CongestionIndexer().on_ingest)
 
     tasks = []
-    tasks.append(task_thread(tsm.fetch_and_store, TSM_INTERVAL, TOTAL_RUNNING_TIME, False))
+    # Polls follow the learned publish cadence, TSM_INTERVAL is the period until it is learned
+    tsm_task, tsm_scheduler = scheduler_thread(tsm, TOTAL_RUNNING_TIME, default_period=TSM_INTERVAL)
+    tasks.append(tsm_task)
+    tasks.append(task_thread(run_rollup, ROLLUP_INTERVAL, TOTAL_RUNNING_TIME))
     for task in tasks:
         task.start()
     time.sleep(TOTAL_RUNNING_TIME)
+    # The last snapshot is ingested before the link stats are flushed
+    tsm_scheduler.stop()
+    tsm_task.join()
     for task in tasks:
         task.join(0.1)
+    link_stats.flush()
@@ -0,0 +1,201 @@
+"""
+Concurrent and resumable downloader of the historical TSM archive.
+Example of an archive url:
+https://api.data.gov.hk/v1/historical-archive/get-file?url=http%3A%2F%2Fresource.data.one.gov.hk%2Ftd%2Fspeedmap.xml&time=20170901-0049
+
+The urls are downloaded by a bounded pool of worker threads, each thread keeps one keep-alive connection per host.
+Failed requests are retried with exponential backoff, a keep-alive connection closed by the server is reopened once
+at once without counting an attempt.
+The pages are handed over in the order of the urls, so parsing and storage of a page overlap with the downloading
+of the following ones.
+Urls whose pages are handled are appended to a ledger file, an interrupted run skips them when started again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urlsplit, urljoin
+import http.client
+import threading
+import time
+import os
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# Errors of a keep-alive connection closed by the server while idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+class ArchiveHTTPError(Exception):
+    def __init__(self, url, status):
+        super().__init__('HTTPError = ' + str(status) + ' of ' + url)
+        self.url = url
+        self.status = status
+
+
+def read_link_file(link_file_path):
+    """
+    Read a daily link file saved by TSMFetcher.fetch_TSM_save_links_file()
+    :param link_file_path: path of the link file
+    :return: list of (url, date time string) pairs, date time string example: 20171001-0000
+    """
+    links = []
+    with open(link_file_path) as file_in:
+        for line in file_in:
+            link = line.strip()
+            if len(link):
+                links.append((link, link[-13:]))
+    return links
+
+
+class TSMArchiveDownloader:
+
+    def __init__(self, ledger_path, workers=8, retries=3, backoff_seconds=1.0, timeout=30, max_pending=None):
+        """
+        :param ledger_path: path of the ledger file of the handled urls
+        :param workers: number of download threads
+        :param retries: number of retries of a url
+        :param backoff_seconds: waiting time before the first retry, doubled for each retry
+        :param timeout: socket timeout in seconds
+        :param max_pending: max number of downloaded pages waiting to be handled, 4 * workers by default
+        """
+        self.ledger_path = ledger_path
+        self.workers = workers
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.max_pending = max_pending if max_pending is not None else 4 * workers
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def load_ledger(self):
+        """
+        :return: set of the urls in the ledger
+        """
+        if not os.path.exists(self.ledger_path):
+            return set()
+        with open(self.ledger_path) as ledger_in:
+            return set(line.strip() for line in ledger_in if line.strip())
+
+    def _get_connection(self, scheme, netloc):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[key] = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        connection = self._local.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def _get(self, url):
+        """
+        GET a url on the keep-alive connection of the current thread, redirects are followed
+        :return: the response body
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            for reconnect in (True, False):
+                connection = self._get_connection(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except STALE_CONNECTION_ERRORS:
+                    # The server closed the idle connection, reconnect once before failing the attempt
+                    self._drop_connection(parts.scheme, parts.netloc)
+                    if not reconnect:
+                        raise
+                except (http.client.HTTPException, OSError):
+                    self._drop_connection(parts.scheme, parts.netloc)
+                    raise
+            if response.status in REDIRECT_CODES and response.getheader('Location'):
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 200:
+                raise ArchiveHTTPError(url, response.status)
+            return body
+        raise ArchiveHTTPError(url, 'too many redirects')
+
+    def fetch(self, url):
+        """
+        Download a url with retries
+        :param url: url of the archive file
+        :return: the page bytes, None if all the attempts failed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._get(url)
+            except ArchiveHTTPError as err:
+                print(str(err) + '. Fetch TSM xml data error!')
+                # Client errors will not be fixed by a retry
+                if isinstance(err.status, int) and 400 <= err.status < 500 and err.status != 429:
+                    return None
+            except (http.client.HTTPException, OSError) as err:
+                print('URLError = ' + str(err) + ' of ' + url + '. Fetch TSM xml data error!')
+            if attempt < self.retries:
+                time.sleep(self.backoff_seconds * (2 ** attempt))
+        return None
+
+    def download(self, urls, handle_page):
+        """
+        Download the urls not in the ledger and hand over the pages in the order of the urls
+        :param urls: list of archive urls
+        :param handle_page: function(url, page) called in the calling thread, e.g. to parse and store the page,
+                            the url is added to the ledger when it returns without exception
+        :return: dict of the numbers of 'handled', 'skipped' and 'failed' urls
+        """
+        done_urls = self.load_ledger()
+        pending_urls = [url for url in urls if url not in done_urls]
+        stats = {'handled': 0, 'skipped': len(urls) - len(pending_urls), 'failed': 0}
+
+        def handle(url, future):
+            page = future.result()
+            if page is None:
+                stats['failed'] += 1
+                return
+            try:
+                handle_page(url, page)
+            except Exception as err:
+                print('Handle error of ' + url + ': ' + str(err))
+                stats['failed'] += 1
+            else:
+                ledger_out.write(url + '\n')
+                ledger_out.flush()
+                stats['handled'] += 1
+
+        ledger_folder = os.path.dirname(os.path.abspath(self.ledger_path))
+        if not os.path.exists(ledger_folder):
+            os.makedirs(ledger_folder)
+        with open(self.ledger_path, 'a') as ledger_out, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            window = deque()
+            for url in pending_urls:
+                window.append((url, executor.submit(self.fetch, url)))
+                if len(window) >= self.max_pending:
+                    handle(*window.popleft())
+            while len(window):
+                handle(*window.popleft())
+
+        self.close()
+        return stats
+
+    def close(self):
+        """
+        Close the keep-alive connections of all the threads
+        """
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
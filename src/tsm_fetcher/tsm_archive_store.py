@@ -0,0 +1,154 @@
+"""
+Compressed and content-addressed archive of the raw speedmap.xml snapshots.
+Folder layout:
+  yyyymmdd.seg  append-only segment of the day, the zlib-compressed unique payloads one after another
+  yyyymmdd.idx  index of the day, one line per snapshot: date time string, sha1, segment, offset, length
+A payload is stored once, snapshots with the same payload (of any day) point to the same blob.
+Import the xml files saved by TSMFetcher:
+  python -m src.tsm_fetcher.tsm_archive_store <archive folder> <xml folder> [<xml folder> ...]
+"""
+import hashlib
+import zlib
+import sys
+import os
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+
+class TSMArchiveStore:
+
+    def __init__(self, archive_path, compress_level=6):
+        """
+        :param archive_path: folder of the segment and index files
+        :param compress_level: zlib compression level
+        """
+        self.archive_path = archive_path
+        self.compress_level = compress_level
+        # sha1 -> (segment, offset, length)
+        self.blobs = {}
+        # date time strings of the stored snapshots
+        self.snapshots = set()
+        if not os.path.exists(archive_path):
+            os.makedirs(archive_path)
+        self.load_index()
+
+    def days(self):
+        """
+        :return: sorted list of the days ('yyyymmdd') in the archive
+        """
+        return sorted(f[:-len(INDEX_SUFFIX)] for f in os.listdir(self.archive_path) if f.endswith(INDEX_SUFFIX))
+
+    def read_index(self, day):
+        """
+        Read the index of a day, entries beyond the end of their segment (an interrupted write) are dropped
+        :param day: 'yyyymmdd'
+        :return: list of (date time string, sha1, segment, offset, length)
+        """
+        entries = []
+        segment_sizes = {}
+        with open(os.path.join(self.archive_path, day + INDEX_SUFFIX)) as index_in:
+            for line in index_in:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 5:
+                    continue
+                date_time_string, payload_hash, segment, offset, length = fields
+                if segment not in segment_sizes:
+                    segment_path = os.path.join(self.archive_path, segment + SEGMENT_SUFFIX)
+                    segment_sizes[segment] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+                if int(offset) + int(length) > segment_sizes[segment]:
+                    continue
+                entries.append((date_time_string, payload_hash, segment, int(offset), int(length)))
+        return entries
+
+    def load_index(self):
+        for day in self.days():
+            for date_time_string, payload_hash, segment, offset, length in self.read_index(day):
+                self.blobs.setdefault(payload_hash, (segment, offset, length))
+                self.snapshots.add(date_time_string)
+
+    def add(self, date_time_string, page):
+        """
+        Add a snapshot to the archive
+        :param date_time_string: capture time of the snapshot in the archive, example: 20171001-0000
+        :param page: bytes of speedmap.xml
+        :return: True if added, False if the snapshot is already in the archive
+        """
+        if date_time_string in self.snapshots:
+            return False
+        day = date_time_string[:8]
+        payload_hash = hashlib.sha1(page).hexdigest()
+        if payload_hash not in self.blobs:
+            blob = zlib.compress(page, self.compress_level)
+            with open(os.path.join(self.archive_path, day + SEGMENT_SUFFIX), 'ab') as segment_out:
+                offset = segment_out.tell()
+                segment_out.write(blob)
+            self.blobs[payload_hash] = (day, offset, len(blob))
+
+        segment, offset, length = self.blobs[payload_hash]
+        with open(os.path.join(self.archive_path, day + INDEX_SUFFIX), 'a') as index_out:
+            index_out.write('\t'.join([date_time_string, payload_hash, segment, str(offset), str(length)]) + '\n')
+        self.snapshots.add(date_time_string)
+        return True
+
+    def add_xml_folder(self, xml_folder_path):
+        """
+        Import the xml files saved by TSMFetcher, e.g. data/full_tsm_xml/20171001/20171001_0000.xml
+        :param xml_folder_path: folder of the xml files, searched recursively
+        :return: number of added snapshots
+        """
+        added = 0
+        for root, dirnames, filenames in os.walk(xml_folder_path):
+            for filename in sorted(filenames):
+                if not filename.endswith('.xml'):
+                    continue
+                with open(os.path.join(root, filename), 'rb') as xml_in:
+                    if self.add(filename[:-4].replace('_', '-'), xml_in.read()):
+                        added += 1
+        return added
+
+    def iter_snapshots(self, start_day=None, end_day=None):
+        """
+        Iterate the snapshots in time order without extracting them to files
+        :param start_day: first day 'yyyymmdd' (included), from the first day of the archive by default
+        :param end_day: last day 'yyyymmdd' (included), to the last day of the archive by default
+        :return: a generator of (date time string, page bytes)
+        """
+        segment_files = {}
+        last_blob = (None, None)
+        try:
+            for day in self.days():
+                if (start_day is not None and day < start_day) or (end_day is not None and day > end_day):
+                    continue
+                for date_time_string, payload_hash, segment, offset, length in sorted(self.read_index(day)):
+                    if last_blob[0] != payload_hash:
+                        if segment not in segment_files:
+                            segment_files[segment] = open(os.path.join(self.archive_path, segment + SEGMENT_SUFFIX),
+                                                          'rb')
+                        segment_file = segment_files[segment]
+                        segment_file.seek(offset)
+                        last_blob = (payload_hash, zlib.decompress(segment_file.read(length)))
+                    yield date_time_string, last_blob[1]
+        finally:
+            for segment_file in segment_files.values():
+                segment_file.close()
+
+    def iter_records(self, tsm_fetcher, start_day=None, end_day=None):
+        """
+        Feed the archived snapshots back through the parser
+        :param tsm_fetcher: a TSMFetcher
+        :param start_day: first day 'yyyymmdd' (included)
+        :param end_day: last day 'yyyymmdd' (included)
+        :return: a generator of (date time string, generator of records)
+        """
+        for date_time_string, page in self.iter_snapshots(start_day, end_day):
+            yield date_time_string, tsm_fetcher.iter_parse_xml(page)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    archive_store = TSMArchiveStore(sys.argv[1])
+    for xml_folder in sys.argv[2:]:
+        print('Added ' + str(archive_store.add_xml_folder(xml_folder)) + ' snapshots from ' + xml_folder)
@@ -0,0 +1,205 @@
+"""
+Materialized congestion index of the TSM snapshots by region (HK/K/TM/ST) and road type.
+One small document per snapshot, region and road type in tsm_congestion_index:
+{'snapshot_time': latest capture of the snapshot, 'region', 'road_type', 'links': number of reporting links,
+ 'speed_sum', 'mean_speed', 'saturation_counts': [bad, average, good], 'saturation_share': [bad, average, good]}
+The documents are upserted as each snapshot is stored (CongestionIndexer.on_ingest as an ingest listener of
+TSMFetcher), the history is backfilled from traffic_speed_map by capture date:
+  python -m src.tsm_fetcher.tsm_congestion [start yyyymmdd] [end yyyymmdd]
+"""
+import itertools
+import sys
+import time
+
+from pymongo import MongoClient, ReplaceOne, ASCENDING
+
+from src.tsm_fetcher.tsm_storage import saturation_code
+from src.tsm_fetcher.tsm_schema import to_number, TRAFFIC_SPEED_COLLECTION
+from src.tsm_fetcher.tsm_link_cache import get_link_cache
+
+CONGESTION_COLLECTION = 'tsm_congestion_index'
+
+
+def build_congestion_documents(records):
+    """
+    Aggregate the records of a snapshot by region and road type
+    :param records: records of a snapshot, of schema 1 or typed (looked up in the link dimension cache)
+    :return: list of congestion documents
+    """
+    if len(records) == 0:
+        return []
+    snapshot_time = int(max(r['capture_date_1970'] for r in records))
+    link_cache = get_link_cache()
+    groups = {}
+    for record in records:
+        if 'region' in record:
+            key = (record['region'], record['road_type'])
+        else:
+            key = link_cache.region_and_type(record['link_id'])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'links': 0, 'speed_sum': 0.0, 'saturation_counts': [0, 0, 0]}
+        group['links'] += 1
+        group['speed_sum'] += to_number(record['traffic_speed'])
+        code = saturation_code(record['road_saturation_level'])
+        if code:
+            group['saturation_counts'][code - 1] += 1
+
+    documents = []
+    for (region, road_type), group in groups.items():
+        documents.append({'snapshot_time': snapshot_time, 'region': region, 'road_type': road_type,
+                          'links': group['links'], 'speed_sum': group['speed_sum'],
+                          'mean_speed': group['speed_sum'] / group['links'],
+                          'saturation_counts': group['saturation_counts'],
+                          'saturation_share': [count / group['links'] for count in group['saturation_counts']]})
+    return documents
+
+
+def store_congestion_documents(db, documents):
+    """
+    Upsert congestion documents, a snapshot written twice (live and backfill) is kept once
+    :param db: the 'traffic' database
+    :param documents: congestion documents
+    """
+    if len(documents) == 0:
+        return
+    collection = db[CONGESTION_COLLECTION]
+    collection.bulk_write([ReplaceOne({'snapshot_time': d['snapshot_time'], 'region': d['region'],
+                                       'road_type': d['road_type']}, d, upsert=True) for d in documents],
+                          ordered=False)
+
+
+def create_congestion_index(db):
+    db[CONGESTION_COLLECTION].create_index([('snapshot_time', ASCENDING), ('region', ASCENDING),
+                                            ('road_type', ASCENDING)], unique=True)
+    db[CONGESTION_COLLECTION].create_index([('region', ASCENDING), ('snapshot_time', ASCENDING)])
+
+
+def split_snapshots(records):
+    """
+    Split the records of one fetch into snapshots, for the records stored without a 'snapshot_time'.
+    A live fetch is one snapshot, while a local csv file stores all its sampled slots with the same fetch time,
+    so such a fetch (a link appearing twice) is split by capture time.
+    :param records: records with the same fetch_time_1970
+    :return: list of lists of records
+    """
+    link_ids = set(r['link_id'] for r in records)
+    if len(link_ids) == len(records):
+        return [records]
+    snapshots = {}
+    for record in records:
+        snapshots.setdefault(record['capture_date_1970'], []).append(record)
+    return [snapshots[capture_time] for capture_time in sorted(snapshots)]
+
+
+def iter_groups(records, key):
+    """
+    :param records: iterable of records sorted by key
+    :param key: field name
+    :return: generator of lists of consecutive records with the same value of key
+    """
+    group = []
+    for record in records:
+        if len(group) and record[key] != group[0][key]:
+            yield group
+            group = []
+        group.append(record)
+    if len(group):
+        yield group
+
+
+class CongestionIndexer:
+
+    def __init__(self):
+        # The upserts of every snapshot filter on the index keys
+        client = MongoClient('127.0.0.1', 27017)
+        create_congestion_index(client['traffic'])
+        client.close()
+
+    def on_ingest(self, records):
+        """
+        Ingest listener of TSMFetcher
+        :param records: stored records of a snapshot
+        """
+        client = MongoClient('127.0.0.1', 27017)
+        db = client['traffic']
+        store_congestion_documents(db, build_congestion_documents(records))
+        client.close()
+
+
+def backfill_congestion_index(start_time_second=None, end_time_second=None, batch_size=1000):
+    """
+    Build the congestion index of the stored records, snapshot by snapshot in capture order.
+    The records are grouped by the 'snapshot_time' stamped on them as each page is stored, the records stored
+    before it existed are grouped by fetch time instead (see split_snapshots).
+    :param start_time_second: start of the capture time range (included), seconds since the epoch
+    :param end_time_second: end of the capture time range (excluded), seconds since the epoch
+    :param batch_size: number of congestion documents of each write
+    :return: number of indexed snapshots
+    """
+    client = MongoClient('127.0.0.1', 27017)
+    db = client['traffic']
+    collection = db[TRAFFIC_SPEED_COLLECTION]
+    collection.create_index([('snapshot_time', ASCENDING)])
+    collection.create_index([('capture_date_1970', ASCENDING)])
+    create_congestion_index(db)
+
+    capture_range = {}
+    if start_time_second is not None:
+        capture_range['$gte'] = start_time_second
+    if end_time_second is not None:
+        capture_range['$lt'] = end_time_second
+    projection = {'_id': 0, 'link_id': 1, 'region': 1, 'road_type': 1, 'traffic_speed': 1,
+                  'road_saturation_level': 1, 'capture_date_1970': 1, 'fetch_time_1970': 1, 'snapshot_time': 1}
+
+    # The snapshot time is a capture time, filtering on it keeps the snapshots at the range ends whole
+    snapshot_query = {'snapshot_time': capture_range if len(capture_range) else {'$exists': True}}
+    snapshots = iter_groups(collection.find(snapshot_query, projection).sort([('snapshot_time', ASCENDING)]),
+                            'snapshot_time')
+    legacy_query = {'snapshot_time': {'$exists': False}}
+    if len(capture_range):
+        legacy_query['capture_date_1970'] = capture_range
+    legacy_fetches = iter_groups(collection.find(legacy_query, projection).sort([('fetch_time_1970', ASCENDING)]),
+                                 'fetch_time_1970')
+    legacy_snapshots = (snapshot for fetch_records in legacy_fetches for snapshot in split_snapshots(fetch_records))
+
+    snapshot_count = 0
+    documents = []
+    for snapshot in itertools.chain(snapshots, legacy_snapshots):
+        documents.extend(build_congestion_documents(snapshot))
+        snapshot_count += 1
+        if len(documents) >= batch_size:
+            store_congestion_documents(db, documents)
+            documents = []
+            print('Indexed ' + str(snapshot_count) + ' snapshots')
+    store_congestion_documents(db, documents)
+    client.close()
+    return snapshot_count
+
+
+def merge_congestion_documents(documents):
+    """
+    Merge congestion documents of the same snapshot time, e.g. all road types of a region
+    :param documents: congestion documents
+    :return: list of dicts {'snapshot_time', 'links', 'mean_speed', 'saturation_share'} sorted by snapshot time
+    """
+    merged = {}
+    for document in documents:
+        group = merged.get(document['snapshot_time'])
+        if group is None:
+            group = merged[document['snapshot_time']] = {'links': 0, 'speed_sum': 0.0, 'saturation_counts': [0, 0, 0]}
+        group['links'] += document['links']
+        group['speed_sum'] += document['speed_sum']
+        group['saturation_counts'] = [a + b for a, b in zip(group['saturation_counts'],
+                                                            document['saturation_counts'])]
+    return [{'snapshot_time': snapshot_time, 'links': group['links'],
+             'mean_speed': group['speed_sum'] / group['links'],
+             'saturation_share': [count / group['links'] for count in group['saturation_counts']]}
+            for snapshot_time, group in sorted(merged.items())]
+
+
+if __name__ == '__main__':
+    date_format = '%Y%m%d'
+    start_second = time.mktime(time.strptime(sys.argv[1], date_format)) if len(sys.argv) > 1 else None
+    end_second = time.mktime(time.strptime(sys.argv[2], date_format)) + 24 * 3600 if len(sys.argv) > 2 else None
+    print('Indexed ' + str(backfill_congestion_index(start_second, end_second)) + ' snapshots')
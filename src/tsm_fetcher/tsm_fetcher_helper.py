@@ -4,10 +4,19 @@ import urllib.request
 from pymongo import MongoClient
 from lxml import etree
 from lxml.etree import XMLSyntaxError
+from functools import lru_cache
+from io import BytesIO
+import hashlib
 import time
-import json
 import os
 
+from src.tsm_fetcher.tsm_storage import STORAGE_LAYOUTS, DeltaSnapshotWriter, store_bucketed_records, saturation_code
+from src.tsm_fetcher.tsm_schema import to_typed_record, to_number, upsert_link_info
+from src.tsm_fetcher.tsm_archive_downloader import TSMArchiveDownloader, read_link_file
+from src.tsm_fetcher.tsm_sampler import sample_links
+from src.tsm_fetcher.tsm_list_crawler import TSMListCrawler
+from src.tsm_fetcher.tsm_link_cache import get_link_cache, TSMLinkCache
+
 #  Modify: save the parsed data as local files
 #          log the schedual
 #          Realtime updating
@@ -15,12 +24,31 @@ import os
 #  Historical record: https://api.data.gov.hk/v1/historical-archive/get-file?url=http%3A%2F%2Fresource.data.one.gov.hk%2Ftd%2Fspeedmap.xml&time=20170901-0049
 
 REQUEST_PATH = 'http://resource.data.one.gov.hk/td/speedmap.xml'
+TRAFFIC_DATABASE = "traffic"
 TRAFFIC_SPEED_COLLECTION = "traffic_speed_map"
+WATERMARK_COLLECTION = "tsm_ingest_watermark"
 
 tag_map = {
     "LINK_ID": 'id',
 }
 
+CAPTURE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+RECORD_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Fields a speedmap entity must carry to be a valid record
+RECORD_FIELDS = ('link_id', 'region', 'road_type', 'road_saturation_level', 'traffic_speed', 'capture_date')
+
+
+@lru_cache(maxsize=4096)
+def convert_date_string(date_string, date_format=CAPTURE_DATE_FORMAT):
+    """
+    Convert a date string to the seconds since the epoch.
+    A snapshot only has a handful of distinct capture dates, so the results are cached.
+    :param date_string: date string, e.g. '2018-05-01T00:48:50'
+    :param date_format: format of the date string
+    :return: int seconds since the epoch
+    """
+    return int(time.mktime(time.strptime(date_string, date_format)))
+
 
 class TSMFetcher:
     """This is a class used to fetch data from the hk gov data.
@@ -32,13 +60,61 @@ class TSMFetcher:
     entity_tag = "jtis_speedmap"
     current_path = os.path.dirname(os.path.abspath(__file__))
 
-    def __init__(self):
-        pass
+    def __init__(self, storage_layout='document', database=TRAFFIC_DATABASE, collection=TRAFFIC_SPEED_COLLECTION):
+        """
+        :param storage_layout: 'document' for one document per link per snapshot,
+                               'bucket' for one document per link per hour,
+                               'delta' for keyframes and changed links of each snapshot (see tsm_storage)
+        :param database: database of the records, the link info and the watermarks, the live one by default
+        :param collection: collection of the 'document' layout
+        """
+        assert storage_layout in STORAGE_LAYOUTS
+        self.storage_layout = storage_layout
+        self.database = database
+        self.collection = collection
+        self.delta_writer = DeltaSnapshotWriter(database=database) if storage_layout == 'delta' else None
+        # Link dimension shared by the process, another database has its own
+        self.link_cache = get_link_cache() if database == TRAFFIC_DATABASE else TSMLinkCache(database=database)
+        # Latest ingested capture_date_1970 of each source, mirrored to WATERMARK_COLLECTION
+        self.watermarks = {}
+        # HTTP validators and payload hash of the last ingested response of each path
+        self.validators = {}
+        # Validators of the fetched responses, kept once the page is stored (see commit_validators())
+        self.pending_validators = {}
+        self.payload_hashes = {}
+        self.page_hash = None
+        self.last_payload_size = 0
+        self.last_parse_seconds = 0.0
+        self.last_parsed_count = 0
+        self.last_stage_seconds = {}
+        self.poll_stats = {'polls': 0, 'not_modified': 0, 'duplicate_payload': 0,
+                           'bytes_saved': 0, 'parse_seconds_saved': 0.0}
+        # Functions called with the records of each stored snapshot
+        self.ingest_listeners = []
+
+    def fetch_TSM_page(self, path=REQUEST_PATH):
+        """
+        Fetch the speedmap page, the request carries the validators of the last response
+        :param path: url of speedmap.xml
+        :return: page bytes, b'' if the page is not modified, None if the request failed
+        """
+        self.poll_stats['polls'] += 1
+        headers = {}
+        validator = self.validators.get(path, {})
+        if validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator.get('last_modified'):
+            headers['If-Modified-Since'] = validator['last_modified']
 
-    def fetch_TSM_data(self, path=REQUEST_PATH):
         try:
-            response = urllib.request.urlopen(path)
+            response = urllib.request.urlopen(urllib.request.Request(path, headers=headers))
         except HTTPError as e:
+            if e.code == 304:
+                # Not modified, neither downloaded nor parsed
+                self.poll_stats['not_modified'] += 1
+                self.poll_stats['bytes_saved'] += self.last_payload_size
+                self.poll_stats['parse_seconds_saved'] += self.last_parse_seconds
+                return b''
             data = str(e.code)
             print('HTTPError = ' + data + '. Air Quality AQExtractor!')
         except URLError as e:
@@ -46,7 +122,116 @@ class TSMFetcher:
             print('URLError = ' + data + '. Air Quality AQExtractor!')
         else:
             self.page = response.read()
-            return self.parse_self_xml()
+            # Only sent with the next request once the page is stored, a failed store is fetched again
+            self.pending_validators[path] = {'etag': response.headers.get('ETag'),
+                                             'last_modified': response.headers.get('Last-Modified')}
+            self.last_payload_size = len(self.page)
+            return self.page
+
+    def commit_validators(self, source=REQUEST_PATH):
+        """
+        Keep the validators of the last fetched response of a source, called once its page is handled
+        :param source: path of the page
+        """
+        if source in self.pending_validators:
+            self.validators[source] = self.pending_validators.pop(source)
+
+    def is_duplicate_payload(self, page, source=REQUEST_PATH, count_poll=True):
+        """
+        Decides if a page is the same as the last ingested payload of the source
+        :param page: page bytes
+        :param source: source of the page
+        :param count_poll: count a duplicate in the poll stats, False for a page that is not polled
+        :return: True if the same (no parse)
+        """
+        self.page_hash = hashlib.sha1(page).hexdigest()
+        if self.page_hash == self.payload_hashes.get(source):
+            if count_poll:
+                self.poll_stats['duplicate_payload'] += 1
+                self.poll_stats['parse_seconds_saved'] += self.last_parse_seconds
+            return True
+        return False
+
+    def fetch_TSM_data(self, path=REQUEST_PATH):
+        """
+        Fetch and parse the speedmap page.
+        The request carries the validators of the last stored response, and a payload identical to the last
+        ingested one is skipped before parsing.
+        :param path: url of speedmap.xml
+        :return: a generator of records (see iter_parse_xml()), empty if the page is not changed,
+                 None if the request failed
+        """
+        page = self.fetch_TSM_page(path)
+        if page is None:
+            return None
+        if len(page) == 0 or self.is_duplicate_payload(page, path):
+            self.commit_validators(path)
+            return iter(())
+        return self.iter_parse_xml(page)
+
+    def ingest_page(self, page, source=REQUEST_PATH, count_poll=True):
+        """
+        Parse, dedupe and store a speedmap page, the path shared by the live poller and the replay.
+        The seconds of each stage are kept in self.last_stage_seconds.
+        :param page: page bytes
+        :param source: source of the page, the payload hash and the watermark are kept per source
+        :param count_poll: count a duplicate payload in the poll stats, False for the replay
+        :return: number of stored records
+        """
+        stage_seconds = self.last_stage_seconds = {'hash': 0.0, 'parse': 0.0, 'dedupe': 0.0, 'store': 0.0}
+        self.last_parsed_count = 0
+
+        start = time.perf_counter()
+        duplicate = self.is_duplicate_payload(page, source, count_poll)
+        stage_seconds['hash'] = time.perf_counter() - start
+        if duplicate:
+            self.commit_validators(source)
+            return 0
+
+        # The watermark check and the listeners need the whole snapshot before it is stored
+        records = list(self.iter_parse_xml(page))
+        stage_seconds['parse'] = self.last_parse_seconds
+        self.last_parsed_count = len(records)
+        if len(records) == 0:
+            return 0
+
+        start = time.perf_counter()
+        ingested = self.is_ingested(records, source)
+        stage_seconds['dedupe'] = time.perf_counter() - start
+
+        stored = 0
+        if ingested:
+            print('Covered.')
+        else:
+            start = time.perf_counter()
+            self.store_TSM_data(records)
+            self.update_watermark(records, source)
+            stage_seconds['store'] = time.perf_counter() - start
+            stored = len(records)
+            for listener in self.ingest_listeners:
+                listener(records)
+        self.payload_hashes[source] = self.page_hash
+        self.commit_validators(source)
+        return stored
+
+    def add_ingest_listener(self, listener):
+        """
+        Register a function called with the records of each stored snapshot, e.g. LinkStatsTracker.on_ingest
+        :param listener: function of a list of records
+        """
+        self.ingest_listeners.append(listener)
+
+    def get_poll_stats(self):
+        """
+        Counters of the live poller
+        polls: number of requests, not_modified: polls answered with 304,
+        duplicate_payload: polls skipped as the payload is the same as the last ingested one,
+        bytes_saved: payload bytes not downloaded, parse_seconds_saved: estimated parse time saved
+        :return: a dict of the counters
+        """
+        stats = dict(self.poll_stats)
+        stats['skipped'] = stats['not_modified'] + stats['duplicate_payload']
+        return stats
 
     def parse_self_xml(self):
         current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
@@ -90,73 +275,70 @@ class TSMFetcher:
         finally:
                 return records
 
-    def fetch_TSM_save_links_file(self, start_date='20180101', relative_path='../../data/tsm_link/'):
+    def iter_parse_xml(self, page=None):
         """
-        Save the xml links to local files for everyday from start date
+        Streaming parser of the speedmap page, records are yielded as the entities are parsed.
+        Records are typed: {'link_id', 'region', 'road_type', 'road_saturation_level': int code,
+        'traffic_speed': int or float, 'capture_date_1970': int, 'fetch_time_1970': int},
+        the parse seconds spent by the generator are kept in self.last_parse_seconds.
+        :param page: bytes of speedmap.xml, self.page by default
+        :return: a generator of records
+        """
+        if page is None:
+            page = self.page
+        self.last_parse_seconds = 0.0
+        resumed = time.perf_counter()
+        fetch_time_1970 = int(time.time())
+
+        context = etree.iterparse(BytesIO(page), events=('end',), tag='{*}' + self.entity_tag)
+        try:
+            for action, element in context:
+                fields = {}
+                for t in element:
+                    fields[t.tag.rsplit('}', 1)[-1].lower()] = t.text
+                # Release the parsed entities
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+                if not all(field in fields for field in RECORD_FIELDS):
+                    print("invalid record")
+                    continue
+                try:
+                    record = {'link_id': fields['link_id'], 'region': fields['region'],
+                              'road_type': fields['road_type'],
+                              'road_saturation_level': saturation_code(fields['road_saturation_level']),
+                              'traffic_speed': to_number(fields['traffic_speed']),
+                              'capture_date_1970': convert_date_string(fields['capture_date']),
+                              'fetch_time_1970': fetch_time_1970}
+                except (TypeError, ValueError):
+                    print("invalid record")
+                    continue
+                self.last_parse_seconds += time.perf_counter() - resumed
+                yield record
+                resumed = time.perf_counter()
+        except XMLSyntaxError as err:
+            print('XMLSyntaxError: ' + str(err))
+        self.last_parse_seconds += time.perf_counter() - resumed
+
+    def fetch_TSM_save_links_file(self, start_date='20180101', relative_path='../../data/tsm_link/', max_workers=4,
+                                  refresh_today=True):
+        """
+        Save the xml links to local files for everyday from start date.
+        Days with a link file are not listed again, the days are listed concurrently (see TSMListCrawler).
         :param start_date: start date in 'yyyymmdd' format
         :param relative_path: relative data path of the current file
+        :param max_workers: max number of concurrent list requests
+        :param refresh_today: if append the new links of today to 'yyyymmdd.partial'
         :return: list of new files' names
         """
 
-        date_format = "%Y%m%d"
-        current_time = time.strftime(date_format, time.localtime())
-        start = int(time.mktime(time.strptime(start_date, date_format)))
-        end = int(time.mktime(time.strptime(current_time, date_format)))
-        # End with yesterday
-        date_list = [time.strftime(date_format, time.localtime(i)) for i in range(start, end, 3600 * 24)]
-
-        # Build folder for data storage
         link_folder_path = os.path.join(self.current_path, relative_path)
-        if not os.path.exists(link_folder_path):
-            os.makedirs(link_folder_path)
-        os.chdir(link_folder_path)
-
-        # Timestamps of everyday
-        api_list = []
-        for date_string in date_list:
-            api_string = 'https://api.data.gov.hk/v1/historical-archive/list-file-versions' \
-                         '?url=http://resource.data.one.gov.hk/td/speedmap.xml' \
-                         '&start=' + date_string + '&end=' + date_string
-            api_list.append(api_string)
-
-        # List of new files
-        new_date_list = []
-        # XML links of everyday
-        for index, date_string in enumerate(date_list):
-            xml_list = []
-            try:
-                response = urllib.request.urlopen(api_list[index])
-            except HTTPError as e:
-                data = str(e.code)
-                print('HTTPError = ' + data + '. Fetch TSM link data error!')
-            except URLError as e:
-                data = str(e.reason)
-                print('URLError = ' + data + '. Fetch TSM link data error!')
-            else:
-                list_file_json = json.loads(response.read())
-                for timestamp in list_file_json['timestamps']:
-                    xml_string = 'https://api.data.gov.hk/v1/historical-archive/get-file' \
-                                 '?url=http%3A%2F%2Fresource.data.one.gov.hk%2Ftd%2Fspeedmap.xml' \
-                                 '&time=' + timestamp
-                    xml_list.append(xml_string)
-
-            # Save xml links file for everyday
-            if not os.path.exists(date_string):
-                print('Saving xml links of ' + date_string + ' ...')
-                new_date_list.append(date_string)
-                try:
-                    with open(date_string, 'w') as file_out:
-                        separate = '\n'
-                        file_string = separate.join(xml_list)
-                        file_out.write(file_string)
-                except IOError as err:
-                    print('File error: ' + str(err))
-            else:
-                print('File: ' + date_string + ' already exists.')
+        crawler = TSMListCrawler(link_folder_path, max_workers)
+        return crawler.crawl(start_date, refresh_today)
 
-        return new_date_list
-
-    def fetch_all_TSM_xml_from_link_file(self, file_list, save_xml=False, store_database=False):
+    def fetch_all_TSM_xml_from_link_file(self, file_list, save_xml=False, store_database=False, workers=8,
+                                         archive_store=None):
         """
         Collect ALL historical xml records from the links in local file.
         Default setting of saving the xml files is FALSE.
@@ -164,59 +346,29 @@ class TSMFetcher:
         :param file_list: list of date files to be processed,
         :param save_xml: if save each xml to local file
         :param store_database: if parse and store in database
-        :return:
+        :param workers: number of download threads
+        :param archive_store: a TSMArchiveStore, if given each xml is saved to it instead of a local file,
+                              whatever save_xml is
+        :return: dict of the numbers of handled, skipped and failed links
         """
 
         # current_path: ~/workspace/hsbc-back-end/src/tsm_fetcher/tsm_fetcher_helper.py
-        xml_folder_path = os.path.join(self.current_path, '../../../../data/full_tsm_xml/')
         link_folder_path = os.path.join(self.current_path, '../../../../data/full_tsm_link/')
 
         # Read link files in link folder
-        os.chdir(link_folder_path)
+        links = []
         for date_file in file_list:
             # date_file example: 20171001
             try:
-                with open(date_file) as file_in:
-                    link_list = file_in.readlines()
-                    for link in link_list:
-                        date_time_string = link[-14:-1]
-                        if link == link_list[-1]:
-                            # Without '\n'
-                            date_time_string = link[-13:]
-
-                        # xml filename example: 20171001_0000.xml
-                        xml_filename = date_time_string.replace('-', '_') + ".xml"
-                        try:
-                            response = urllib.request.urlopen(link)
-                        except HTTPError as e:
-                            data = str(e.code)
-                            print('HTTPError = ' + data + '. Fetch TSM xml data error!')
-                        except URLError as e:
-                            data = str(e.reason)
-                            print('URLError = ' + data + '. Fetch TSM xml data error!')
-                        else:
-                            self.page = response.read()
-                            if save_xml:
-                                xml_date_folder = os.path.join(xml_folder_path, date_file + '/')
-                                if not os.path.exists(xml_date_folder):
-                                    os.makedirs(xml_date_folder)
-                                try:
-                                    with open(xml_date_folder + xml_filename, 'wb') as xml_file_out:
-                                        xml_file_out.write(self.page)
-                                        print('Saving: ' + xml_date_folder + xml_filename + ' successfully.')
-                                except IOError as err:
-                                    print('File error: ' + str(err))
-                            if store_database:
-                                # Store in database
-                                xml_record = self.parse_self_xml()
-                                if len(xml_record):
-                                    # valid record
-                                    self.store_TSM_data(xml_record)
-                                    print('Parsing: ' + xml_filename + ' and storing in database successfully')
+                for link, date_time_string in read_link_file(os.path.join(link_folder_path, date_file)):
+                    links.append((date_file, link, date_time_string))
             except IOError as err:
                 print('File error: ' + str(err))
 
-    def fetch_TSM_xml_from_link_file(self, file_list, save_xml=False, store_database=False):
+        return self.download_TSM_xml(links, save_xml, store_database, workers, archive_store)
+
+    def fetch_TSM_xml_from_link_file(self, file_list, save_xml=False, store_database=False, workers=8,
+                                     slot_minutes=30, tolerance_seconds=None, archive_store=None):
         """
         Collect historical xml records with 30-min interval from the links in local file.
         Default setting of saving the xml files is FALSE.
@@ -224,101 +376,124 @@ class TSMFetcher:
         :param file_list: list of date files to be processed,
         :param save_xml: if save each xml to local file
         :param store_database: if parse and store in database
-        :return:
+        :param workers: number of download threads
+        :param slot_minutes: sampling interval in minutes, one of 5, 15, 30 and 60
+        :param tolerance_seconds: max gap between a slot and its link, the slot width by default
+        :param archive_store: a TSMArchiveStore, if given each xml is saved to it instead of a local file,
+                              whatever save_xml is
+        :return: dict of the numbers of handled, skipped and failed links
         """
 
-        xml_folder_path = os.path.join(self.current_path, '../../../../data/full_tsm_xml/')
         link_folder_path = os.path.join(self.current_path, '../../../../data/full_tsm_link/')
 
         # Read link files in link folder
-        os.chdir(link_folder_path)
+        links = []
         for date_file in file_list:
             # date_file example: 20171001
-            current_date_time = time.strptime(date_file, "%Y%m%d")
-            seconds_of_current_date = time.mktime(current_date_time)
-            # print(seconds_of_current_date)
-            date_format = "%Y%m%d-%H%M"
+            seconds_of_current_date = time.mktime(time.strptime(date_file, "%Y%m%d"))
             try:
-                with open(date_file) as file_in:
-                    link_list = file_in.readlines()
-                    search_start_index = 0
-                    for i in range(0, 49):
-                        # Search data for every 30 minutes
-                        seconds_of_each_interval = seconds_of_current_date + i * 30 * 60
-                        if i == 48:
-                            # 23:59
-                            seconds_of_each_interval = seconds_of_current_date + (23 * 60 + 59) * 60
-                        # print(time.strftime(date_format, time.localtime(seconds_of_each_interval + i * 30 * 60)))
-                        smallest_gap = 30 * 60
-                        closest_link = ""
-                        closest_date_time_string = ""
-                        for index, link in enumerate(link_list):
-                            if index >= search_start_index:
-                                date_time_string = link[-14:-1]
-                                if link == link_list[-1]:
-                                    # Without '\n'
-                                    date_time_string = link[-13:]
-
-                                seconds_of_link = time.mktime(time.strptime(date_time_string, date_format))
-                                gap = abs(seconds_of_link - seconds_of_each_interval)
-                                if gap < smallest_gap:
-                                    smallest_gap = gap
-                                    search_start_index = index
-                                    closest_link = link
-                                    closest_date_time_string = date_time_string
-
-                        if len(closest_link):
-                            # xml filename example: 20171001_0000.xml
-                            xml_filename = closest_date_time_string.replace('-', '_') + ".xml"
-                            try:
-                                response = urllib.request.urlopen(closest_link)
-                            except HTTPError as e:
-                                data = str(e.code)
-                                print('HTTPError = ' + data + '. Fetch TSM xml data error!')
-                            except URLError as e:
-                                data = str(e.reason)
-                                print('URLError = ' + data + '. Fetch TSM xml data error!')
-                            else:
-                                self.page = response.read()
-                                if save_xml:
-                                    xml_date_folder = os.path.join(xml_folder_path, date_file + '/')
-                                    if not os.path.exists(xml_date_folder):
-                                        os.makedirs(xml_date_folder)
-                                    try:
-                                        with open(xml_date_folder + xml_filename, 'wb') as xml_file_out:
-                                            xml_file_out.write(self.page)
-                                            print('Saving: ' + xml_date_folder + xml_filename + ' successfully.')
-                                    except IOError as err:
-                                        print('File error: ' + str(err))
-                                if store_database:
-                                    # Store in database
-                                    xml_record = self.parse_self_xml()
-                                    if len(xml_record):
-                                        # valid record
-                                        self.store_TSM_data(xml_record)
-                                        print('Parsing: ' + xml_filename + ' and storing in database successfully')
+                link_list = read_link_file(os.path.join(link_folder_path, date_file))
             except IOError as err:
                 print('File error: ' + str(err))
+                continue
+
+            # Closest link of every slot
+            for link, date_time_string in sample_links(link_list, seconds_of_current_date, slot_minutes,
+                                                       tolerance_seconds):
+                links.append((date_file, link, date_time_string))
+
+        return self.download_TSM_xml(links, save_xml, store_database, workers, archive_store)
+
+    def download_TSM_xml(self, links, save_xml=False, store_database=False, workers=8, archive_store=None):
+        """
+        Download historical xml files with a pool of threads (see TSMArchiveDownloader).
+        The pages are saved and/or parsed and stored in the order of the links while the following ones are
+        downloading. Handled links are recorded in a ledger, so an interrupted run resumes where it stopped.
+        :param links: list of (date file, link, date time string), date time string example: 20171001-0000
+        :param save_xml: if save each xml to local file
+        :param store_database: if parse and store in database
+        :param workers: number of download threads
+        :param archive_store: a TSMArchiveStore, if given each xml is saved to it instead of a local file,
+                              whatever save_xml is
+        :return: dict of the numbers of handled, skipped and failed links
+        """
+
+        xml_folder_path = os.path.join(self.current_path, '../../../../data/full_tsm_xml/')
+        link_folder_path = os.path.join(self.current_path, '../../../../data/full_tsm_link/')
+        link_info = {}
+        for date_file, link, date_time_string in links:
+            link_info[link] = (date_file, date_time_string)
+
+        def handle_page(link, page):
+            date_file, date_time_string = link_info[link]
+            # xml filename example: 20171001_0000.xml
+            xml_filename = date_time_string.replace('-', '_') + ".xml"
+            if archive_store is not None:
+                archive_store.add(date_time_string, page)
+            elif save_xml:
+                xml_date_folder = os.path.join(xml_folder_path, date_file + '/')
+                if not os.path.exists(xml_date_folder):
+                    os.makedirs(xml_date_folder)
+                with open(xml_date_folder + xml_filename, 'wb') as xml_file_out:
+                    xml_file_out.write(page)
+                    print('Saving: ' + xml_date_folder + xml_filename + ' successfully.')
+            if store_database:
+                # Store in database, the records are stored as they are parsed
+                if self.store_TSM_data(self.iter_parse_xml(page)):
+                    print('Parsing: ' + xml_filename + ' and storing in database successfully')
+
+        # One ledger for each mode, a link saved as xml is not yet stored in database
+        ledger_name = '.ledger' + ('_archive' if archive_store is not None else '_xml' if save_xml else '') \
+                      + ('_database' if store_database else '')
+        downloader = TSMArchiveDownloader(os.path.join(link_folder_path, ledger_name), workers)
+        return downloader.download([link for date_file, link, date_time_string in links], handle_page)
 
     def store_TSM_data(self, records):
         """
-        Store the records into the database
-        Bad code
-        :param records:
-        :return:
+        Store the records into the database with the storage layout of the fetcher.
+        The 'document' layout stores the typed schema (see tsm_schema) in a single pass over the records.
+        :param records: iterable of the records of one page, e.g. the generator of iter_parse_xml()
+        :return: number of stored records
         """
 
+        if self.storage_layout != 'document':
+            # The bucket and delta layouts group the records of a snapshot
+            records = list(records)
+            if self.storage_layout == 'bucket':
+                store_bucketed_records(records, self.database)
+            else:
+                self.delta_writer.store(records)
+            return len(records)
+
+        typed_records = []
+        new_link_records = []
+        for r in records:
+            if not self.link_cache.is_stored(r['link_id']):
+                new_link_records.append(r)
+            typed_records.append(to_typed_record(r))
+        if len(typed_records) == 0:
+            return 0
+        # The records of a page are one snapshot, keyed by its latest capture (see tsm_congestion)
+        snapshot_time = max(r['capture_date_1970'] for r in typed_records)
+        for r in typed_records:
+            r['snapshot_time'] = snapshot_time
+
         client = MongoClient('127.0.0.1', 27017)
-        db = client['traffic']
-        collection = db[TRAFFIC_SPEED_COLLECTION]
-        collection.insert_many(records)
+        db = client[self.database]
+        if len(new_link_records):
+            # Only the upserted links are cached as stored, a link without a region is tried again
+            for link_id, info in upsert_link_info(db, new_link_records).items():
+                self.link_cache.add(link_id, info['road_region'], info['road_type'])
+        collection = db[self.collection]
+        collection.insert_many(typed_records)
         client.close()
+        return len(typed_records)
 
     def find_latest_record(self):
         client = MongoClient('127.0.0.1', 27017)
-        db = client['traffic']
-        collection = db[TRAFFIC_SPEED_COLLECTION]
-        records = list(collection.find().sort([('fetch_time', -1)]).limit(1))
+        db = client[self.database]
+        collection = db[self.collection]
+        records = list(collection.find().sort([('fetch_time_1970', -1)]).limit(1))
         if len(records) == 0:
             print('No traffic speed data in current database')
             return None
@@ -333,31 +508,96 @@ class TSMFetcher:
         """
 
         client = MongoClient('127.0.0.1', 27017)
-        db = client['traffic']
-        collection = db[TRAFFIC_SPEED_COLLECTION]
+        db = client[self.database]
+        collection = db[self.collection]
         latest_record = self.find_latest_record()
         if latest_record is None:
             print('No traffic speed data in current database')
             client.close()
             return None
         else:
-            return list(collection.find({'fetch_time': latest_record['fetch_time']}))
+            return list(collection.find({'fetch_time_1970': latest_record['fetch_time_1970']}))
 
-    def fetch_and_store(self):
+    def get_watermark(self, source=REQUEST_PATH):
         """
-        This function is used to fetch and store the Recent Record.
-        :return:
+        Get the ingestion watermark (latest ingested capture_date_1970) of a source.
+        The watermark is kept in memory and only loaded from the database once.
+        :param source: source of the records, the request path by default
+        :return: seconds since the epoch or None if nothing is ingested
         """
-        records = self.fetch_TSM_data()
-        old_records = self.find_recent_records()
+        if source not in self.watermarks:
+            self.watermarks[source] = self.load_watermark(source)
+        return self.watermarks[source]
 
-        if old_records is None:
-            print('No record in database!')
-        elif self.time_cover(records, old_records):
-            print('Covered.')
-            return
+    def load_watermark(self, source=REQUEST_PATH):
+        """
+        Load the watermark of a source from the database.
+        If the source has no watermark yet, it is bootstrapped once from the latest stored record.
+        :param source: source of the records
+        :return: seconds since the epoch or None if nothing is ingested
+        """
+        client = MongoClient('127.0.0.1', 27017)
+        db = client[self.database]
+        watermark_record = db[WATERMARK_COLLECTION].find_one({'source': source})
+        if watermark_record is not None:
+            watermark = watermark_record['capture_date_1970']
+        else:
+            latest_records = list(db[self.collection].find({}, {'capture_date_1970': 1})
+                                  .sort([('capture_date_1970', -1)]).limit(1))
+            watermark = latest_records[0]['capture_date_1970'] if len(latest_records) else None
+        client.close()
+        return watermark
 
-        self.store_TSM_data(records)
+    def update_watermark(self, records, source=REQUEST_PATH):
+        """
+        Move the watermark of a source forward to the latest capture time of the ingested records
+        :param records: ingested records
+        :param source: source of the records
+        :return: the current watermark
+        """
+        watermark = self.get_watermark(source)
+        latest_capture = max(r['capture_date_1970'] for r in records)
+        if watermark is not None and latest_capture <= watermark:
+            return watermark
+
+        self.watermarks[source] = latest_capture
+        client = MongoClient('127.0.0.1', 27017)
+        db = client[self.database]
+        db[WATERMARK_COLLECTION].update_one(
+            {'source': source},
+            {'$set': {'capture_date_1970': latest_capture,
+                      'update_time': time.strftime(RECORD_TIME_FORMAT, time.localtime())}},
+            upsert=True)
+        client.close()
+        return latest_capture
+
+    def is_ingested(self, records, source=REQUEST_PATH):
+        """
+        Decides if the records are already ingested, i.e. none of them is captured after the watermark
+        :param records: new coming records
+        :param source: source of the records
+        :return: True if no new capture (no insert), False if there is a new capture (insert)
+        """
+        watermark = self.get_watermark(source)
+        if watermark is None or len(records) == 0:
+            return False
+        return max(r['capture_date_1970'] for r in records) <= watermark
+
+    def fetch_and_store(self, path=REQUEST_PATH):
+        """
+        This function is used to fetch and store the Recent Record.
+        The overlap check uses the ingestion watermark instead of reading the previous snapshot.
+        :param path: url of speedmap.xml
+        :return: number of stored records
+        """
+        page = self.fetch_TSM_page(path)
+        if page is None:
+            print('No record fetched!')
+            return 0
+        if len(page) == 0:
+            # Not modified since the last poll
+            return 0
+        return self.ingest_page(page, path)
 
     def time_cover(self, old_records, new_records):
         """
@@ -0,0 +1,110 @@
+"""
+Process-wide cache of the TSM link dimension (region, road type and end nodes of the ~600 links).
+It is loaded once from tsm_link_and_node_info_v2.csv and the tsm_link_info collection (the collection wins),
+and shared by TSMFetcher, TSMLocalFetcher and the query layer instead of one find_one per link.
+Call get_link_cache().refresh() after the link dimension is changed by another process.
+"""
+import csv
+import os
+
+from pymongo import MongoClient
+
+from src.tsm_fetcher.tsm_schema import LINK_INFO_COLLECTION
+
+LINK_INFO_CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../tsm_link_and_node_info_v2.csv')
+UNKNOWN_LINK_INFO = {'road_region': 'NULL', 'road_type': 'NULL'}
+
+
+def read_link_info_csv(csv_path=LINK_INFO_CSV_PATH):
+    """
+    :param csv_path: path of tsm_link_and_node_info_v2.csv
+    :return: dict of link_id: {'link_id', 'road_region', 'road_type', 'start_id', 'end_id'}, empty if no file
+    """
+    links = {}
+    try:
+        with open(csv_path, newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                links[row['Link ID']] = {'link_id': row['Link ID'], 'road_region': row['Region'],
+                                         'road_type': row['Road Type'], 'start_id': row['Start Node'],
+                                         'end_id': row['End Node']}
+    except IOError as err:
+        print('File error: ' + str(err))
+    return links
+
+
+class TSMLinkCache:
+
+    def __init__(self, csv_path=LINK_INFO_CSV_PATH, database='traffic'):
+        """
+        :param csv_path: path of tsm_link_and_node_info_v2.csv, None to load from the database only
+        :param database: database of the tsm_link_info collection
+        """
+        self.csv_path = csv_path
+        self.database = database
+        self.links = None
+        # Links known to be in the tsm_link_info collection
+        self.stored_link_ids = set()
+
+    def refresh(self):
+        """
+        Reload the cache, the new dict replaces the old one at once so readers never see a partial cache
+        """
+        links = read_link_info_csv(self.csv_path) if self.csv_path is not None else {}
+        client = MongoClient('127.0.0.1', 27017)
+        db = client[self.database]
+        stored_link_ids = set()
+        for info in db[LINK_INFO_COLLECTION].find({}, {'_id': 0}):
+            links[info['link_id']] = dict(links.get(info['link_id'], {}), **info)
+            stored_link_ids.add(info['link_id'])
+        client.close()
+        self.links = links
+        self.stored_link_ids = stored_link_ids
+
+    def all(self):
+        """
+        :return: dict of link_id: link info
+        """
+        if self.links is None:
+            self.refresh()
+        return self.links
+
+    def get(self, link_id):
+        """
+        :return: link info dict with 'road_region' and 'road_type', None if unknown
+        """
+        return self.all().get(link_id)
+
+    def region_and_type(self, link_id):
+        """
+        :return: (region, road_type), ('NULL', 'NULL') if unknown
+        """
+        info = self.all().get(link_id, UNKNOWN_LINK_INFO)
+        return info['road_region'], info['road_type']
+
+    def is_stored(self, link_id):
+        """
+        :return: True if the link is in the tsm_link_info collection
+        """
+        self.all()
+        return link_id in self.stored_link_ids
+
+    def add(self, link_id, road_region, road_type, stored=True):
+        """
+        Add a link seen on ingestion
+        :param stored: if the link is written to the tsm_link_info collection
+        """
+        links = self.all()
+        if link_id not in links:
+            links[link_id] = {'link_id': link_id, 'road_region': road_region, 'road_type': road_type}
+        if stored:
+            self.stored_link_ids.add(link_id)
+
+
+_link_cache = TSMLinkCache()
+
+
+def get_link_cache():
+    """
+    :return: the TSMLinkCache of the process, loaded on first use
+    """
+    return _link_cache
@@ -0,0 +1,188 @@
+"""
+Per-link rolling statistics of the traffic speed, updated in O(1) per record on ingestion.
+Each link keeps the count, mean and variance (Welford), EWMA, min, max and the latest speed,
+and the count, mean and variance of each hour-of-week bucket (0 is Monday 00:00-01:00, local time).
+The statistics live in memory and are flushed periodically to the small tsm_link_stats collection
+(one document per link), z-scores against the baseline are computed from them without scanning traffic_speed_map.
+Usage with the live poller:
+  tracker = LinkStatsTracker()
+  tsm_fetcher.add_ingest_listener(tracker.on_ingest)
+"""
+import math
+import time
+
+from pymongo import MongoClient, ReplaceOne
+
+from src.tsm_fetcher.tsm_schema import to_number
+
+LINK_STATS_COLLECTION = 'tsm_link_stats'
+HOURS_OF_WEEK = 7 * 24
+
+
+def hour_of_week(seconds):
+    """
+    :param seconds: seconds since the epoch
+    :return: hour of the week in [0, 168), 0 is Monday 00:00-01:00
+    """
+    local_time = time.localtime(seconds)
+    return local_time.tm_wday * 24 + local_time.tm_hour
+
+
+def new_link_stats(link_id):
+    return {'link_id': link_id, 'count': 0, 'mean': 0.0, 'm2': 0.0, 'ewma': None, 'min': None, 'max': None,
+            'last_speed': None, 'last_capture_1970': None,
+            'hour_counts': [0] * HOURS_OF_WEEK, 'hour_means': [0.0] * HOURS_OF_WEEK,
+            'hour_m2s': [0.0] * HOURS_OF_WEEK}
+
+
+def update_link_stats(stats, speed, capture_1970, alpha):
+    """
+    Add a speed to the statistics of a link
+    :param stats: statistics dict of the link, see new_link_stats()
+    :param speed: traffic speed
+    :param capture_1970: capture time in seconds since the epoch
+    :param alpha: smoothing factor of the EWMA
+    """
+    stats['count'] += 1
+    delta = speed - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (speed - stats['mean'])
+    stats['ewma'] = speed if stats['ewma'] is None else alpha * speed + (1 - alpha) * stats['ewma']
+    stats['min'] = speed if stats['min'] is None else min(stats['min'], speed)
+    stats['max'] = speed if stats['max'] is None else max(stats['max'], speed)
+    stats['last_speed'] = speed
+    stats['last_capture_1970'] = capture_1970
+
+    hour = hour_of_week(capture_1970)
+    stats['hour_counts'][hour] += 1
+    delta = speed - stats['hour_means'][hour]
+    stats['hour_means'][hour] += delta / stats['hour_counts'][hour]
+    stats['hour_m2s'][hour] += delta * (speed - stats['hour_means'][hour])
+
+
+def zscore_from_stats(stats, speed, hour=None, min_count=10):
+    """
+    z-score of a speed against the baseline of a link.
+    The baseline is the hour-of-week bucket if it has min_count speeds, otherwise all the speeds of the link.
+    :param stats: statistics dict of the link
+    :param speed: traffic speed
+    :param hour: hour of the week of the speed, None for the overall baseline
+    :param min_count: min number of speeds of a baseline
+    :return: the z-score, None if no baseline has enough speeds or the baseline has no variance
+    """
+    if hour is not None and stats['hour_counts'][hour] >= min_count:
+        count, mean, m2 = stats['hour_counts'][hour], stats['hour_means'][hour], stats['hour_m2s'][hour]
+    elif stats['count'] >= min_count:
+        count, mean, m2 = stats['count'], stats['mean'], stats['m2']
+    else:
+        return None
+    std = math.sqrt(m2 / (count - 1))
+    if std == 0:
+        return None
+    return (speed - mean) / std
+
+
+class LinkStatsTracker:
+
+    def __init__(self, alpha=0.1, flush_interval=600, min_count=10, load=True):
+        """
+        :param alpha: smoothing factor of the EWMA
+        :param flush_interval: seconds between two flushes to the database
+        :param min_count: min number of speeds of a baseline for the z-scores
+        :param load: if load the flushed statistics from the database
+        """
+        self.alpha = alpha
+        self.flush_interval = flush_interval
+        self.min_count = min_count
+        self.link_stats = {}
+        self.dirty_link_ids = set()
+        self.last_flush_time = time.time()
+        if load:
+            self.load()
+
+    def load(self):
+        client = MongoClient('127.0.0.1', 27017)
+        db = client['traffic']
+        for stats in db[LINK_STATS_COLLECTION].find({}, {'_id': 0}):
+            self.link_stats[stats['link_id']] = stats
+        client.close()
+
+    def update(self, record):
+        """
+        Add a record, a link capture already counted (a link not updated between two snapshots) is skipped
+        :param record: record of schema 1 or typed record
+        :return: True if counted
+        """
+        stats = self.link_stats.get(record['link_id'])
+        if stats is None:
+            stats = self.link_stats[record['link_id']] = new_link_stats(record['link_id'])
+        capture_1970 = int(record['capture_date_1970'])
+        if stats['last_capture_1970'] is not None and capture_1970 <= stats['last_capture_1970']:
+            return False
+        update_link_stats(stats, to_number(record['traffic_speed']), capture_1970, self.alpha)
+        self.dirty_link_ids.add(record['link_id'])
+        return True
+
+    def on_ingest(self, records):
+        """
+        Ingest listener of TSMFetcher, flushes when the flush interval is passed
+        :param records: stored records of a snapshot
+        """
+        for record in records:
+            self.update(record)
+        if time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the statistics of the links updated since the last flush
+        :return: number of written links
+        """
+        self.last_flush_time = time.time()
+        if len(self.dirty_link_ids) == 0:
+            return 0
+        operations = [ReplaceOne({'link_id': link_id}, self.link_stats[link_id], upsert=True)
+                      for link_id in self.dirty_link_ids]
+        client = MongoClient('127.0.0.1', 27017)
+        db = client['traffic']
+        db[LINK_STATS_COLLECTION].bulk_write(operations, ordered=False)
+        client.close()
+        self.dirty_link_ids = set()
+        return len(operations)
+
+    def get(self, link_id):
+        """
+        :return: statistics dict of a link, None if unknown
+        """
+        return self.link_stats.get(link_id)
+
+    def zscore(self, link_id, speed=None, capture_1970=None):
+        """
+        z-score of a speed of a link against its baseline
+        :param link_id: id of the link
+        :param speed: traffic speed, the latest speed of the link by default
+        :param capture_1970: capture time of the speed for the hour-of-week baseline,
+                             the latest capture time by default when the speed is the latest one
+        :return: the z-score, None if no baseline
+        """
+        stats = self.link_stats.get(link_id)
+        if stats is None or stats['count'] == 0:
+            return None
+        if speed is None:
+            speed = stats['last_speed']
+            capture_1970 = stats['last_capture_1970']
+        hour = hour_of_week(capture_1970) if capture_1970 is not None else None
+        return zscore_from_stats(stats, speed, hour, self.min_count)
+
+    def anomalies(self, threshold=2.0):
+        """
+        Links whose latest speed is far from their baseline
+        :param threshold: min absolute z-score
+        :return: list of (link_id, z-score), the most unusual first
+        """
+        result = []
+        for link_id in self.link_stats:
+            z = self.zscore(link_id)
+            if z is not None and abs(z) >= threshold:
+                result.append((link_id, z))
+        return sorted(result, key=lambda x: -abs(x[1]))
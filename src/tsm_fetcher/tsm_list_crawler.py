@@ -0,0 +1,133 @@
+"""
+Crawler of the daily file lists of the historical speedmap archive.
+The list-file-versions api is queried concurrently for the days without a link file.
+A finished past day is saved once as a link file named 'yyyymmdd' and never listed again,
+the current day is saved as 'yyyymmdd.partial' and only its new links are appended on each run.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+import urllib.request
+import json
+import time
+import os
+
+LIST_FILE_API = 'https://api.data.gov.hk/v1/historical-archive/list-file-versions' \
+                '?url=http://resource.data.one.gov.hk/td/speedmap.xml&start={0}&end={0}'
+GET_FILE_API = 'https://api.data.gov.hk/v1/historical-archive/get-file' \
+               '?url=http%3A%2F%2Fresource.data.one.gov.hk%2Ftd%2Fspeedmap.xml&time={0}'
+PARTIAL_SUFFIX = '.partial'
+DATE_FORMAT = "%Y%m%d"
+
+
+class TSMListCrawler:
+
+    def __init__(self, link_folder_path, max_workers=4, timeout=30):
+        """
+        :param link_folder_path: folder of the link files
+        :param max_workers: max number of concurrent api requests
+        :param timeout: timeout of a request in seconds
+        """
+        self.link_folder_path = link_folder_path
+        self.max_workers = max_workers
+        self.timeout = timeout
+        if not os.path.exists(link_folder_path):
+            os.makedirs(link_folder_path)
+
+    def fetch_day_links(self, date_string):
+        """
+        List the xml links of a day
+        :param date_string: date in 'yyyymmdd' format
+        :return: list of xml links, None if the request failed
+        """
+        try:
+            response = urllib.request.urlopen(LIST_FILE_API.format(date_string), timeout=self.timeout)
+            list_file_json = json.loads(response.read())
+        except HTTPError as e:
+            print('HTTPError = ' + str(e.code) + '. Fetch TSM link data error of ' + date_string + '!')
+        except (URLError, OSError) as e:
+            print('URLError = ' + str(getattr(e, 'reason', e)) + '. Fetch TSM link data error of ' + date_string + '!')
+        except ValueError as e:
+            print('JSON error: ' + str(e) + ' of ' + date_string)
+        else:
+            return [GET_FILE_API.format(timestamp) for timestamp in list_file_json['timestamps']]
+        return None
+
+    def write_link_file(self, file_name, links, mode='w'):
+        """
+        Write a link file, one link per line
+        :param file_name: 'yyyymmdd' or 'yyyymmdd.partial'
+        :param links: list of xml links
+        :param mode: 'w' to write a new file, 'a' to append to the file
+        """
+        path = os.path.join(self.link_folder_path, file_name)
+        if mode == 'w':
+            # Write to a temporary file first, a link file is either complete or missing
+            with open(path + '.tmp', 'w') as file_out:
+                file_out.write('\n'.join(links))
+            os.replace(path + '.tmp', path)
+        else:
+            with open(path, 'a') as file_out:
+                for link in links:
+                    file_out.write('\n' + link if file_out.tell() else link)
+
+    def crawl_days(self, date_list):
+        """
+        Save the link files of the past days that are not saved yet
+        :param date_list: list of dates in 'yyyymmdd' format
+        :return: list of the newly saved dates
+        """
+        missing_dates = [d for d in date_list if not os.path.exists(os.path.join(self.link_folder_path, d))]
+        print(str(len(date_list) - len(missing_dates)) + ' days cached, ' + str(len(missing_dates)) + ' days to list.')
+
+        new_date_list = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for date_string, links in zip(missing_dates, executor.map(self.fetch_day_links, missing_dates)):
+                if links is None:
+                    # Failed days are listed again on the next run
+                    continue
+                print('Saving xml links of ' + date_string + ' ...')
+                self.write_link_file(date_string, links)
+                new_date_list.append(date_string)
+                partial_path = os.path.join(self.link_folder_path, date_string + PARTIAL_SUFFIX)
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+        return new_date_list
+
+    def refresh_today(self):
+        """
+        Append the new links of the current day to its partial link file
+        :return: list of the new links
+        """
+        date_string = time.strftime(DATE_FORMAT, time.localtime())
+        file_name = date_string + PARTIAL_SUFFIX
+        path = os.path.join(self.link_folder_path, file_name)
+        known_links = set()
+        if os.path.exists(path):
+            with open(path) as file_in:
+                known_links = set(line.strip() for line in file_in if line.strip())
+
+        links = self.fetch_day_links(date_string)
+        if links is None:
+            return []
+        new_links = [link for link in links if link not in known_links]
+        if len(new_links):
+            self.write_link_file(file_name, new_links, mode='a')
+        return new_links
+
+    def crawl(self, start_date, refresh_today=True):
+        """
+        Save the link files from the start date to yesterday, and refresh the current day
+        :param start_date: start date in 'yyyymmdd' format
+        :param refresh_today: if refresh the partial link file of the current day
+        :return: list of the newly saved past dates
+        """
+        current_time = time.strftime(DATE_FORMAT, time.localtime())
+        start = int(time.mktime(time.strptime(start_date, DATE_FORMAT)))
+        end = int(time.mktime(time.strptime(current_time, DATE_FORMAT)))
+        # End with yesterday
+        date_list = [time.strftime(DATE_FORMAT, time.localtime(i)) for i in range(start, end, 3600 * 24)]
+
+        new_date_list = self.crawl_days(date_list)
+        if refresh_today:
+            print(str(len(self.refresh_today())) + ' new links of ' + current_time)
+        return new_date_list
@@ -1,7 +1,14 @@
 import os
 import time
+import numpy as np
+from multiprocessing import Pool
 from pymongo import MongoClient
 
+from src.tsm_fetcher.tsm_storage import STORAGE_LAYOUTS, DeltaSnapshotWriter, store_bucketed_records
+from src.tsm_fetcher.tsm_schema import to_typed_record
+from src.tsm_fetcher.tsm_sampler import day_slot_times
+from src.tsm_fetcher.tsm_link_cache import get_link_cache
+
 
 class TSMLocalFetcher:
     """
@@ -13,132 +20,306 @@ class TSMLocalFetcher:
     relative_smp_path = '../../../../data/tsm2016/SMP/'
     jtis_folder_path = os.path.join(current_path, relative_jtis_path)
     smp_folder_path = os.path.join(current_path, relative_smp_path)
+    ledger_path = os.path.join(current_path, '../../../../data/tsm2016/.ingest_ledger')
 
-    def __init__(self):
-        pass
+    def __init__(self, storage_layout='document'):
+        """
+        :param storage_layout: 'document', 'bucket' or 'delta', see tsm_storage
+        """
+        assert storage_layout in STORAGE_LAYOUTS
+        self.storage_layout = storage_layout
+        self.delta_writer = DeltaSnapshotWriter() if storage_layout == 'delta' else None
+        self.link_cache = get_link_cache()
 
     def find_link_info(self, road_id_list):
         """
-        Query the region and road_type of the roads from the database
-        :param road_id_list: list of records to be stored
-        :return: A map with all the road
+        Look up the region and road_type of the roads in the link dimension cache
+        :param road_id_list: list of road ids
+        :return: A map with all the road, 'NULL' region and road_type for the unknown roads
         """
-        client = MongoClient('127.0.0.1', 27017)
-        db = client['traffic']
-        collection = db['tsm_link_info']
         all_road_info = {}
         for r_id in road_id_list:
-            record = collection.find_one({'link_id': r_id})
-            if record:
-                road_info = {r_id: {'region': record['road_region'], 'road_type': record['road_type']}}
-                all_road_info.update(road_info)
-            else:
-                road_info = {r_id: {'region': 'NULL', 'road_type': 'NULL'}}
-            all_road_info.update(road_info)
-        client.close()
+            region, road_type = self.link_cache.region_and_type(r_id)
+            all_road_info[r_id] = {'region': region, 'road_type': road_type}
         return all_road_info
 
-    def store_tsm_data(self, records):
+    def store_tsm_data(self, records, source=None):
         """
         Store the records into the database
         :param records: list of records to be stored
+        :param source: source of the records, 'JTIS' or 'SMP' (see csv_source()), the delta layout keeps its
+                       state per source
         """
+        if self.storage_layout == 'bucket':
+            store_bucketed_records(records)
+            return
+        if self.storage_layout == 'delta':
+            # One snapshot for each sampled time
+            snapshots = {}
+            for record in records:
+                snapshots.setdefault(record['capture_date_1970'], []).append(record)
+            for capture_time in sorted(snapshots):
+                self.delta_writer.store(snapshots[capture_time], source)
+            return
         client = MongoClient('127.0.0.1', 27017)
         db = client['traffic']
         collection = db['traffic_speed_map']
-        collection.insert_many(records)
+        # Region and road type are already in the link dimension collection
+        collection.insert_many([to_typed_record(r) for r in records])
         client.close()
 
-    def process_all_csv(self):
+    def list_csv_files(self):
+        """
+        :return: paths of the csv files of the JTIS and SMP folders in capture order,
+                 i.e. sorted by the date ending the file name, then by source
+        """
+        csv_paths = []
+        for folder_path in (self.jtis_folder_path, self.smp_folder_path):
+            for root, dirnames, filenames in os.walk(folder_path):
+                for filename in filenames:
+                    if filename.endswith('.csv'):
+                        csv_paths.append(os.path.join(root, filename))
+        return sorted(csv_paths, key=lambda path: (os.path.basename(path)[-12:-4], os.path.basename(path)))
+
+    def load_ledger(self):
+        """
+        :return: set of (path, size, mtime) of the ingested files
+        """
+        if not os.path.exists(self.ledger_path):
+            return set()
+        entries = set()
+        with open(self.ledger_path) as ledger_in:
+            for line in ledger_in:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3:
+                    entries.add((fields[0], int(fields[1]), int(fields[2])))
+        return entries
+
+    def process_all_csv(self, workers=None, batch_size=50000, slot_minutes=30, tolerance_seconds=None):
         """
-        Process all csv data
+        Process all csv data.
+        The files are parsed by a process pool and stored by a single writer in batches,
+        in capture order across the JTIS and SMP folders (see list_csv_files()).
+        A file is added to the ledger (path, size and mtime) once all its records are stored,
+        files in the ledger are skipped, a changed file is processed again.
+        :param workers: number of parser processes, the number of cores by default, 1 to parse in this process
+        :param batch_size: min number of records of each write
+        :param slot_minutes: sampling interval in minutes, one of 5, 15, 30 and 60
+        :param tolerance_seconds: max gap between a slot and its row, the slot width by default
+        :return: number of processed files
         """
-        for root, dirnames, filenames in os.walk(self.jtis_folder_path):
-            for filename in filenames:
-                self.process_csv(os.path.join(root, filename))
+        ingested = self.load_ledger()
+        pending_files = []
+        for csv_path in self.list_csv_files():
+            file_stat = os.stat(csv_path)
+            key = (os.path.abspath(csv_path), file_stat.st_size, int(file_stat.st_mtime))
+            if key not in ingested:
+                pending_files.append(key)
+        print(str(len(pending_files)) + ' csv files to process, ' + str(len(ingested)) + ' in the ledger.')
+        if len(pending_files) == 0:
+            return 0
+
+        # Loaded before the pool starts, so that the workers inherit it
+        self.link_cache.all()
+        tasks = [(key[0], slot_minutes, tolerance_seconds) for key in pending_files]
+        ledger_folder = os.path.dirname(os.path.abspath(self.ledger_path))
+        if not os.path.exists(ledger_folder):
+            os.makedirs(ledger_folder)
+
+        processed = 0
+        # {source: records} of the files not yet stored
+        record_batches = {}
+        record_count = 0
+        written_files = []
+        pool = Pool(workers) if workers != 1 else None
+        try:
+            results = pool.imap(parse_csv_file, tasks) if pool is not None else map(parse_csv_file, tasks)
+            with open(self.ledger_path, 'a') as ledger_out:
+                for key, file_records in zip(pending_files, results):
+                    if file_records is None:
+                        continue
+                    record_batches.setdefault(csv_source(key[0]), []).extend(file_records)
+                    record_count += len(file_records)
+                    written_files.append(key)
+                    if record_count >= batch_size:
+                        processed += self.flush_records(record_batches, written_files, ledger_out)
+                        record_batches = {}
+                        record_count = 0
+                        written_files = []
+                processed += self.flush_records(record_batches, written_files, ledger_out)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return processed
 
-        for root, dirnames, filenames in os.walk(self.smp_folder_path):
-            for filename in filenames:
-                self.process_csv(os.path.join(root, filename))
+    def flush_records(self, record_batches, written_files, ledger_out):
+        """
+        Store a batch of records and add their files to the ledger
+        :param record_batches: dict of source: records
+        :return: number of the files
+        """
+        record_count = 0
+        for source, record_list in record_batches.items():
+            if len(record_list):
+                self.store_tsm_data(record_list, source)
+                record_count += len(record_list)
+        for path, size, mtime in written_files:
+            ledger_out.write('\t'.join([path, str(size), str(mtime)]) + '\n')
+        ledger_out.flush()
+        if len(written_files):
+            print('Stored ' + str(record_count) + ' records of ' + str(len(written_files)) + ' files')
+        return len(written_files)
 
-    def process_csv(self, csv_path):
+    def parse_csv(self, csv_path, slot_minutes=30, tolerance_seconds=None):
+        """
+        Load a csv file once and pick the closest valid row of every slot, vectorized with numpy
+        :param csv_path: path string of the csv file, the file name ends with the date, e.g. JTIS_20160101.csv
+        :param slot_minutes: sampling interval in minutes, one of 5, 15, 30 and 60
+        :param tolerance_seconds: max gap between a slot and its row, the slot width by default
+        :return: (road_id_list, capture date strings, capture seconds, speed strings, saturation labels, travel strings)
+                 of the sampled rows, the last three are arrays of shape (rows, roads)
+        """
+        date_string = csv_path[-12:-4]
+        seconds_of_current_date = time.mktime(time.strptime(date_string, '%Y%m%d'))
+        with open(csv_path) as file_in:
+            lines = file_in.read().splitlines()
+        col_items = lines[0].rstrip().split(',')[2:]  # Skip 'Date' and 'Time'
+        roads_list = [item_name.split(' ')[1] for item_name in col_items]
+        road_id_list = list(set(roads_list))
+        road_id_list.sort(key=roads_list.index)
+        n_columns = 2 + 3 * len(road_id_list)
+
+        # Rows with a missing value are skipped, only the time column is split before sampling
+        n_commas = n_columns - 1
+        valid_lines = [line for line in (line.rstrip() for line in lines[1:])
+                       if line.count(',') == n_commas and ',,' not in line and line[-1] != ',' and line[0] != ',']
+        time_strings = np.array([line.split(',', 2)[1] for line in valid_lines], dtype=str)
+        time_lengths = np.char.str_len(time_strings)
+        line_index = np.flatnonzero((time_lengths == 8) | (time_lengths == 7))
+        if len(line_index) < len(lines) - 1:
+            print('Skip ' + str(len(lines) - 1 - len(line_index)) + ' invalid rows')
+        if len(line_index) == 0:
+            # No complete row, e.g. a link missing for the whole day
+            no_rows = np.empty((0, len(road_id_list)), dtype=str)
+            return road_id_list, np.empty(0, dtype=str), np.empty(0, dtype=np.float64), no_rows, no_rows, no_rows
+
+        # 'HH:MM:SS' to seconds of the day, 'H:MM:SS' is padded to 'HH:MM:SS' first
+        time_strings = np.char.zfill(time_strings[line_index], 8).astype('U8')
+        digits = time_strings.view('U1').reshape(-1, 8)[:, [0, 1, 3, 4, 6, 7]].astype(np.int64)
+        line_times = seconds_of_current_date + \
+            (digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 2] * 10 + digits[:, 3]) * 60 + \
+            digits[:, 4] * 10 + digits[:, 5]
+        order = np.argsort(line_times, kind='stable')
+        line_times = line_times[order]
+
+        # Closest row of every slot, the earlier row wins a tie
+        if tolerance_seconds is None:
+            tolerance_seconds = slot_minutes * 60
+        slot_times = np.array(day_slot_times(seconds_of_current_date, slot_minutes))
+        positions = np.searchsorted(line_times, slot_times, side='left')
+        before = np.clip(positions - 1, 0, None)
+        after = np.clip(positions, None, len(line_times) - 1)
+        if len(line_times):
+            gap_before = np.where(positions > 0, np.abs(line_times[before] - slot_times), np.inf)
+            gap_after = np.where(positions < len(line_times), np.abs(line_times[after] - slot_times), np.inf)
+        else:
+            gap_before = gap_after = np.full(len(slot_times), np.inf)
+        closest = np.where(gap_before <= gap_after, before, after)
+        selected = closest[np.minimum(gap_before, gap_after) < tolerance_seconds]
+
+        sampled = np.array([valid_lines[i].split(',') for i in line_index[order[selected]]],
+                           dtype=str).reshape(-1, n_columns)
+        capture_dates = np.char.add(np.char.add(sampled[:, 0], ' '), time_strings[order[selected]])
+        speeds = np.round(sampled[:, 2::3].astype(np.float64)).astype(np.int64).astype(str)
+        saturation_flags = sampled[:, 3::3]
+        saturation_levels = np.where(saturation_flags == 'G', 'TRAFFIC GOOD',
+                                     np.where(saturation_flags == 'R', 'TRAFFIC BAD', 'TRAFFIC AVERAGE'))
+        travel_mins = np.char.rstrip(sampled[:, 4::3])
+        return road_id_list, capture_dates, line_times[selected], speeds, saturation_levels, travel_mins
+
+    def iter_csv_records(self, csv_path, slot_minutes=30, tolerance_seconds=None, batch_size=5000):
+        """
+        Records of the sampled rows of a csv file, in batches
+        :param csv_path: path string of the csv file
+        :param slot_minutes: sampling interval in minutes, one of 5, 15, 30 and 60
+        :param tolerance_seconds: max gap between a slot and its row, the slot width by default
+        :param batch_size: max number of records of a batch, a batch holds whole rows
+        :return: a generator of lists of records
+        """
+        road_id_list, capture_dates, capture_seconds, speeds, saturation_levels, travel_mins = \
+            self.parse_csv(csv_path, slot_minutes, tolerance_seconds)
+        all_road_info = self.find_link_info(road_id_list)
+        road_regions = [all_road_info[r_id]['region'] for r_id in road_id_list]
+        road_types = [all_road_info[r_id]['road_type'] for r_id in road_id_list]
+        current_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        seconds_current_time = float(time.mktime(time.strptime(current_time, '%Y-%m-%d %H:%M:%S')))
+
+        record_list = []
+        for row in range(len(capture_dates)):
+            capture_date = str(capture_dates[row])
+            capture_date_1970 = float(capture_seconds[row])
+            for r_index, speed, saturation_level, travel in zip(range(len(road_id_list)), speeds[row].tolist(),
+                                                                saturation_levels[row].tolist(),
+                                                                travel_mins[row].tolist()):
+                record_list.append({'link_id': road_id_list[r_index],
+                                    'region': road_regions[r_index],
+                                    'road_type': road_types[r_index],
+                                    'traffic_speed': speed,
+                                    'road_saturation_level': saturation_level,
+                                    'capture_date': capture_date,
+                                    'fetch_time': current_time,
+                                    'capture_date_1970': capture_date_1970,
+                                    'fetch_time_1970': seconds_current_time,
+                                    'snapshot_time': capture_date_1970,
+                                    'travel_mins': travel})
+            if len(record_list) >= batch_size:
+                yield record_list
+                record_list = []
+        if len(record_list):
+            yield record_list
+
+    def process_csv(self, csv_path, slot_minutes=30, tolerance_seconds=None):
         """
         Process single csv and store into databse
         :param csv_path: path string of the csv file
+        :param slot_minutes: sampling interval in minutes, one of 5, 15, 30 and 60
+        :param tolerance_seconds: max gap between a slot and its row, the slot width by default
         """
-        current_date = time.strptime(csv_path[-12:-4], '%Y%m%d')
-        seconds_of_current_date = time.mktime(current_date)
-        date_format = '%Y-%m-%d %H:%M:%S'
         try:
-            with open(csv_path) as file_in:
-                print('Processing: ' + csv_path)
-                line_list = file_in.readlines()
-                col_items = line_list[0].split(',')[2:]  # Skip 'Date' and 'Time'
-                roads_list = []
-                for item_name in col_items:
-                    roads_list.append(item_name.split(' ')[1])
-                road_id_list = list(set(roads_list))
-                road_id_list.sort(key=roads_list.index)
-                all_road_info = self.find_link_info(road_id_list)
-                record_list = []
-                current_time = time.strftime(date_format, time.localtime())
-                seconds_current_time = float(time.mktime(time.strptime(current_time, date_format)))
-                search_start_index = 0
-                for i in range(0, 49):  # [0, 48]
-                    # Search data for every 30 minutes
-                    seconds_of_each_interval = seconds_of_current_date + i * 30 * 60
-                    if i == 48:
-                        # 23:59
-                        seconds_of_each_interval = seconds_of_current_date + (23 * 60 + 59) * 60
-                    # print(time.strftime(date_format, time.localtime(seconds_of_each_interval)))
-                    smallest_gap = 30 * 60
-                    closest_line = ""
-                    closest_seconds_time = 0.0
-                    for index, line in enumerate(line_list[1:]):
-                        if index >= search_start_index:
-                            line_segments = line.split(',')
-                            if '' in line_segments:
-                                print('Skip invalid data')
-                            else:
-                                date_time_string = csv_path[-12:-4] + ' ' + line_segments[1]
-                                seconds_of_line_time = time.mktime(time.strptime(date_time_string, '%Y%m%d %H:%M:%S'))
-                                # print(seconds_of_line_time)
-                                gap = abs(seconds_of_line_time - seconds_of_each_interval)
-                                if gap < smallest_gap:
-                                    smallest_gap = gap
-                                    search_start_index = index
-                                    closest_line = line
-                                    closest_seconds_time = seconds_of_line_time
-                    # Store into database
-                    if len(closest_line):
-                        line_columns = closest_line.split(',')
-                        column_list = line_columns[2:]
-                        for r_index in range(len(road_id_list)):
-                            if '' in column_list[r_index * 3] or '' in column_list[r_index * 3 + 1]:
-                                # Without speed and saturation level
-                                print('Skip invalid data')
-                            else:
-                                record = {'link_id': road_id_list[r_index],
-                                          'region': all_road_info[road_id_list[r_index]]['region'],
-                                          'road_type': all_road_info[road_id_list[r_index]]['road_type'],
-                                          'traffic_speed': str(round(float(column_list[r_index * 3]))),
-                                          'capture_date': ' '.join(closest_line.split(',')[:2]),
-                                          'fetch_time': current_time,
-                                          'capture_date_1970': closest_seconds_time,
-                                          'fetch_time_1970': seconds_current_time,
-                                          'travel_mins': column_list[r_index * 3 + 2].rstrip()}
-                                if column_list[r_index * 3 + 1] == 'G':
-                                    record['road_saturation_level'] = 'TRAFFIC GOOD'
-                                elif column_list[r_index * 3 + 1] == 'R':
-                                    record['road_saturation_level'] = 'TRAFFIC BAD'
-                                else:
-                                    record['road_saturation_level'] = 'TRAFFIC AVERAGE'
-                                record_list.append(record)
-                self.store_tsm_data(record_list)
+            print('Processing: ' + csv_path)
+            for record_list in self.iter_csv_records(csv_path, slot_minutes, tolerance_seconds):
+                self.store_tsm_data(record_list, csv_source(csv_path))
         except IOError as err:
             print('File error: ' + str(err))
 
 
+def csv_source(csv_path):
+    """
+    :param csv_path: path of a csv file, e.g. .../JTIS_20160101.csv
+    :return: the source of the file, e.g. 'JTIS'
+    """
+    return os.path.basename(csv_path).rsplit('_', 1)[0]
+
+
+def parse_csv_file(task):
+    """
+    Parse a csv file in a worker process
+    :param task: (csv_path, slot_minutes, tolerance_seconds)
+    :return: list of records, None if the file can not be processed
+    """
+    csv_path, slot_minutes, tolerance_seconds = task
+    try:
+        print('Processing: ' + csv_path)
+        records = []
+        for record_list in TSMLocalFetcher().iter_csv_records(csv_path, slot_minutes, tolerance_seconds):
+            records.extend(record_list)
+        return records
+    except (IOError, ValueError, IndexError) as err:
+        print('File error: ' + csv_path + ', ' + str(err))
+        return None
+
+
 if __name__ == '__main__':
     tsm_local = TSMLocalFetcher()
     tsm_local.process_all_csv()
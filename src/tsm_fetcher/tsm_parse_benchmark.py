@@ -0,0 +1,99 @@
+"""
+Benchmark of the speedmap.xml parsers of TSMFetcher on recorded snapshots, before and after the typed stream parser.
+The snapshots are read from a TSMArchiveStore folder or a folder of xml files,
+e.g. the xml files saved by fetch_all_TSM_xml_from_link_file(save_xml=True).
+Before: parse_self_xml() builds string records, converted by to_typed_record() when they are stored.
+After: iter_parse_xml() yields the typed records as it parses.
+Usage: python -m src.tsm_fetcher.tsm_parse_benchmark <archive folder> [repeat] [start yyyymmdd] [end yyyymmdd]
+"""
+import sys
+import time
+
+from src.tsm_fetcher.tsm_fetcher_helper import TSMFetcher, convert_date_string
+from src.tsm_fetcher.tsm_replay import iter_archive
+from src.tsm_fetcher.tsm_schema import to_typed_record
+
+
+def load_snapshots(archive_path, start_day=None, end_day=None):
+    """
+    Read the recorded snapshots into memory, so that only the parsing is timed
+    :param archive_path: TSMArchiveStore folder or folder of xml files (see tsm_replay.iter_archive())
+    :param start_day: first day 'yyyymmdd' (included)
+    :param end_day: last day 'yyyymmdd' (included)
+    :return: list of page bytes
+    """
+    return [page for date_time_string, page in iter_archive(archive_path, start_day, end_day)]
+
+
+def benchmark_parsers(pages, repeat=3):
+    """
+    Parse all the pages with each parser
+    :param pages: list of page bytes
+    :param repeat: number of runs, the best one is reported
+    :return: dict of parser name: {'seconds': best seconds, 'records': number of records}
+    """
+    tsm_fetcher = TSMFetcher()
+
+    def parse_with_pull_parser():
+        count = 0
+        for page in pages:
+            tsm_fetcher.page = page
+            count += len(tsm_fetcher.parse_self_xml())
+        return count
+
+    def parse_and_type_with_pull_parser():
+        count = 0
+        for page in pages:
+            tsm_fetcher.page = page
+            count += len([to_typed_record(r) for r in tsm_fetcher.parse_self_xml()])
+        return count
+
+    def parse_with_stream():
+        count = 0
+        for page in pages:
+            for record in tsm_fetcher.iter_parse_xml(page):
+                count += 1
+        return count
+
+    result = {}
+    for name, parse in [('parse_self_xml', parse_with_pull_parser),
+                        ('parse_self_xml + to_typed_record', parse_and_type_with_pull_parser),
+                        ('iter_parse_xml', parse_with_stream)]:
+        best = None
+        count = 0
+        for i in range(repeat):
+            # Start every run with a cold date cache
+            convert_date_string.cache_clear()
+            start = time.perf_counter()
+            count = parse()
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        result[name] = {'seconds': best, 'records': count}
+    return result
+
+
+def print_benchmark(result, snapshot_count):
+    """
+    :param result: result of benchmark_parsers()
+    :param snapshot_count: number of benchmarked snapshots
+    """
+    for parser_name, parser_result in result.items():
+        print('{:s}: {:.4f}s, {:d} records, {:.2f} ms/snapshot'.format(
+            parser_name, parser_result['seconds'], parser_result['records'],
+            parser_result['seconds'] * 1000 / max(snapshot_count, 1)))
+    after = result['iter_parse_xml']['seconds']
+    for before_name in ('parse_self_xml', 'parse_self_xml + to_typed_record'):
+        before = result[before_name]['seconds']
+        print('Speedup over {:s}: {:.2f}x'.format(before_name, before / after if after else float('inf')))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    repeat_times = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    snapshot_pages = load_snapshots(sys.argv[1], *sys.argv[3:5])
+    print('Snapshots: ' + str(len(snapshot_pages)))
+    if len(snapshot_pages) == 0:
+        sys.exit(1)
+    print_benchmark(benchmark_parsers(snapshot_pages, repeat_times), len(snapshot_pages))
@@ -0,0 +1,152 @@
+"""
+Replay harness of the TSM ingestion, for load testing.
+Archived snapshots are pushed through TSMFetcher.ingest_page(), the same hash/parse/dedupe/store path
+of the live poller, at a speed multiplier of the real time or as fast as possible.
+The archive folder is either a TSMArchiveStore folder or a folder of xml files saved by TSMFetcher.
+The snapshots are stored into the REPLAY_DATABASE database by default, never into the live traffic database.
+Usage: python -m src.tsm_fetcher.tsm_replay <archive folder> [speed, 0 for as fast as possible] [storage layout]
+                                            [database]
+"""
+import time
+import sys
+import os
+
+from src.tsm_fetcher.tsm_fetcher_helper import TSMFetcher
+from src.tsm_fetcher.tsm_archive_store import TSMArchiveStore, INDEX_SUFFIX
+
+REPLAY_SOURCE = 'replay'
+REPLAY_DATABASE = 'traffic_replay'
+STAGES = ('hash', 'parse', 'dedupe', 'store', 'total')
+
+
+def iter_archive(archive_path, start_day=None, end_day=None):
+    """
+    Iterate the snapshots of an archive folder in time order
+    :param archive_path: TSMArchiveStore folder or folder of xml files (e.g. data/full_tsm_xml/)
+    :param start_day: first day 'yyyymmdd' (included)
+    :param end_day: last day 'yyyymmdd' (included)
+    :return: a generator of (date time string, page bytes), date time string example: 20171001-0000
+    """
+    if any(f.endswith(INDEX_SUFFIX) for f in os.listdir(archive_path)):
+        for snapshot in TSMArchiveStore(archive_path).iter_snapshots(start_day, end_day):
+            yield snapshot
+        return
+
+    xml_files = []
+    for root, dirnames, filenames in os.walk(archive_path):
+        for filename in filenames:
+            if filename.endswith('.xml'):
+                # xml filename example: 20171001_0000.xml
+                xml_files.append((filename[:-4].replace('_', '-'), os.path.join(root, filename)))
+    for date_time_string, xml_path in sorted(xml_files):
+        day = date_time_string[:8]
+        if (start_day is not None and day < start_day) or (end_day is not None and day > end_day):
+            continue
+        with open(xml_path, 'rb') as xml_in:
+            yield date_time_string, xml_in.read()
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile
+    :param values: list of numbers
+    :param q: percentile in [0, 100]
+    :return: the percentile, None for an empty list
+    """
+    if len(values) == 0:
+        return None
+    sorted_values = sorted(values)
+    rank = max(int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class TSMReplay:
+
+    def __init__(self, tsm_fetcher=None, source=REPLAY_SOURCE):
+        """
+        :param tsm_fetcher: the TSMFetcher to drive, a new one with the document layout on REPLAY_DATABASE by default
+        :param source: source name of the replay, the payload hash and the watermark are kept apart from the live
+                       poller, and start empty for every run
+        """
+        self.tsm_fetcher = tsm_fetcher if tsm_fetcher is not None else TSMFetcher(database=REPLAY_DATABASE)
+        self.source = source
+
+    def run(self, archive_path, speed=None, start_day=None, end_day=None, limit=None):
+        """
+        Replay the snapshots of an archive
+        :param archive_path: TSMArchiveStore folder or folder of xml files
+        :param speed: multiplier of the real time between the snapshots, None for as fast as possible
+        :param start_day: first day 'yyyymmdd' (included)
+        :param end_day: last day 'yyyymmdd' (included)
+        :param limit: max number of snapshots
+        :return: report dict, see report()
+        """
+        self.tsm_fetcher.watermarks[self.source] = None
+        self.tsm_fetcher.payload_hashes.pop(self.source, None)
+        latencies = dict((stage, []) for stage in STAGES)
+        counts = {'snapshots': 0, 'parsed_records': 0, 'stored_records': 0}
+
+        replay_start = time.perf_counter()
+        first_snapshot_time = None
+        for date_time_string, page in iter_archive(archive_path, start_day, end_day):
+            if limit is not None and counts['snapshots'] >= limit:
+                break
+            if speed:
+                snapshot_time = time.mktime(time.strptime(date_time_string, "%Y%m%d-%H%M"))
+                if first_snapshot_time is None:
+                    first_snapshot_time = snapshot_time
+                wait = (snapshot_time - first_snapshot_time) / speed - (time.perf_counter() - replay_start)
+                if wait > 0:
+                    time.sleep(wait)
+
+            start = time.perf_counter()
+            stored = self.tsm_fetcher.ingest_page(page, self.source, count_poll=False)
+            latencies['total'].append(time.perf_counter() - start)
+            for stage, seconds in self.tsm_fetcher.last_stage_seconds.items():
+                latencies[stage].append(seconds)
+            counts['snapshots'] += 1
+            counts['parsed_records'] += self.tsm_fetcher.last_parsed_count
+            counts['stored_records'] += stored
+
+        return self.report(counts, latencies, time.perf_counter() - replay_start)
+
+    @staticmethod
+    def report(counts, latencies, elapsed_seconds):
+        """
+        :return: dict of the counts, 'elapsed_seconds', 'snapshots_per_second', 'records_per_second' (stored)
+                 and 'latency_ms' {stage: {'p50', 'p90', 'p99', 'max'}}
+        """
+        result = dict(counts)
+        result['elapsed_seconds'] = elapsed_seconds
+        result['snapshots_per_second'] = counts['snapshots'] / elapsed_seconds if elapsed_seconds else 0.0
+        result['records_per_second'] = counts['stored_records'] / elapsed_seconds if elapsed_seconds else 0.0
+        result['latency_ms'] = {}
+        for stage in STAGES:
+            values = [v * 1000 for v in latencies[stage]]
+            result['latency_ms'][stage] = {'p50': percentile(values, 50), 'p90': percentile(values, 90),
+                                           'p99': percentile(values, 99), 'max': max(values) if values else None}
+        return result
+
+
+def print_report(result):
+    print('Snapshots: {:d}, parsed records: {:d}, stored records: {:d}, elapsed: {:.2f}s'.format(
+        result['snapshots'], result['parsed_records'], result['stored_records'], result['elapsed_seconds']))
+    print('Throughput: {:.2f} snapshots/s, {:.1f} records/s'.format(
+        result['snapshots_per_second'], result['records_per_second']))
+    for stage in STAGES:
+        latency = result['latency_ms'][stage]
+        if latency['max'] is None:
+            continue
+        print('{:>7s} latency (ms): p50 {:.2f}, p90 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+            stage, latency['p50'], latency['p90'], latency['p99'], latency['max']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    replay_speed = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    layout = sys.argv[3] if len(sys.argv) > 3 else 'document'
+    replay_database = sys.argv[4] if len(sys.argv) > 4 else REPLAY_DATABASE
+    replay = TSMReplay(TSMFetcher(layout, replay_database))
+    print_report(replay.run(sys.argv[1], replay_speed or None))
@@ -0,0 +1,289 @@
+"""
+Rollup and retention of the traffic speed records (document layout).
+Complete periods are downsampled into one document per link per period and resolution:
+  traffic_speed_rollup_1800 (30 minutes) and traffic_speed_rollup_3600 (hourly)
+  {'link_id', 'period_start', 'count', 'mean', 'min', 'max', 'last', 'last_capture_1970',
+   'saturation_counts': [bad, average, good]}
+Records fetched after their period was rolled up (e.g. imported history) are rolled up on the next run.
+The raw records older than the retention horizon are deleted once they are rolled up,
+the query layer picks the resolution of a time range with choose_resolution().
+Run once: python -m src.tsm_fetcher.tsm_rollup [raw retention days]
+"""
+import sys
+import time
+
+from pymongo import MongoClient, ReplaceOne, ASCENDING
+
+from src.tsm_fetcher.tsm_schema import to_typed_record, TRAFFIC_SPEED_COLLECTION
+
+ROLLUP_RESOLUTIONS = (1800, 3600)
+ROLLUP_COLLECTION_FORMAT = 'traffic_speed_rollup_{:d}'
+ROLLUP_STATE_COLLECTION = 'tsm_rollup_state'
+RAW_RETENTION_SECONDS = 28 * 24 * 3600
+# Periods are rolled up once they ended this long ago, late records are in by then
+ROLLUP_DELAY_SECONDS = 3600
+# Longest range served from the raw records
+RAW_MAX_SPAN_SECONDS = 3 * 24 * 3600
+HOURLY_MIN_SPAN_SECONDS = 30 * 24 * 3600
+
+
+def rollup_collection_name(resolution):
+    return ROLLUP_COLLECTION_FORMAT.format(resolution)
+
+
+def choose_resolution(start_time_second, end_time_second, now=None, raw_retention_seconds=RAW_RETENTION_SECONDS,
+                      max_resolution=None):
+    """
+    Resolution of a query range: the raw records for short recent ranges, 30 minutes up to a month, hourly beyond
+    :param start_time_second: start of the range, seconds since the epoch
+    :param end_time_second: end of the range, seconds since the epoch
+    :param now: current time, time.time() by default
+    :param raw_retention_seconds: age of the oldest raw records
+    :param max_resolution: coarsest wanted resolution in seconds, e.g. the step of a time grid. A range older
+                           than the raw retention still gets the finest rollup, its raw records are deleted
+    :return: 0 for the raw records, otherwise the rollup resolution in seconds
+    """
+    if now is None:
+        now = time.time()
+    span = end_time_second - start_time_second
+    if start_time_second >= now - raw_retention_seconds and span <= RAW_MAX_SPAN_SECONDS:
+        resolution = 0
+    elif span < HOURLY_MIN_SPAN_SECONDS:
+        resolution = ROLLUP_RESOLUTIONS[0]
+    else:
+        resolution = ROLLUP_RESOLUTIONS[-1]
+    if max_resolution is not None and resolution > max_resolution:
+        finer = [r for r in ROLLUP_RESOLUTIONS if r <= max_resolution]
+        if len(finer):
+            resolution = finer[-1]
+        elif start_time_second >= now - raw_retention_seconds:
+            resolution = 0
+        else:
+            resolution = ROLLUP_RESOLUTIONS[0]
+    return resolution
+
+
+def build_rollup_documents(records, resolution):
+    """
+    Aggregate the records by link and period.
+    A link capture repeated by several snapshots (the link was not updated) is counted once.
+    :param records: records of schema 1 or typed, sorted by capture time
+    :param resolution: period length in seconds
+    :return: list of rollup documents
+    """
+    groups = {}
+    for record in records:
+        record = to_typed_record(record)
+        capture = record['capture_date_1970']
+        key = (record['link_id'], capture // resolution * resolution)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'link_id': key[0], 'period_start': key[1], 'count': 0, 'speed_sum': 0.0,
+                                   'min': None, 'max': None, 'last': None, 'last_capture_1970': None,
+                                   'saturation_counts': [0, 0, 0]}
+        if group['last_capture_1970'] == capture:
+            continue
+        speed = record['traffic_speed']
+        group['count'] += 1
+        group['speed_sum'] += speed
+        group['min'] = speed if group['min'] is None else min(group['min'], speed)
+        group['max'] = speed if group['max'] is None else max(group['max'], speed)
+        group['last'] = speed
+        group['last_capture_1970'] = capture
+        if record['road_saturation_level']:
+            group['saturation_counts'][record['road_saturation_level'] - 1] += 1
+
+    documents = []
+    for group in groups.values():
+        group['mean'] = group.pop('speed_sum') / group['count']
+        documents.append(group)
+    return documents
+
+
+def get_rolled_up_to(db, resolution):
+    """
+    :return: end of the rolled up periods of a resolution, None if nothing is rolled up
+    """
+    state = db[ROLLUP_STATE_COLLECTION].find_one({'resolution': resolution})
+    return state.get('rolled_up_to') if state is not None else None
+
+
+def merge_rollup_document(old_document, new_document):
+    """
+    Merge two rollup documents of the same link and period
+    :return: the merged document
+    """
+    count = old_document['count'] + new_document['count']
+    merged = dict(old_document)
+    merged['count'] = count
+    merged['mean'] = (old_document['mean'] * old_document['count'] + new_document['mean'] * new_document['count']) \
+        / count
+    merged['min'] = min(old_document['min'], new_document['min'])
+    merged['max'] = max(old_document['max'], new_document['max'])
+    merged['saturation_counts'] = [a + b for a, b in zip(old_document['saturation_counts'],
+                                                         new_document['saturation_counts'])]
+    if new_document['last_capture_1970'] > old_document['last_capture_1970']:
+        merged['last'] = new_document['last']
+        merged['last_capture_1970'] = new_document['last_capture_1970']
+    return merged
+
+
+def rollup_late_records(db, resolution, fetched_since):
+    """
+    Roll up again the periods that got records after they were rolled up, e.g. history imported later.
+    A period whose raw records rolled up before are still stored is recomputed from the raw records,
+    otherwise (the raw records are deleted) the late records are merged into its rollup document.
+    :param db: the 'traffic' database
+    :param resolution: period length in seconds
+    :param fetched_since: fetch time of the last run, records fetched since then are checked
+    :return: number of written rollup documents
+    """
+    rolled_up_to = get_rolled_up_to(db, resolution)
+    if rolled_up_to is None:
+        return 0
+    collection = db[TRAFFIC_SPEED_COLLECTION]
+    rollup_collection = db[rollup_collection_name(resolution)]
+    late_records = collection.find({'fetch_time_1970': {'$gte': fetched_since},
+                                    'capture_date_1970': {'$lt': rolled_up_to}},
+                                   {'_id': 0, 'link_id': 1, 'capture_date_1970': 1})
+    period_links = {}
+    for record in late_records:
+        period = int(record['capture_date_1970']) // resolution * resolution
+        period_links.setdefault(period, set()).add(record['link_id'])
+
+    written = 0
+    for period in sorted(period_links):
+        link_ids = list(period_links[period])
+        records = list(collection.find({'capture_date_1970': {'$gte': period, '$lt': period + resolution},
+                                        'link_id': {'$in': link_ids}},
+                                       {'_id': 0, 'link_id': 1, 'capture_date_1970': 1, 'fetch_time_1970': 1,
+                                        'traffic_speed': 1, 'road_saturation_level': 1, 'schema_version': 1})
+                       .sort([('capture_date_1970', ASCENDING)]))
+        recomputed_links = set(r['link_id'] for r in records if r['fetch_time_1970'] < fetched_since)
+        old_documents = dict((d['link_id'], d) for d in rollup_collection.find(
+            {'period_start': period, 'link_id': {'$in': link_ids}}, {'_id': 0}))
+        operations = []
+        for document in build_rollup_documents(records, resolution):
+            if document['link_id'] not in recomputed_links and document['link_id'] in old_documents:
+                document = merge_rollup_document(old_documents[document['link_id']], document)
+            operations.append(ReplaceOne({'link_id': document['link_id'], 'period_start': period}, document,
+                                         upsert=True))
+        if len(operations):
+            rollup_collection.bulk_write(operations, ordered=False)
+            written += len(operations)
+    return written
+
+
+def rollup_resolution(db, resolution, until_second, chunk_seconds=24 * 3600):
+    """
+    Roll up the complete periods of a resolution from the last rolled up period to until_second, chunk by chunk
+    :param db: the 'traffic' database
+    :param resolution: period length in seconds
+    :param until_second: end of the periods to roll up, rounded down to the resolution
+    :param chunk_seconds: length of the time range read at once, a multiple of the resolution
+    :return: number of written rollup documents
+    """
+    collection = db[TRAFFIC_SPEED_COLLECTION]
+    rollup_collection = db[rollup_collection_name(resolution)]
+    rollup_collection.create_index([('link_id', ASCENDING), ('period_start', ASCENDING)], unique=True)
+    rollup_collection.create_index([('period_start', ASCENDING)])
+
+    until_second = int(until_second) // resolution * resolution
+    start = get_rolled_up_to(db, resolution) or 0
+
+    written = 0
+    while start < until_second:
+        # Skip the time without records, e.g. before the first record or an outage
+        first = list(collection.find({'capture_date_1970': {'$gte': start, '$lt': until_second}},
+                                     {'capture_date_1970': 1}).sort([('capture_date_1970', ASCENDING)]).limit(1))
+        if len(first) == 0:
+            start = until_second
+            break
+        start = int(first[0]['capture_date_1970']) // resolution * resolution
+        end = min(start + chunk_seconds, until_second)
+        records = collection.find({'capture_date_1970': {'$gte': start, '$lt': end}},
+                                  {'_id': 0, 'link_id': 1, 'capture_date_1970': 1, 'fetch_time_1970': 1,
+                                   'traffic_speed': 1, 'road_saturation_level': 1, 'schema_version': 1}) \
+            .sort([('capture_date_1970', ASCENDING)])
+        documents = build_rollup_documents(records, resolution)
+        if len(documents):
+            rollup_collection.bulk_write([ReplaceOne({'link_id': d['link_id'], 'period_start': d['period_start']},
+                                                     d, upsert=True) for d in documents], ordered=False)
+            written += len(documents)
+        db[ROLLUP_STATE_COLLECTION].update_one({'resolution': resolution}, {'$set': {'rolled_up_to': end}},
+                                               upsert=True)
+        start = end
+    if start > (get_rolled_up_to(db, resolution) or 0):
+        db[ROLLUP_STATE_COLLECTION].update_one({'resolution': resolution}, {'$set': {'rolled_up_to': start}},
+                                               upsert=True)
+    return written
+
+
+def run_rollup(raw_retention_seconds=RAW_RETENTION_SECONDS, compact=False):
+    """
+    Roll up the late records and the new complete periods of every resolution, then delete the raw records
+    that are older than the retention horizon, rolled up at every resolution and fetched before this run
+    :param raw_retention_seconds: age of the raw records to keep
+    :param compact: if run the compact command on the raw collection after deleting
+    :return: (number of written rollup documents, number of deleted raw records)
+    """
+    client = MongoClient('127.0.0.1', 27017)
+    db = client['traffic']
+    db[TRAFFIC_SPEED_COLLECTION].create_index([('capture_date_1970', ASCENDING)])
+    db[TRAFFIC_SPEED_COLLECTION].create_index([('fetch_time_1970', ASCENDING)])
+    now = int(time.time())
+    start = time.time()
+    written = 0
+    for resolution in ROLLUP_RESOLUTIONS:
+        state = db[ROLLUP_STATE_COLLECTION].find_one({'resolution': resolution})
+        if state is not None and state.get('fetched_to') is not None:
+            written += rollup_late_records(db, resolution, state['fetched_to'])
+        written += rollup_resolution(db, resolution, now - ROLLUP_DELAY_SECONDS)
+        db[ROLLUP_STATE_COLLECTION].update_one({'resolution': resolution}, {'$set': {'fetched_to': now}},
+                                               upsert=True)
+
+    rolled_up_to = [get_rolled_up_to(db, resolution) for resolution in ROLLUP_RESOLUTIONS]
+    deleted = 0
+    if None not in rolled_up_to:
+        horizon = min([now - raw_retention_seconds] + rolled_up_to)
+        deleted = db[TRAFFIC_SPEED_COLLECTION].delete_many({'capture_date_1970': {'$lt': horizon},
+                                                            'fetch_time_1970': {'$lt': now}}).deleted_count
+        if compact and deleted:
+            db.command('compact', TRAFFIC_SPEED_COLLECTION)
+    client.close()
+    print('Rollup: ' + str(written) + ' documents written, ' + str(deleted) + ' raw records deleted in '
+          + str(round(time.time() - start)) + 's')
+    return written, deleted
+
+
+def find_rollup_records(db, resolution, start_time_second, end_time_second, link_id=None):
+    """
+    Query the rollup documents of a time range
+    :param db: the 'traffic' database
+    :param resolution: one of ROLLUP_RESOLUTIONS
+    :param start_time_second: start of the range (included), seconds since the epoch
+    :param end_time_second: end of the range (excluded), seconds since the epoch
+    :param link_id: id of a link, all the links by default
+    :return: a cursor of rollup documents sorted by period_start
+    """
+    query = {'period_start': {'$gte': start_time_second // resolution * resolution, '$lt': end_time_second}}
+    if link_id is not None:
+        query['link_id'] = link_id
+    return db[rollup_collection_name(resolution)].find(query, {'_id': 0}).sort([('period_start', ASCENDING)])
+
+
+def rollup_to_record(document):
+    """
+    Record of a rollup document for the readers of the raw records, timed at the start of its period
+    :param document: a rollup document
+    :return: {'link_id', 'capture_date_1970': period_start, 'traffic_speed': mean speed,
+              'road_saturation_level': most frequent int code, 0 if none}
+    """
+    saturation_counts = document['saturation_counts']
+    saturation_level = saturation_counts.index(max(saturation_counts)) + 1 if sum(saturation_counts) else 0
+    return {'link_id': document['link_id'], 'capture_date_1970': document['period_start'],
+            'traffic_speed': document['mean'], 'road_saturation_level': saturation_level}
+
+
+if __name__ == '__main__':
+    run_rollup(float(sys.argv[1]) * 24 * 3600 if len(sys.argv) > 1 else RAW_RETENTION_SECONDS)
@@ -0,0 +1,86 @@
+"""
+Nearest-snapshot sampler of the TSM data.
+The timestamps are parsed once into a sorted list and the snapshot closest to each slot of a day
+is picked with binary search, used by both the archive links and the local csv rows.
+"""
+from bisect import bisect_left
+import time
+
+SLOT_MINUTES = (5, 15, 30, 60)
+
+
+def day_slot_times(seconds_of_date, slot_minutes=30):
+    """
+    Slot times of a day, from 00:00 every slot_minutes, and the last slot at 23:59
+    (49 slots for the 30-minute sampling)
+    :param seconds_of_date: seconds since the epoch of 00:00 of the day
+    :param slot_minutes: slot width in minutes
+    :return: list of seconds since the epoch
+    """
+    assert slot_minutes in SLOT_MINUTES
+    slot_seconds = slot_minutes * 60
+    slot_times = [seconds_of_date + i * slot_seconds for i in range(24 * 3600 // slot_seconds)]
+    slot_times.append(seconds_of_date + (23 * 60 + 59) * 60)
+    return slot_times
+
+
+class NearestSnapshotSampler:
+
+    def __init__(self, times, items):
+        """
+        :param times: seconds since the epoch of each item, not necessarily sorted
+        :param items: the snapshots, e.g. links or csv lines
+        """
+        order = sorted(range(len(times)), key=lambda i: times[i])
+        self.times = [times[i] for i in order]
+        self.items = [items[i] for i in order]
+
+    def nearest(self, target_second, tolerance_seconds):
+        """
+        Index of the snapshot closest to a time, the earlier one wins a tie
+        :param target_second: seconds since the epoch
+        :param tolerance_seconds: the gap must be smaller than the tolerance
+        :return: index in self.times, None if no snapshot is close enough
+        """
+        position = bisect_left(self.times, target_second)
+        best_index = None
+        best_gap = tolerance_seconds
+        for index in (position - 1, position):
+            if 0 <= index < len(self.times):
+                gap = abs(self.times[index] - target_second)
+                if gap < best_gap:
+                    best_gap = gap
+                    best_index = index
+        return best_index
+
+    def sample(self, seconds_of_date, slot_minutes=30, tolerance_seconds=None):
+        """
+        Pick the closest snapshot of each slot of a day
+        :param seconds_of_date: seconds since the epoch of 00:00 of the day
+        :param slot_minutes: slot width in minutes, one of 5, 15, 30 and 60
+        :param tolerance_seconds: max gap between a slot and its snapshot, the slot width by default
+        :return: list of (slot time, snapshot time, item) of the slots with a snapshot
+        """
+        if tolerance_seconds is None:
+            tolerance_seconds = slot_minutes * 60
+        samples = []
+        for slot_time in day_slot_times(seconds_of_date, slot_minutes):
+            index = self.nearest(slot_time, tolerance_seconds)
+            if index is not None:
+                samples.append((slot_time, self.times[index], self.items[index]))
+        return samples
+
+
+def sample_links(link_list, seconds_of_date, slot_minutes=30, tolerance_seconds=None):
+    """
+    Sample the archive links of a day
+    :param link_list: list of (link, date time string) read from a link file, e.g. ('https://...', '20171001-0000')
+    :param seconds_of_date: seconds since the epoch of 00:00 of the day
+    :param slot_minutes: slot width in minutes
+    :param tolerance_seconds: max gap between a slot and its link, the slot width by default
+    :return: list of (link, date time string) of the slots
+    """
+    times = [time.mktime(time.strptime(date_time_string, "%Y%m%d-%H%M")) for link, date_time_string in link_list]
+    sampler = NearestSnapshotSampler(times, link_list)
+    return [item for slot_time, snapshot_time, item in sampler.sample(seconds_of_date, slot_minutes,
+                                                                       tolerance_seconds)]
@@ -0,0 +1,143 @@
+"""
+Adaptive polling scheduler of TSMFetcher.fetch_and_store().
+The publish period is learned from the recent capture times (the ingestion watermark after each new snapshot),
+and the poll is planned just after the expected publish time: the next capture time plus a learned delay.
+When a poll brings nothing new, it retries with an exponential backoff and the delay grows to the observed
+publish time. When the first poll already brings the snapshot, the delay is tightened a little, so that the poll
+keeps approaching the publish time. A snapshot missed in between resets the backoff.
+"""
+from collections import deque
+import threading
+import time
+
+from src.tsm_fetcher.tsm_fetcher_helper import REQUEST_PATH
+
+
+class AdaptivePollScheduler:
+
+    def __init__(self, tsm_fetcher, path=REQUEST_PATH, default_period=120, publish_delay=15, min_retry=5,
+                 tighten_step=2, history=15, min_delay=0, lag_history=720):
+        """
+        :param tsm_fetcher: a TSMFetcher
+        :param path: url of speedmap.xml
+        :param default_period: publish period in seconds before it is learned
+        :param publish_delay: initial delay in seconds between a capture time and its poll
+        :param min_retry: first retry interval in seconds when a poll brings nothing new
+        :param tighten_step: seconds the delay is tightened after a poll that hits at the first try
+        :param history: number of recent capture times used to learn the period
+        :param min_delay: lower bound of the delay in seconds, a snapshot is never polled before its capture time
+        :param lag_history: number of recent snapshots of the freshness lag stats
+        """
+        self.tsm_fetcher = tsm_fetcher
+        self.path = path
+        self.period = default_period
+        self.delay = max(publish_delay, min_delay)
+        self.min_delay = min_delay
+        self.min_retry = min_retry
+        self.tighten_step = tighten_step
+        self.capture_times = deque(maxlen=history)
+        self.retries = 0
+        self.last_poll_time = None
+        self.next_poll = time.time()
+        self.stop_event = threading.Event()
+        self.stats = {'polls': 0, 'empty_polls': 0, 'snapshots': 0, 'missed_snapshots': 0,
+                      'freshness_lags': deque(maxlen=lag_history)}
+
+    def learn_period(self):
+        """
+        The publish period is the median gap of the recent capture times, gaps of missed snapshots are outliers
+        """
+        gaps = sorted(b - a for a, b in zip(self.capture_times, list(self.capture_times)[1:]) if b > a)
+        if len(gaps):
+            self.period = min(max(gaps[len(gaps) // 2], 30), 900)
+
+    def on_poll(self, poll_time, latest_capture):
+        """
+        Update the model with the result of a poll and plan the next one
+        :param poll_time: seconds since the epoch of the poll
+        :param latest_capture: the latest ingested capture time after the poll, None if nothing is ingested
+        :return: seconds since the epoch of the next poll
+        """
+        self.stats['polls'] += 1
+        previous_capture = self.capture_times[-1] if len(self.capture_times) else None
+        if latest_capture is not None and (previous_capture is None or latest_capture > previous_capture):
+            # A new snapshot
+            self.stats['snapshots'] += 1
+            self.stats['freshness_lags'].append(poll_time - latest_capture)
+            if previous_capture is not None and latest_capture - previous_capture > 1.5 * self.period:
+                self.stats['missed_snapshots'] += 1
+            if self.retries == 0:
+                self.delay = max(self.delay - self.tighten_step, self.min_delay)
+            elif self.last_poll_time is not None:
+                # Published between the last empty poll and this one
+                self.delay = max((self.last_poll_time + poll_time) / 2.0 - latest_capture, self.min_delay)
+            self.retries = 0
+            self.capture_times.append(latest_capture)
+            self.learn_period()
+            self.next_poll = latest_capture + self.period + self.delay
+            # Never plan in the past, e.g. after a long outage
+            if self.next_poll <= poll_time:
+                self.next_poll = poll_time + self.min_retry
+        else:
+            self.stats['empty_polls'] += 1
+            self.retries += 1
+            self.next_poll = poll_time + min(self.min_retry * 2 ** (self.retries - 1), self.period / 2.0)
+        self.last_poll_time = poll_time
+        return self.next_poll
+
+    def poll(self):
+        """
+        Poll once and plan the next poll
+        :return: seconds since the epoch of the next poll
+        """
+        poll_time = time.time()
+        self.tsm_fetcher.fetch_and_store(self.path)
+        return self.on_poll(poll_time, self.tsm_fetcher.get_watermark(self.path))
+
+    def run(self, stop_time):
+        """
+        Poll until stop_time seconds have passed or stop() is called
+        :param stop_time: running time in seconds
+        """
+        start_time = time.time()
+        while time.time() - start_time < stop_time and not self.stop_event.is_set():
+            wait = self.next_poll - time.time()
+            if wait > 0:
+                if self.stop_event.wait(min(wait, stop_time - (time.time() - start_time))):
+                    break
+                if time.time() - start_time >= stop_time:
+                    break
+            try:
+                self.poll()
+            except Exception as err:
+                print('Poll error: ' + str(err))
+                self.on_poll(time.time(), None)
+
+    def stop(self):
+        """
+        Stop run() before its next poll, a running poll is finished
+        """
+        self.stop_event.set()
+
+    def get_stats(self):
+        """
+        :return: dict of the counters, the learned 'period' and 'delay', and 'median_freshness_lag' in seconds
+                 of the last lag_history snapshots
+        """
+        stats = dict(self.stats)
+        lags = sorted(stats.pop('freshness_lags'))
+        stats['median_freshness_lag'] = lags[len(lags) // 2] if len(lags) else None
+        stats['period'] = self.period
+        stats['delay'] = self.delay
+        return stats
+
+
+def scheduler_thread(tsm_fetcher, stop_time, **kwargs):
+    """
+    Create a thread that runs an AdaptivePollScheduler, like utils.task_thread()
+    :param tsm_fetcher: a TSMFetcher
+    :param stop_time: running time in seconds
+    :return: the thread and the scheduler
+    """
+    scheduler = AdaptivePollScheduler(tsm_fetcher, **kwargs)
+    return threading.Thread(target=scheduler.run, args=(stop_time,)), scheduler
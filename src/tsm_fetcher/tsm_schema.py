@@ -0,0 +1,135 @@
+"""
+Typed schema (schema_version 2) of the traffic_speed_map records:
+{'link_id': str, 'capture_date_1970': int, 'fetch_time_1970': int, 'traffic_speed': int or float,
+ 'road_saturation_level': int code (see tsm_storage.SATURATION_LEVEL_CODE), 'schema_version': 2}
+Records of the local csv data also keep 'travel_mins' as a float.
+Records also keep 'snapshot_time': int, the latest capture of the page (or csv slot) they were stored with,
+many pages are parsed within the same fetch second and a page spans several capture dates.
+The string dates are dropped, region and road_type are moved to the tsm_link_info dimension collection.
+
+The field names of schema 1 are kept so that the existing indexes and range queries serve both schemas
+while the collection is being migrated.
+Migrate the existing collection: python -m src.tsm_fetcher.tsm_schema [batch_size]
+"""
+import sys
+import time
+
+from pymongo import MongoClient, ReplaceOne, UpdateOne, ASCENDING
+
+from src.tsm_fetcher.tsm_storage import saturation_code
+
+SCHEMA_VERSION = 2
+TRAFFIC_SPEED_COLLECTION = "traffic_speed_map"
+LINK_INFO_COLLECTION = "tsm_link_info"
+
+
+def to_number(value):
+    """
+    Convert a speed string or number to int if it is integral, otherwise float
+    """
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def to_typed_record(record):
+    """
+    Convert a record of schema 1 (as parsed by TSMFetcher) to the typed schema,
+    typed records are returned as they are
+    :param record: a record dict, '_id' is kept if exists
+    :return: a typed record dict
+    """
+    if record.get('schema_version') == SCHEMA_VERSION:
+        return record
+    typed_record = {'link_id': record['link_id'],
+                    'capture_date_1970': int(record['capture_date_1970']),
+                    'fetch_time_1970': int(record['fetch_time_1970']),
+                    'traffic_speed': to_number(record['traffic_speed']),
+                    'road_saturation_level': saturation_code(record['road_saturation_level']),
+                    'schema_version': SCHEMA_VERSION}
+    if '_id' in record:
+        typed_record['_id'] = record['_id']
+    if record.get('travel_mins') not in (None, ''):
+        typed_record['travel_mins'] = float(record['travel_mins'])
+    if record.get('snapshot_time') is not None:
+        typed_record['snapshot_time'] = int(record['snapshot_time'])
+    return typed_record
+
+
+def build_link_info(records):
+    """
+    Link dimension of schema 1 records, the links without a region are skipped
+    :param records: records of schema 1
+    :return: dict of link_id: {'road_region', 'road_type'}
+    """
+    link_info = {}
+    for record in records:
+        region = record.get('region')
+        if region in (None, 'NULL') or record['link_id'] in link_info:
+            continue
+        link_info[record['link_id']] = {'road_region': region, 'road_type': record.get('road_type')}
+    return link_info
+
+
+def build_link_info_operations(link_info):
+    """
+    Upserts of the link dimension, existing link info is never overwritten
+    :param link_info: dict of link_id: {'road_region', 'road_type'}, see build_link_info()
+    :return: list of UpdateOne operations, one for each link
+    """
+    return [UpdateOne({'link_id': link_id}, {'$setOnInsert': info}, upsert=True)
+            for link_id, info in link_info.items()]
+
+
+def upsert_link_info(db, records):
+    """
+    Make sure the links of the records are in the dimension collection
+    :param db: the 'traffic' database
+    :param records: records of schema 1
+    :return: dict of link_id: {'road_region', 'road_type'} of the upserted links, the links without a region
+             are not written
+    """
+    link_info = build_link_info(records)
+    if len(link_info):
+        db[LINK_INFO_COLLECTION].bulk_write(build_link_info_operations(link_info), ordered=False)
+    return link_info
+
+
+def migrate_traffic_speed_map(batch_size=5000):
+    """
+    Rewrite the traffic_speed_map collection to the typed schema in place.
+    Documents are scanned in _id order and replaced in batches, typed documents are skipped,
+    so an interrupted migration can simply be run again.
+    :param batch_size: number of documents of each batch
+    :return: number of migrated documents
+    """
+    client = MongoClient('127.0.0.1', 27017)
+    db = client['traffic']
+    collection = db[TRAFFIC_SPEED_COLLECTION]
+    db[LINK_INFO_COLLECTION].create_index('link_id')
+
+    migrated = 0
+    last_id = None
+    start = time.time()
+    while True:
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        batch = list(collection.find(query).sort([('_id', ASCENDING)]).limit(batch_size))
+        if len(batch) == 0:
+            break
+        last_id = batch[-1]['_id']
+
+        legacy_records = [r for r in batch if r.get('schema_version') != SCHEMA_VERSION]
+        if len(legacy_records) == 0:
+            continue
+        upsert_link_info(db, legacy_records)
+        collection.bulk_write([ReplaceOne({'_id': r['_id']}, to_typed_record(r)) for r in legacy_records],
+                              ordered=False)
+        migrated += len(legacy_records)
+        print('Migrated ' + str(migrated) + ' records in ' + str(round(time.time() - start)) + 's')
+
+    collection.create_index([('link_id', ASCENDING), ('capture_date_1970', ASCENDING)])
+    client.close()
+    return migrated
+
+
+if __name__ == '__main__':
+    migrate_traffic_speed_map(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
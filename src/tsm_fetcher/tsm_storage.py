@@ -0,0 +1,301 @@
+"""
+Storage layouts of the TSM records.
+'document': one document per link per snapshot in traffic_speed_map (default)
+'bucket': one document per link per hour in traffic_speed_map_hourly, holding parallel arrays of
+          capture_date_1970, traffic_speed and road_saturation_level, a capture already in the bucket is not
+          pushed again
+'delta': one document per snapshot and source in traffic_speed_delta, a full keyframe every few snapshots and
+         otherwise only the changes of the links since the previous snapshot of the source
+"""
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+
+TRAFFIC_SPEED_BUCKET_COLLECTION = "traffic_speed_map_hourly"
+TRAFFIC_SPEED_DELTA_COLLECTION = "traffic_speed_delta"
+BUCKET_SECONDS = 3600
+# 30 snapshots of the 2-minute feed, about one keyframe per hour
+KEYFRAME_INTERVAL = 30
+STORAGE_LAYOUTS = ('document', 'bucket', 'delta')
+# Source of the delta documents of the live feed, the documents written without a source belong to it
+LIVE_DELTA_SOURCE = 'live'
+
+SATURATION_LEVEL_CODE = {
+    'TRAFFIC BAD': 1,
+    'TRAFFIC AVERAGE': 2,
+    'TRAFFIC GOOD': 3,
+}
+
+
+def saturation_code(saturation_level):
+    """
+    Convert the saturation level label to a small int code, codes are kept as they are
+    :param saturation_level: e.g. 'TRAFFIC GOOD' or 3
+    :return: 3 for good, 2 for average, 1 for bad, 0 for unknown
+    """
+    if isinstance(saturation_level, int):
+        return saturation_level
+    return SATURATION_LEVEL_CODE.get(saturation_level, 0)
+
+
+def bucket_start(time_second):
+    """
+    Start of the hour bucket of a time
+    :param time_second: seconds since the epoch
+    :return: seconds since the epoch of the bucket start
+    """
+    return int(time_second // BUCKET_SECONDS * BUCKET_SECONDS)
+
+
+def build_bucket_operations(records):
+    """
+    Group the records by link and hour. Each bucket is created by an upsert, then every capture is pushed by an
+    update that only matches while the capture is not in the bucket, so storing the same records again is a no-op.
+    :param records: records in the format of TSMFetcher.parse_self_xml()
+    :return: list of UpdateOne operations, to be written in order
+    """
+    groups = {}
+    for record in sorted(records, key=lambda r: r['capture_date_1970']):
+        key = (record['link_id'], bucket_start(record['capture_date_1970']))
+        if key not in groups:
+            groups[key] = {'region': record.get('region'), 'road_type': record.get('road_type'), 'captures': []}
+        groups[key]['captures'].append((record['capture_date_1970'], float(record['traffic_speed']),
+                                        saturation_code(record['road_saturation_level'])))
+
+    operations = []
+    for (link_id, start), group in groups.items():
+        operations.append(UpdateOne(
+            {'link_id': link_id, 'bucket_start': start},
+            {'$setOnInsert': {'region': group['region'], 'road_type': group['road_type'], 'capture_date_1970': [],
+                              'traffic_speed': [], 'road_saturation_level': [], 'count': 0}},
+            upsert=True))
+        for capture, speed, saturation in group['captures']:
+            operations.append(UpdateOne(
+                {'link_id': link_id, 'bucket_start': start, 'capture_date_1970': {'$ne': capture}},
+                {'$push': {'capture_date_1970': capture, 'traffic_speed': speed, 'road_saturation_level': saturation},
+                 '$inc': {'count': 1}}))
+    return operations
+
+
+def create_bucket_index(collection):
+    """
+    Unique index on link_id and bucket_start, used by both the upserts and the range reads
+    """
+    collection.create_index([('link_id', ASCENDING), ('bucket_start', ASCENDING)], unique=True)
+
+
+def store_bucketed_records(records, database='traffic'):
+    """
+    Store the records into the hourly bucket collection
+    :param records: records in the format of TSMFetcher.parse_self_xml()
+    :param database: database of the bucket collection
+    :return: number of pushed captures
+    """
+    operations = build_bucket_operations(records)
+    if len(operations) == 0:
+        return 0
+
+    client = MongoClient('127.0.0.1', 27017)
+    db = client[database]
+    collection = db[TRAFFIC_SPEED_BUCKET_COLLECTION]
+    create_bucket_index(collection)
+    # In order, a bucket is created before its captures are pushed
+    result = collection.bulk_write(operations, ordered=True)
+    client.close()
+    return result.modified_count
+
+
+def flatten_link_buckets(buckets, start_time_second=None, end_time_second=None):
+    """
+    Unfold bucket documents to records sorted by capture time
+    :param buckets: bucket documents of links
+    :param start_time_second: keep records captured at or after this time
+    :param end_time_second: keep records captured before this time
+    :return: list of dicts with link_id, region, road_type, capture_date_1970, traffic_speed
+             and road_saturation_level (int code)
+    """
+    records = []
+    for bucket in buckets:
+        for capture, speed, saturation in zip(bucket['capture_date_1970'], bucket['traffic_speed'],
+                                              bucket['road_saturation_level']):
+            if start_time_second is not None and capture < start_time_second:
+                continue
+            if end_time_second is not None and capture >= end_time_second:
+                continue
+            records.append({'link_id': bucket['link_id'], 'region': bucket.get('region'),
+                            'road_type': bucket.get('road_type'), 'capture_date_1970': capture,
+                            'traffic_speed': speed, 'road_saturation_level': saturation})
+    records.sort(key=lambda r: r['capture_date_1970'])
+    return records
+
+
+def find_link_buckets(db, link_id, start_time_second=None, end_time_second=None):
+    """
+    Query the records of a link in a time range from the bucket collection
+    :param db: the 'traffic' database
+    :param link_id: string of two indexes (example: "3006-30069")
+    :param start_time_second: start of the range (included), seconds since the epoch
+    :param end_time_second: end of the range (excluded), seconds since the epoch
+    :return: list of records sorted by capture time
+    """
+    query = {'link_id': link_id}
+    if start_time_second is not None or end_time_second is not None:
+        query['bucket_start'] = {}
+        if start_time_second is not None:
+            query['bucket_start']['$gte'] = bucket_start(start_time_second)
+        if end_time_second is not None:
+            query['bucket_start']['$lt'] = end_time_second
+    buckets = db[TRAFFIC_SPEED_BUCKET_COLLECTION].find(query).sort([('bucket_start', ASCENDING)])
+    return flatten_link_buckets(buckets, start_time_second, end_time_second)
+
+
+class DeltaSnapshotWriter:
+    """
+    Writer of the delta layout.
+    It keeps the link state of the last written snapshot of each source (the live feed, JTIS, SMP), as the sources
+    cover different links. A snapshot is stored as a keyframe with all the links of its source every
+    keyframe_interval snapshots of the source, otherwise only the changes are stored.
+    Document: {'source', 'snapshot_time': latest capture of the snapshot, 'keyframe': bool,
+               'keyframe_time': snapshot_time of the keyframe the delta builds on,
+               'links': [[link_id, traffic_speed, road_saturation_level code, capture_date_1970], ...]
+                        of the new links and the links whose speed or saturation changed,
+               'captures': [[capture_date_1970, [link_id, ...]], ...] of the other links captured again,
+               'removed': [link_id, ...] of the links missing from the snapshot}
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, database='traffic'):
+        self.keyframe_interval = keyframe_interval
+        self.database = database
+        # {source: {'state': {link_id: [traffic_speed, road_saturation_level, capture_date_1970]},
+        #           'keyframe_time', 'snapshot_count'}}
+        self.sources = {}
+
+    def build_document(self, records, source=LIVE_DELTA_SOURCE):
+        """
+        Build the document of a snapshot and move the writer state of its source forward
+        :param records: records of one snapshot in the format of TSMFetcher.parse_self_xml()
+        :param source: source of the snapshot
+        :return: the document to be stored, None if there is no record
+        """
+        if len(records) == 0:
+            return None
+        current = {}
+        for record in records:
+            current[record['link_id']] = [float(record['traffic_speed']),
+                                          saturation_code(record['road_saturation_level']),
+                                          record['capture_date_1970']]
+        snapshot_time = max(link[2] for link in current.values())
+
+        writer = self.sources.get(source)
+        document = {'source': source, 'snapshot_time': snapshot_time}
+        if writer is None or writer['snapshot_count'] % self.keyframe_interval == 0:
+            if writer is None:
+                writer = self.sources[source] = {'snapshot_count': 0}
+            writer['keyframe_time'] = snapshot_time
+            document['keyframe'] = True
+            document['links'] = [[link_id] + value for link_id, value in current.items()]
+        else:
+            state = writer['state']
+            links = []
+            captures = {}
+            for link_id, value in current.items():
+                previous = state.get(link_id)
+                if previous is None or previous[0] != value[0] or previous[1] != value[1]:
+                    links.append([link_id] + value)
+                elif previous[2] != value[2]:
+                    captures.setdefault(value[2], []).append(link_id)
+            document['keyframe'] = False
+            document['links'] = links
+            document['captures'] = [[capture, link_ids] for capture, link_ids in sorted(captures.items())]
+            document['removed'] = [link_id for link_id in state if link_id not in current]
+        # The state of the source is the snapshot, the capture times included
+        writer['state'] = current
+        writer['snapshot_count'] += 1
+        document['keyframe_time'] = writer['keyframe_time']
+        return document
+
+    def store(self, records, source=LIVE_DELTA_SOURCE):
+        """
+        Store a snapshot into the delta collection
+        :param records: records of one snapshot
+        :param source: source of the snapshot
+        :return: the stored document
+        """
+        document = self.build_document(records, source)
+        if document is None:
+            return None
+
+        client = MongoClient('127.0.0.1', 27017)
+        db = client[self.database]
+        collection = db[TRAFFIC_SPEED_DELTA_COLLECTION]
+        collection.create_index([('source', ASCENDING), ('snapshot_time', ASCENDING)])
+        collection.insert_one(document)
+        client.close()
+        return document
+
+
+def source_query(source):
+    # The documents written before the sources were kept belong to the live feed
+    if source == LIVE_DELTA_SOURCE:
+        return {'$in': [LIVE_DELTA_SOURCE, None]}
+    return source
+
+
+def reconstruct_source_state(collection, source, time_second):
+    """
+    Rebuild the link state of a source from its latest keyframe before the time and the deltas after it
+    :return: (snapshot_time, {link_id: {'traffic_speed', 'road_saturation_level', 'capture_date_1970'}}),
+             (None, {}) if the source has no snapshot before the time
+    """
+    latest = list(collection.find({'source': source_query(source), 'snapshot_time': {'$lt': time_second}},
+                                  {'keyframe_time': 1, 'snapshot_time': 1})
+                  .sort([('snapshot_time', DESCENDING)]).limit(1))
+    if len(latest) == 0:
+        return None, {}
+
+    state = {}
+    documents = collection.find({'source': source_query(source),
+                                 'snapshot_time': {'$gte': latest[0]['keyframe_time'],
+                                                   '$lte': latest[0]['snapshot_time']}}) \
+        .sort([('snapshot_time', ASCENDING)])
+    for document in documents:
+        if document['keyframe']:
+            state = {}
+        for link_id in document.get('removed', []):
+            state.pop(link_id, None)
+        for capture, link_ids in document.get('captures', []):
+            for link_id in link_ids:
+                if link_id in state:
+                    state[link_id]['capture_date_1970'] = capture
+        for link_id, speed, saturation, capture in document['links']:
+            state[link_id] = {'traffic_speed': speed, 'road_saturation_level': saturation,
+                              'capture_date_1970': capture}
+    return latest[0]['snapshot_time'], state
+
+
+def reconstruct_snapshot_state(db, time_second, source=None):
+    """
+    Rebuild the full link state of the delta layout at a time, source by source
+    :param db: the 'traffic' database
+    :param time_second: seconds since the epoch, snapshots captured before this time are applied
+    :param source: a single source, all the sources by default (the latest capture of a link wins)
+    :return: (snapshot_time, {link_id: {'traffic_speed', 'road_saturation_level', 'capture_date_1970'}}),
+             (None, {}) if there is no snapshot before the time
+    """
+    collection = db[TRAFFIC_SPEED_DELTA_COLLECTION]
+    if source is None:
+        sources = set(collection.distinct('source', {'snapshot_time': {'$lt': time_second}}))
+        sources.discard(None)
+        sources.add(LIVE_DELTA_SOURCE)
+    else:
+        sources = [source]
+
+    snapshot_time = None
+    state = {}
+    for source in sources:
+        source_time, source_state = reconstruct_source_state(collection, source, time_second)
+        if source_time is None:
+            continue
+        snapshot_time = source_time if snapshot_time is None else max(snapshot_time, source_time)
+        for link_id, link_state in source_state.items():
+            if link_id not in state or link_state['capture_date_1970'] > state[link_id]['capture_date_1970']:
+                state[link_id] = link_state
+    return snapshot_time, state
@@ -7,6 +7,7 @@ import json
 import codecs
 import urllib
 import time
+import math
 import threading
 from urllib import request, error
 from urllib.error import HTTPError, URLError
@@ -106,12 +107,18 @@ def task_thread(func, sleep_time, stop_time, args = None):
         i = 0
         while(time.time() - start_time < stop_time):
             i += 1
-            if args == None:
-                func()
-            else:
-                func(args)
+            try:
+                if args == None:
+                    func()
+                else:
+                    func(args)
+            except Exception as err:
+                # An error of one run does not end the task
+                _logger.error('Task error: ' + repr(err))
+            # Skip the periods missed by a run longer than sleep_time
+            i = max(i, int(math.ceil((time.time() - start_time) / sleep_time)))
             # For more accurate period control when time length is too large
-            time.sleep(sleep_time*i + start_time - time.time())
+            time.sleep(max(0, sleep_time*i + start_time - time.time()))
         return 0
     return threading.Thread(target=task, args=(func, args))
 
@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+
+import struct
+import unittest
+
+import psycopg2
+
+from src.query.preprocess import linestring_ewkb_hex, iter_osm_link_copy_rows, copy_rows_in_chunks, \
+    load_hk_osm_link_postgis_database
+
+TEST_TABLE = 'test_hk_osm_link'
+OSM_LINKS = [
+    {'id': '722-50059', 'path': [{'id': '1', 'coordinates': [114.1694, 22.3193]},
+                                 {'id': '2', 'coordinates': [114.1702, 22.3201]},
+                                 {'id': '3', 'coordinates': [114.1715, 22.3206]}]},
+    {'id': '724-722', 'path': [{'id': '4', 'coordinates': [114.2001, 22.2802]},
+                               {'id': '5', 'coordinates': [114.2013, 22.2811]}]},
+]
+
+
+def connect_postgis():
+    """
+    :return: a connection to the local gis database with PostGIS, None if not available
+    """
+    try:
+        connection = psycopg2.connect(dbname='gis', host='127.0.0.1', port='5432', user='postgres',
+                                      password='manage', connect_timeout=3)
+    except psycopg2.OperationalError:
+        return None
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT PostGIS_Version()')
+        cursor.close()
+    except psycopg2.DatabaseError:
+        connection.close()
+        return None
+    return connection
+
+
+class RecordingCursor:
+    """
+    Cursor keeping the text of every COPY
+    """
+
+    def __init__(self):
+        self.copies = []
+
+    def copy_expert(self, sql, buffer):
+        self.copies.append((sql, buffer.read()))
+
+
+class CopyRowsTestCase(unittest.TestCase):
+    def test_ewkb_hex(self):
+        # SELECT encode(ST_AsEWKB(ST_GeomFromText('LINESTRING(0 0, 1 1)', 4326)), 'hex')
+        self.assertEqual(linestring_ewkb_hex(0, 0, 1, 1),
+                         '0102000020E610000002000000000000000000000000000000000000000000000000'
+                         '00F03F000000000000F03F')
+
+    def test_ewkb_round_trip(self):
+        ewkb = bytes.fromhex(linestring_ewkb_hex('114.1694', '22.3193', '114.1702', '22.3201'))
+        self.assertEqual(struct.unpack('<BIIIdddd', ewkb), (1, 0x20000002, 4326, 2, 114.1694, 22.3193,
+                                                            114.1702, 22.3201))
+
+    def test_copy_rows(self):
+        rows = list(iter_osm_link_copy_rows(OSM_LINKS + [{'id': 'a\tb', 'path': OSM_LINKS[1]['path']}]))
+        self.assertEqual(len(rows), 4)
+        fields = rows[0][:-1].split('\t')
+        self.assertEqual(fields[:6], ['1-2', '722-50059', '114.1694', '22.3193', '114.1702', '22.3201'])
+        self.assertEqual(fields[6], linestring_ewkb_hex(114.1694, 22.3193, 114.1702, 22.3201))
+        # The tab of the id is escaped, not a field separator
+        self.assertEqual(rows[3].split('\t')[:2], ['4-5', 'a\\tb'])
+
+    def test_copy_in_chunks(self):
+        cursor = RecordingCursor()
+        rows = ['%d\n' % i for i in range(5)]
+        self.assertEqual(copy_rows_in_chunks(cursor, TEST_TABLE, rows, chunk_size=2), 5)
+        self.assertEqual([text for sql, text in cursor.copies], ['0\n1\n', '2\n3\n', '4\n'])
+        self.assertTrue(cursor.copies[0][0].startswith('COPY ' + TEST_TABLE + ' ('))
+
+
+class PostGISCopyTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = connect_postgis()
+        if cls.connection is None:
+            raise unittest.SkipTest('no local PostgreSQL with PostGIS')
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = cls.connection.cursor()
+        cursor.execute('DROP TABLE IF EXISTS ' + TEST_TABLE + '; DROP TABLE IF EXISTS ' + TEST_TABLE + '_staging;')
+        cls.connection.commit()
+        cls.connection.close()
+
+    def test_load_and_swap(self):
+        self.assertEqual(load_hk_osm_link_postgis_database(OSM_LINKS, chunk_size=2, table=TEST_TABLE), 3)
+        # Reloading swaps in a new table
+        self.assertEqual(load_hk_osm_link_postgis_database(OSM_LINKS[:1], table=TEST_TABLE), 2)
+
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT link_id, parent_id, ST_AsText(link), ST_SRID(link) FROM ' + TEST_TABLE +
+                       ' ORDER BY link_id')
+        self.assertEqual(cursor.fetchall(),
+                         [('1-2', '722-50059', 'LINESTRING(114.1694 22.3193,114.1702 22.3201)', 4326),
+                          ('2-3', '722-50059', 'LINESTRING(114.1702 22.3201,114.1715 22.3206)', 4326)])
+        cursor.execute('SELECT to_regclass(%s), to_regclass(%s), to_regclass(%s)',
+                       (TEST_TABLE + '_staging', TEST_TABLE + '_index', TEST_TABLE + '_staging_index'))
+        self.assertEqual(cursor.fetchone(), (None, TEST_TABLE + '_index', None))
+        cursor.close()
+        self.connection.commit()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from src.tsm_fetcher.tsm_archive_downloader import TSMArchiveDownloader
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """
+    /page/<name>: 200 with the body <name>
+    /redirect/<name>: 302 to /page/<name>
+    /missing: 404
+    /flaky/<name>: 500 for the first two requests of the name, then 200
+    /drop/<name>: 200, then the keep-alive connection is closed without notice
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    flaky_counts = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        ArchiveHandler.requests.append(self.path)
+        kind, name = (self.path.strip('/').split('/', 1) + [''])[:2]
+        if kind == 'page':
+            self.send_body(200, name.encode())
+        elif kind == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', '/page/' + name)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif kind == 'flaky':
+            count = ArchiveHandler.flaky_counts[name] = ArchiveHandler.flaky_counts.get(name, 0) + 1
+            self.send_body(500 if count <= 2 else 200, name.encode())
+        elif kind == 'drop':
+            self.send_body(200, name.encode())
+            self.close_connection = True
+        else:
+            self.send_body(404)
+
+
+class TSMArchiveDownloaderTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        cls.base_url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        ArchiveHandler.requests = []
+        ArchiveHandler.flaky_counts = {}
+        self.folder = tempfile.mkdtemp()
+        self.ledger_path = os.path.join(self.folder, '.ledger')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def downloader(self, **kwargs):
+        downloader = TSMArchiveDownloader(self.ledger_path, workers=kwargs.pop('workers', 2), backoff_seconds=0,
+                                          timeout=5, **kwargs)
+        self.addCleanup(downloader.close)
+        return downloader
+
+    def test_fetch(self):
+        downloader = self.downloader()
+        self.assertEqual(downloader.fetch(self.base_url + '/page/20180501-0000'), b'20180501-0000')
+        self.assertEqual(downloader.fetch(self.base_url + '/redirect/20180501-0002'), b'20180501-0002')
+
+    def test_client_error_not_retried(self):
+        self.assertIsNone(self.downloader().fetch(self.base_url + '/missing'))
+        self.assertEqual(ArchiveHandler.requests, ['/missing'])
+
+    def test_retries(self):
+        self.assertEqual(self.downloader(retries=2).fetch(self.base_url + '/flaky/a'), b'a')
+        self.assertIsNone(self.downloader(retries=1).fetch(self.base_url + '/flaky/b'))
+
+    def test_reconnect_closed_connection(self):
+        # No retry, the closed keep-alive connection is reopened without using an attempt
+        downloader = self.downloader(retries=0)
+        self.assertEqual(downloader.fetch(self.base_url + '/drop/a'), b'a')
+        time.sleep(0.1)
+        self.assertEqual(downloader.fetch(self.base_url + '/drop/b'), b'b')
+        self.assertEqual(ArchiveHandler.requests, ['/drop/a', '/drop/b'])
+
+    def test_download_order_and_ledger(self):
+        urls = [self.base_url + '/page/%d' % i for i in range(10)] + [self.base_url + '/missing']
+        handled = []
+        stats = self.downloader(workers=4, retries=0, max_pending=3).download(
+            urls, lambda url, page: handled.append(page))
+        self.assertEqual(handled, [str(i).encode() for i in range(10)])
+        self.assertEqual(stats, {'handled': 10, 'skipped': 0, 'failed': 1})
+        with open(self.ledger_path) as ledger_in:
+            self.assertEqual(ledger_in.read().split(), urls[:10])
+
+        # Handled urls are skipped by the next run
+        stats = self.downloader(retries=0).download(urls, lambda url, page: handled.append(page))
+        self.assertEqual(stats, {'handled': 0, 'skipped': 10, 'failed': 1})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.tsm_fetcher.tsm_local_fetcher import TSMLocalFetcher
+
+HEADER = 'Date,Time,Speed 722-50059,Saturation 722-50059,Travel 722-50059,Speed 724-722,Saturation 724-722,' \
+         'Travel 724-722'
+
+
+class ParseCsvTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.folder, 'JTIS_20160101.csv')
+        self.tsm_local = TSMLocalFetcher()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def parse(self, lines, tolerance_seconds=None):
+        with open(self.csv_path, 'w') as csv_out:
+            csv_out.write('\n'.join(lines) + '\n')
+        return self.tsm_local.parse_csv(self.csv_path, tolerance_seconds=tolerance_seconds)
+
+    def assert_no_rows(self, result):
+        road_id_list, capture_dates, capture_seconds, speeds, saturation_levels, travel_mins = result
+        self.assertEqual(road_id_list, ['722-50059', '724-722'])
+        self.assertEqual(len(capture_dates), 0)
+        self.assertEqual(len(capture_seconds), 0)
+        for values in (speeds, saturation_levels, travel_mins):
+            self.assertEqual(values.shape, (0, 2))
+
+    def test_rows(self):
+        road_id_list, capture_dates, capture_seconds, speeds, saturation_levels, travel_mins = self.parse([
+            HEADER,
+            '2016-01-01,0:00:10,45.4,G,1.2,30,R,2.5',
+            '2016-01-01,00:30:20,50,A,1.1,31,G,2.4'], tolerance_seconds=60)
+        self.assertEqual(capture_dates.tolist(), ['2016-01-01 00:00:10', '2016-01-01 00:30:20'])
+        self.assertEqual(capture_seconds[1] - capture_seconds[0], 1810)
+        self.assertEqual(speeds.tolist(), [['45', '30'], ['50', '31']])
+        self.assertEqual(saturation_levels[0].tolist(), ['TRAFFIC GOOD', 'TRAFFIC BAD'])
+        self.assertEqual(travel_mins[1].tolist(), ['1.1', '2.4'])
+
+    def test_header_only(self):
+        self.assert_no_rows(self.parse([HEADER]))
+
+    def test_all_rows_invalid(self):
+        # One link is missing for the whole day
+        self.assert_no_rows(self.parse([HEADER,
+                                        '2016-01-01,00:00:10,45,G,1.2,,,',
+                                        '2016-01-01,00:30:20,50,A,1.1,,,',
+                                        '2016-01-01,not a time,50,A,1.1,31,G,2.4']))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
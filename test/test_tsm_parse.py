@@ -0,0 +1,83 @@
+# -*- coding:utf-8 -*-
+
+import inspect
+import unittest
+
+from src.tsm_fetcher.tsm_fetcher_helper import TSMFetcher, convert_date_string
+
+SPEEDMAP_ENTITY = '<jtis_speedmap><LINK_ID>{}</LINK_ID><REGION>K</REGION><ROAD_TYPE>URBAN ROAD</ROAD_TYPE>' \
+                  '<ROAD_SATURATION_LEVEL>{}</ROAD_SATURATION_LEVEL><TRAFFIC_SPEED>{}</TRAFFIC_SPEED>' \
+                  '<CAPTURE_DATE>{}</CAPTURE_DATE></jtis_speedmap>'
+CAPTURE_DATES = ('2018-05-01T00:00:10', '2018-05-01T00:00:50', '2018-05-01T00:01:30')
+SATURATION_LEVELS = ('TRAFFIC BAD', 'TRAFFIC AVERAGE', 'TRAFFIC GOOD')
+
+
+def speedmap_page(entities):
+    return ('<?xml version="1.0" encoding="UTF-8"?><jtis_speedlist xmlns="http://data.one.gov.hk/td">' +
+            ''.join(entities) + '</jtis_speedlist>').encode('utf-8')
+
+
+def snapshot_page(link_count=600):
+    """
+    :return: page bytes of a snapshot with a few distinct capture dates, like speedmap.xml
+    """
+    return speedmap_page(SPEEDMAP_ENTITY.format('%d-%d' % (i, i + 1), SATURATION_LEVELS[i % 3], 20 + i % 60,
+                                                CAPTURE_DATES[i % 3]) for i in range(link_count))
+
+
+class TSMParseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tsm_fetcher = TSMFetcher()
+
+    def test_typed_records(self):
+        records = list(self.tsm_fetcher.iter_parse_xml(speedmap_page([
+            SPEEDMAP_ENTITY.format('722-50059', 'TRAFFIC GOOD', '84', '2018-05-01T00:00:50'),
+            SPEEDMAP_ENTITY.format('724-722', 'TRAFFIC BAD', '12.5', '2018-05-01T00:00:10')])))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['link_id'], '722-50059')
+        self.assertEqual(records[0]['region'], 'K')
+        self.assertEqual(records[0]['road_type'], 'URBAN ROAD')
+        self.assertEqual(records[0]['road_saturation_level'], 3)
+        self.assertEqual(records[0]['traffic_speed'], 84)
+        self.assertIsInstance(records[0]['traffic_speed'], int)
+        self.assertEqual(records[1]['traffic_speed'], 12.5)
+        self.assertEqual(records[1]['road_saturation_level'], 1)
+        self.assertIsInstance(records[0]['capture_date_1970'], int)
+        self.assertEqual(records[0]['capture_date_1970'] - records[1]['capture_date_1970'], 40)
+        self.assertIsInstance(records[0]['fetch_time_1970'], int)
+
+    def test_invalid_records(self):
+        records = list(self.tsm_fetcher.iter_parse_xml(speedmap_page([
+            '<jtis_speedmap><LINK_ID>722-50059</LINK_ID></jtis_speedmap>',
+            SPEEDMAP_ENTITY.format('724-722', 'TRAFFIC BAD', '', '2018-05-01T00:00:10'),
+            SPEEDMAP_ENTITY.format('752-875', 'TRAFFIC BAD', '40', 'not a date'),
+            SPEEDMAP_ENTITY.format('875-752', 'TRAFFIC GOOD', '60', '2018-05-01T00:00:10')])))
+        self.assertEqual([r['link_id'] for r in records], ['875-752'])
+
+    def test_syntax_error(self):
+        self.assertEqual(list(self.tsm_fetcher.iter_parse_xml(b'<jtis_speedlist><jtis_speedmap>')), [])
+
+    def test_streaming(self):
+        records = self.tsm_fetcher.iter_parse_xml(snapshot_page())
+        self.assertTrue(inspect.isgenerator(records))
+        self.assertEqual(next(records)['link_id'], '0-1')
+        self.assertEqual(len(list(records)), 599)
+        self.assertGreater(self.tsm_fetcher.last_parse_seconds, 0)
+
+    def test_memoized_capture_dates(self):
+        convert_date_string.cache_clear()
+        records = list(self.tsm_fetcher.iter_parse_xml(snapshot_page()))
+        self.assertEqual(len(records), 600)
+        self.assertEqual(convert_date_string.cache_info().misses, len(CAPTURE_DATES))
+
+    def test_same_as_pull_parser(self):
+        page = snapshot_page()
+        self.tsm_fetcher.page = page
+        pulled = self.tsm_fetcher.parse_self_xml()
+        streamed = list(self.tsm_fetcher.iter_parse_xml(page))
+        self.assertEqual([(r['link_id'], int(r['capture_date_1970']), float(r['traffic_speed'])) for r in pulled],
+                         [(r['link_id'], r['capture_date_1970'], float(r['traffic_speed'])) for r in streamed])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
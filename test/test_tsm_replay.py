@@ -0,0 +1,86 @@
+# -*- coding:utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from src.tsm_fetcher import tsm_fetcher_helper, tsm_link_cache, tsm_storage
+from src.tsm_fetcher.tsm_replay import TSMReplay, REPLAY_DATABASE
+
+SPEEDMAP_ENTITY = '<jtis_speedmap><LINK_ID>{}</LINK_ID><REGION>HK</REGION><ROAD_TYPE>MAJOR ROUTE</ROAD_TYPE>' \
+                  '<ROAD_SATURATION_LEVEL>TRAFFIC GOOD</ROAD_SATURATION_LEVEL><TRAFFIC_SPEED>{}</TRAFFIC_SPEED>' \
+                  '<CAPTURE_DATE>{}</CAPTURE_DATE></jtis_speedmap>'
+
+
+def speedmap_page(capture_date, speeds):
+    """
+    :param capture_date: capture date of all the links, e.g. 2018-05-01T00:00:50
+    :param speeds: dict of link_id: traffic speed
+    :return: page bytes in the format of speedmap.xml
+    """
+    entities = ''.join(SPEEDMAP_ENTITY.format(link_id, speed, capture_date) for link_id, speed in speeds.items())
+    return ('<?xml version="1.0" encoding="UTF-8"?><jtis_speedlist xmlns="http://data.one.gov.hk/td">' +
+            entities + '</jtis_speedlist>').encode('utf-8')
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class TSMReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        client = mongomock.MongoClient()
+        self.client = client
+
+        class MongoStandIn:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def __getitem__(self, name):
+                return client[name]
+
+            def close(self):
+                pass
+
+        self.modules = (tsm_fetcher_helper, tsm_link_cache, tsm_storage)
+        self.mongo_clients = [module.MongoClient for module in self.modules]
+        for module in self.modules:
+            module.MongoClient = MongoStandIn
+
+        self.archive_path = tempfile.mkdtemp()
+        pages = [('20180501_0000.xml', speedmap_page('2018-05-01T00:00:50', {'722-50059': 84, '724-722': 87})),
+                 ('20180501_0002.xml', speedmap_page('2018-05-01T00:02:50', {'722-50059': 80, '724-722': 87})),
+                 # Same payload as the snapshot before
+                 ('20180501_0004.xml', speedmap_page('2018-05-01T00:02:50', {'722-50059': 80, '724-722': 87}))]
+        for filename, page in pages:
+            with open(os.path.join(self.archive_path, filename), 'wb') as xml_out:
+                xml_out.write(page)
+
+    def tearDown(self):
+        for module, mongo_client in zip(self.modules, self.mongo_clients):
+            module.MongoClient = mongo_client
+        shutil.rmtree(self.archive_path)
+
+    def test_replay_database(self):
+        replay = TSMReplay()
+        result = replay.run(self.archive_path)
+        self.assertEqual(result['snapshots'], 3)
+        self.assertEqual(result['stored_records'], 4)
+        replay_db = self.client[REPLAY_DATABASE]
+        self.assertEqual(replay_db[tsm_fetcher_helper.TRAFFIC_SPEED_COLLECTION].count_documents({}), 4)
+        self.assertEqual(replay_db[tsm_fetcher_helper.WATERMARK_COLLECTION].count_documents({}), 1)
+        # Nothing lands in the live database
+        self.assertEqual(self.client['traffic'].list_collection_names(), [])
+
+    def test_replay_poll_stats(self):
+        replay = TSMReplay()
+        replay.run(self.archive_path)
+        self.assertEqual(replay.tsm_fetcher.get_poll_stats()['duplicate_payload'], 0)
+        self.assertEqual(replay.tsm_fetcher.get_poll_stats()['skipped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)